@@ -0,0 +1,354 @@
+import os
+import sys
+import json
+import time
+import wave
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+from types import SimpleNamespace
+
+import numpy as np
+from subtitle_core import IntervalIndex, SrtWriter, read_srt
+
+"""
+Stage-level benchmarks of the transcription and caption pipeline on deterministic synthetic fixtures.
+
+Fixtures are generated locally: speech-like regions (harmonic "voices" with syllable-rate amplitude modulation, a low
+voice and a high voice standing in for two languages) alternate with near-silent regions of various lengths.
+Model-bound stages run with stub models by default, so the suite runs offline on CPU without downloading any weights.
+Results are compared against a json baseline to catch regressions.
+"""
+
+SAMPLE_RATE = 16000
+
+DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'baseline.json')
+
+# Fixture layouts as (region kind, seconds). Kinds are 'low' and 'high' voices and 'silence'.
+FIXTURES = {
+    'dense_bilingual': [('low', 20), ('high', 15), ('low', 3), ('high', 25), ('silence', 2), ('low', 35)],
+    'sparse_speech': [('silence', 40), ('low', 4), ('silence', 60), ('high', 2), ('silence', 30), ('low', 6), ('silence', 40)],
+    'rapid_switching': [kind for _ in range(30) for kind in [('low', 2), ('high', 2), ('silence', 0.5)]],
+    'silent': [('silence', 120)],
+}
+
+# Length of the srt file of the caption codec benchmark, in lines. Each caption takes 4 lines: index, times, text and
+# the blank line after it.
+DEFAULT_SRT_LINES = 100000
+
+# A stage is reported as regressed if it is slower or uses more memory than the baseline by more than this ratio.
+DEFAULT_TOLERANCE = 0.25
+# Differences below these are run to run noise, whatever their ratio. Stages of the stub models take milliseconds.
+NOISE_FLOOR = {'wall_seconds': 0.5, 'peak_traced_mb': 1.0}
+
+def synthesize_region(kind, seconds, rng):
+    n = int(seconds * SAMPLE_RATE)
+    t = np.arange(n) / SAMPLE_RATE
+    noise = rng.normal(0.0, 0.002, n)
+    if kind == 'silence':
+        return noise
+    fundamental = 120.0 if kind == 'low' else 290.0
+    # Slow pitch drift and a few harmonics with decaying amplitude give a voice-like spectrum.
+    pitch = fundamental * (1.0 + 0.05 * np.sin(2 * np.pi * 0.7 * t + rng.uniform(0, np.pi)))
+    phase = 2 * np.pi * np.cumsum(pitch) / SAMPLE_RATE
+    voice = sum(np.sin(h * phase) / h for h in range(1, 8))
+    # Syllables at ~4 Hz.
+    envelope = np.clip(np.sin(2 * np.pi * 4.0 * t + rng.uniform(0, np.pi)), 0.0, None) ** 0.5
+    return 0.1 * voice * envelope + noise
+
+def generate_fixture(name, layout, fixture_dir, scale=1.0):
+    """
+    Write the fixture as a 16 kHz mono wav, plus an mp4 with a blank video track if ffmpeg is available.
+    Returns (audio path, video path or None, seconds).
+    """
+    rng = np.random.default_rng(sum(map(ord, name)))
+    samples = np.concatenate([synthesize_region(kind, seconds * scale, rng) for kind, seconds in layout])
+    audio_path = os.path.join(fixture_dir, name + '.wav')
+    with wave.open(audio_path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes((np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    seconds = len(samples) / SAMPLE_RATE
+
+    video_path = None
+    if shutil.which('ffmpeg'):
+        video_path = os.path.join(fixture_dir, name + '.mp4')
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'color=c=black:s=160x90:r=10:d=' + str(seconds),
+                        '-i', audio_path, '-shortest', '-c:v', 'libx264', '-c:a', 'aac', video_path], check=True)
+    return audio_path, video_path, seconds
+
+class StubVadModel:
+    """
+    Energy based stand-in for the Silero model, with the interface stream_speech_timestamps uses.
+    """
+    def reset_states(self):
+        pass
+
+    def __call__(self, frame, sampling_rate):
+        import torch
+        return torch.tensor(min(1.0, float(frame.pow(2).mean().sqrt()) / 0.02))
+
+def stub_get_speech_timestamps(wav, model, sampling_rate=SAMPLE_RATE, threshold=0.5, frame_samples=512, min_speech_samples=4000,
+                               min_silence_samples=4800):
+    """
+    Energy based stand-in for Silero's get_speech_timestamps. Returns segments in samples.
+    Like Silero, runs of speech separated by less than min_silence_samples are merged, so that the gaps between the
+    syllables of the synthetic voices don't cut speech into pieces too short to keep.
+    """
+    wav = np.asarray(wav)
+    frames = len(wav) // frame_samples
+    if frames == 0:
+        return []
+    rms = np.sqrt((wav[:frames * frame_samples].reshape(frames, frame_samples) ** 2).mean(axis=1))
+    speech = np.concatenate([[False], np.minimum(1.0, rms / 0.02) >= threshold, [False]])
+    edges = np.flatnonzero(speech[1:] != speech[:-1])
+    starts = edges[::2] * frame_samples
+    ends = edges[1::2] * frame_samples
+    if len(starts) == 0:
+        return []
+    group_starts = np.flatnonzero(np.concatenate(([True], starts[1:] - ends[:-1] >= min_silence_samples)))
+    group_ends = np.concatenate((group_starts[1:] - 1, [len(ends) - 1]))
+    segments = []
+    for start, end in zip(starts[group_starts], ends[group_ends]):
+        if end - start >= min_speech_samples:
+            segments.append({'start': int(start), 'end': int(end)})
+    return segments
+
+class StubWhisperModel:
+    """
+    Stand-in for a whisper model with the methods the pipeline calls on it. Language is decided by whether the low or
+    the high mel bands carry more energy, which tells the two synthetic voices apart.
+    """
+    dims = SimpleNamespace(n_mels=80)
+
+    def __init__(self):
+        import torch
+        self.device = torch.device('cpu')
+
+    def embed_audio(self, mel):
+        return mel
+
+    def detect_language(self, features):
+        probs = []
+        for mel in features:
+            # Windows are padded to 30 s with frames of zeros, and silence within them is at the floor of the log-mel in
+            # every band. Only the frames of actual audio are compared, or the padding drowns out the voices.
+            audible = (mel != 0).any(dim=0) & (mel.amax(dim=0) > mel.min() + 1e-6)
+            if not bool(audible.any()):
+                probs.append({'en': 0.5, 'ko': 0.5})
+                continue
+            bands = mel[:, audible].mean(dim=1)
+            # How much more the low bands carry than the next ones: about 0.4 for the low voice and 0 for the high one.
+            low_share = float(bands[:20].mean() - bands[20:40].mean())
+            p_low = 1.0 / (1.0 + np.exp(-20.0 * (low_share - 0.2)))
+            probs.append({'en': p_low, 'ko': 1.0 - p_low})
+        return None, probs
+
+    def transcribe(self, audio, language=None, **kwargs):
+        segments = []
+        step = 3 * SAMPLE_RATE
+        for start in range(0, len(audio), step):
+            chunk = np.asarray(audio[start:start + step])
+            if len(chunk) > 0 and np.sqrt((chunk ** 2).mean()) > 0.01:
+                segments.append({'start': start / SAMPLE_RATE, 'end': (start + len(chunk)) / SAMPLE_RATE, 'text': ' stub ' + str(language)})
+        return {'segments': segments}
+
+def max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        # Not available on windows.
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on linux, bytes on macOS.
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+def measure(results, stage, audio_seconds, function, *args, **kwargs):
+    """
+    Run function, record wall time, real-time factor and peak memory of stage into results, and return its result.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[stage] = {
+        'wall_seconds': wall,
+        'rtf': wall / audio_seconds if audio_seconds else None,
+        'peak_traced_mb': peak / (1024 * 1024),
+        'max_rss_mb': max_rss_mb(),
+    }
+    print('  {0:<32} {1:9.3f} s  rtf {2:8.5f}  peak {3:8.1f} MB'.format(stage, wall, results[stage]['rtf'] or 0.0, results[stage]['peak_traced_mb']))
+    return result
+
+def clip_track_items(audio_seconds, clip_seconds=10.0):
+    """
+    Timeline clips cutting the fixture into consecutive pieces, as pymiere track items would.
+    """
+    clips = []
+    start = 0.0
+    while start < audio_seconds:
+        end = min(start + clip_seconds, audio_seconds)
+        clips.append(SimpleNamespace(inPoint=SimpleNamespace(seconds=start), outPoint=SimpleNamespace(seconds=end),
+                                     duration=SimpleNamespace(seconds=end - start)))
+        start = end
+    return clips
+
+def benchmark_fixture(name, layout, fixture_dir, args):
+    import transcription
+    audio_path, video_path, audio_seconds = generate_fixture(name, layout, fixture_dir, args.scale)
+    print(name + ' (' + '{0:.0f}'.format(audio_seconds) + ' s)')
+    results = {}
+
+    if args.real_models:
+        vad_model, get_speech_timestamps = transcription.create_vad_model()
+        whisper_model = transcription.load_whisper_model(args.model)
+    else:
+        vad_model, get_speech_timestamps = StubVadModel(), stub_get_speech_timestamps
+        whisper_model = StubWhisperModel()
+
+    if video_path is not None:
+        measure(results, 'extract_audio', audio_seconds, transcription.extract_audio, video_path, os.path.join(fixture_dir, name + '_extracted.wav'))
+    audio = measure(results, 'load_audio', audio_seconds, transcription.load_audio, audio_path)
+    segments = measure(results, 'vad_transcribe_timestamps', audio_seconds, transcription.vad_transcribe_timestamps,
+                       vad_model, get_speech_timestamps, audio_path, 0.0, audio_seconds, samples=audio)
+    # Fixtures with speech must give every later stage work to do, or their timings measure nothing.
+    has_speech = any(kind != 'silence' for kind, _ in layout)
+    assert len(segments) > 0 or not has_speech, name + ": VAD found no speech segments."
+    detection_path = os.path.join(fixture_dir, name + '_lang_detection.seg')
+    measure(results, 'language_detection_test_adaptive', audio_seconds, transcription.language_detection_test,
+            detection_path, whisper_model, audio_path, pre_transcribe_segments=segments, audio=audio, adaptive=True)
+    measure(results, 'language_detection_test', audio_seconds, transcription.language_detection_test,
+            detection_path, whisper_model, audio_path, pre_transcribe_segments=segments, audio=audio)
+    transcription_path = os.path.join(fixture_dir, name + '_transcription.seg')
+    assert len(transcription.read_segments(detection_path)) > 0 or not has_speech, name + ": language detection found no windows."
+    transcriptions = measure(results, 'transcribe_using_detection', audio_seconds, transcription.transcribe_using_detection,
+                             detection_path, transcription_path, whisper_model, audio_path, audio=audio)
+    assert len(transcriptions) > 0 or not has_speech, name + ": transcription produced no segments."
+    measure(results, 'transcriptions_to_srt', audio_seconds, transcription.transcriptions_to_srt,
+            os.path.join(fixture_dir, name + '.srt'), transcriptions)
+
+    try:
+        from process_sequence import add_transcription_to_captions
+        captions = []
+        def merge_captions():
+            clip_begin_time_in_track = 0.0
+            transcription_index = IntervalIndex(transcription.read_segments(transcription_path))
+            for clip in clip_track_items(audio_seconds):
+                add_transcription_to_captions(clip, clip_begin_time_in_track, transcription_index, captions)
+                clip_begin_time_in_track += clip.duration.seconds
+        measure(results, 'add_transcription_to_captions', audio_seconds, merge_captions)
+    except ImportError as e:
+        print('  add_transcription_to_captions skipped: ' + str(e))
+
+    if args.denoise:
+        # DeepFilterNet has no stub; this stage only runs with its real model.
+        from df.enhance import init_df
+        from denoise_audio import denoise_file
+        df_model, df_state, _ = init_df(post_filter=True, config_allow_defaults=True)
+        measure(results, 'denoise_file', audio_seconds, denoise_file, df_model, df_state, audio_path, reprocess=True)
+
+    return {'audio_seconds': audio_seconds, 'stages': results}
+
+def benchmark_srt(line_count, fixture_dir):
+    """
+    Write and read back an srt file of about line_count lines with the subtitle_core codec, and with pysrt when it is
+    installed for comparison.
+    """
+    caption_count = line_count // 4
+    print('srt (' + str(caption_count) + ' captions)')
+    starts = [1500 * i for i in range(caption_count)]
+    texts = ['Caption number ' + str(i) + ' ' + 'ab' * (i % 20) for i in range(caption_count)]
+    audio_seconds = 1.5 * caption_count
+    results = {}
+
+    srt_path = os.path.join(fixture_dir, 'benchmark_codec.srt')
+    def write_captions():
+        with SrtWriter(srt_path) as writer:
+            for start, text in zip(starts, texts):
+                writer.write(start, start + 1200, text)
+    measure(results, 'srt_write', audio_seconds, write_captions)
+    measure(results, 'srt_read', audio_seconds, read_srt, srt_path)
+
+    try:
+        import pysrt
+        pysrt_path = os.path.join(fixture_dir, 'benchmark_pysrt.srt')
+        def write_pysrt():
+            items = [pysrt.SubRipItem(i + 1, pysrt.SubRipTime.from_ordinal(start), pysrt.SubRipTime.from_ordinal(start + 1200), text)
+                     for i, (start, text) in enumerate(zip(starts, texts))]
+            pysrt.SubRipFile(items).save(pysrt_path, encoding='utf-8')
+        measure(results, 'pysrt_write', audio_seconds, write_pysrt)
+        measure(results, 'pysrt_read', audio_seconds, pysrt.open, srt_path)
+    except ImportError as e:
+        print('  pysrt comparison skipped: ' + str(e))
+
+    return {'audio_seconds': audio_seconds, 'stages': results}
+
+def compare_to_baseline(report, baseline, tolerance):
+    """
+    Return a list of descriptions of the stages that regressed compared to baseline.
+    """
+    regressions = []
+    for fixture, fixture_report in report['fixtures'].items():
+        baseline_stages = baseline.get('fixtures', {}).get(fixture, {}).get('stages', {})
+        for stage, result in fixture_report['stages'].items():
+            if stage not in baseline_stages:
+                continue
+            for metric in ['wall_seconds', 'peak_traced_mb']:
+                before = baseline_stages[stage][metric]
+                after = result[metric]
+                if before and after > before * (1.0 + tolerance) and after - before > NOISE_FLOOR[metric]:
+                    regressions.append('{0}/{1} {2}: {3:.3f} -> {4:.3f}'.format(fixture, stage, metric, before, after))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the pipeline on synthetic fixtures.')
+    parser.add_argument("--fixtures", nargs='*', choices=list(FIXTURES.keys()), help="Fixtures to run. Runs all if not set.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the length of every fixture region by this.")
+    parser.add_argument("--fixture_dir", help="Directory to write fixtures and stage outputs to. A temporary directory is used if not set.")
+    parser.add_argument("--real_models", action='store_true', help="Use the real Silero and whisper models instead of stubs.")
+    parser.add_argument("--model", default='medium', help="Whisper model to use with --real_models.")
+    parser.add_argument("--denoise", action='store_true', help="Also benchmark denoise_file. Requires DeepFilterNet and its model.")
+    parser.add_argument("--srt_lines", type=int, default=DEFAULT_SRT_LINES, help="Lines of the srt file of the caption codec benchmark. 0 skips it.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="Baseline json to compare against.")
+    parser.add_argument("--update_baseline", action='store_true', help="Write the results as the new baseline instead of comparing.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed ratio of regression against the baseline.")
+    parser.add_argument("--output", help="Also write the results to this json file.")
+    args = parser.parse_args()
+
+    fixture_dir = args.fixture_dir or tempfile.mkdtemp(prefix='multilang_benchmark_')
+    os.makedirs(fixture_dir, exist_ok=True)
+    report = {'config': {'scale': args.scale, 'real_models': args.real_models, 'model': args.model if args.real_models else 'stub'},
+              'fixtures': {}}
+    for name in args.fixtures or FIXTURES.keys():
+        report['fixtures'][name] = benchmark_fixture(name, FIXTURES[name], fixture_dir, args)
+    if args.srt_lines > 0:
+        report['fixtures']['srt_' + str(args.srt_lines) + '_lines'] = benchmark_srt(args.srt_lines, fixture_dir)
+    if not args.fixture_dir:
+        shutil.rmtree(fixture_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w+', encoding='UTF-8') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w+', encoding='UTF-8') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print("Baseline written to " + args.baseline)
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline, encoding='UTF-8') as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('config') != report['config']:
+            print("Baseline was recorded with a different configuration " + json.dumps(baseline.get('config')) + "; not comparing.")
+        else:
+            regressions = compare_to_baseline(report, baseline, args.tolerance)
+            if len(regressions) > 0:
+                sys.exit("Regressions against " + args.baseline + ":\n" + "\n".join(regressions))
+            print("No regressions against " + args.baseline + ".")
+    else:
+        # A missing baseline would otherwise pass every run without comparing anything.
+        sys.exit("No baseline at " + args.baseline + ". Use --update_baseline to record one.")
@@ -0,0 +1,111 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+import transcription
+
+"""
+Compares the int8 quantized whisper model of --quantize against the full precision model on the same audio.
+Both modes run language detection and transcription on the same fixture, and the report gives the speedup of the
+quantized mode along with the word error rate of each mode against a reference transcript. Without a reference, the
+full precision transcript is the reference, and the quantized mode's word error rate is its drift from it.
+"""
+
+# Scripts without spaces between words, where every character counts as a word.
+UNSEGMENTED_SCRIPT = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+
+def wer_tokens(text):
+    text = re.sub(r"[^\w\s" + UNSEGMENTED_SCRIPT + "]", ' ', text.lower())
+    return re.findall('[' + UNSEGMENTED_SCRIPT + ']|[^\\s' + UNSEGMENTED_SCRIPT + ']+', text)
+
+def word_error_rate(reference, hypothesis):
+    """
+    (substitutions + deletions + insertions) / number of reference words, between two transcripts.
+    """
+    reference = wer_tokens(reference)
+    hypothesis = wer_tokens(hypothesis)
+    if len(reference) == 0:
+        return 0.0 if len(hypothesis) == 0 else 1.0
+    # Levenshtein distance over words, keeping a single row of the table.
+    previous = list(range(len(hypothesis) + 1))
+    for i, reference_word in enumerate(reference, 1):
+        current = [i]
+        for j, hypothesis_word in enumerate(hypothesis, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (reference_word != hypothesis_word)))
+        previous = current
+    return previous[-1] / len(reference)
+
+def run_mode(audio_path, model_type, quantize, work_dir, batch_size):
+    """
+    Load the model and run language detection and transcription on audio_path.
+    Returns {load_seconds, detection_seconds, transcription_seconds, text}.
+    """
+    mode = 'int8' if quantize else 'fp32'
+    name = os.path.splitext(os.path.basename(audio_path))[0] + '_' + mode
+    start = time.perf_counter()
+    model = transcription.load_whisper_model(model_type, quantize)
+    load_seconds = time.perf_counter() - start
+
+    audio = transcription.load_shared_audio(audio_path, os.path.join(work_dir, name + '_16k.pcm'))
+    detection_path = os.path.join(work_dir, name + '_lang_detection.seg')
+    start = time.perf_counter()
+    transcription.language_detection_test(detection_path, model, audio_path, audio=audio, batch_size=batch_size)
+    detection_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    transcriptions = transcription.transcribe_using_detection(detection_path, os.path.join(work_dir, name + '_transcription.seg'), model, audio_path, audio=audio)
+    transcription_seconds = time.perf_counter() - start
+    return {'load_seconds': load_seconds, 'detection_seconds': detection_seconds, 'transcription_seconds': transcription_seconds,
+            'audio_seconds': len(audio) / transcription.SAMPLE_RATE, 'text': ' '.join(segment['text'].strip() for segment in transcriptions)}
+
+def compare(audio_path, model_type, reference_text, work_dir, batch_size):
+    modes = {'fp32': run_mode(audio_path, model_type, False, work_dir, batch_size),
+             'int8': run_mode(audio_path, model_type, True, work_dir, batch_size)}
+    reference = reference_text if reference_text is not None else modes['fp32']['text']
+    for result in modes.values():
+        result['wer'] = word_error_rate(reference, result['text'])
+        result['inference_seconds'] = result['detection_seconds'] + result['transcription_seconds']
+        result['rtf'] = result['inference_seconds'] / result['audio_seconds']
+    return {'audio': audio_path, 'model': model_type, 'reference': 'given' if reference_text is not None else 'fp32',
+            'modes': modes, 'speedup': modes['fp32']['inference_seconds'] / modes['int8']['inference_seconds'],
+            'wer_delta': modes['int8']['wer'] - modes['fp32']['wer']}
+
+def print_report(report):
+    print(report['audio'] + ' (' + report['model'] + ', reference: ' + report['reference'] + ')')
+    print('{0:<6} {1:>9} {2:>12} {3:>15} {4:>8} {5:>8}'.format('mode', 'load [s]', 'detect [s]', 'transcribe [s]', 'rtf', 'wer'))
+    for mode, result in report['modes'].items():
+        print('{0:<6} {1:>9.1f} {2:>12.1f} {3:>15.1f} {4:>8.3f} {5:>8.3f}'.format(
+            mode, result['load_seconds'], result['detection_seconds'], result['transcription_seconds'], result['rtf'], result['wer']))
+    print('speedup {0:.2f}x, word error rate delta {1:+.3f}'.format(report['speedup'], report['wer_delta']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the speed and accuracy of the int8 quantized whisper model against full precision.')
+    parser.add_argument("audio", nargs='?', help="Audio to compare on. A synthetic benchmark.py fixture is generated if not set, which is only meaningful for speed.")
+    parser.add_argument("--reference", help="Text file with the reference transcript of the audio.")
+    parser.add_argument("--model", default=transcription.DEFAULT_MODEL_TYPE, help="Whisper model to compare.")
+    parser.add_argument("--fixture", default='dense_bilingual', help="benchmark.py fixture to generate if no audio is given.")
+    parser.add_argument("--detection_batch_size", type=int, default=transcription.DETECTION_BATCH_SIZE, help="Number of language detection windows run through the model at once.")
+    parser.add_argument("--output", help="Also write the report to this json file.")
+    args = parser.parse_args()
+
+    reference_text = None
+    if args.reference:
+        with open(args.reference, encoding='UTF-8') as reference_file:
+            reference_text = reference_file.read()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_path = args.audio
+        if audio_path is None:
+            import benchmark
+            audio_path, _, _ = benchmark.generate_fixture(args.fixture, benchmark.FIXTURES[args.fixture], work_dir)
+        elif not os.path.isfile(audio_path):
+            sys.exit(audio_path + " is not a file.")
+        report = compare(os.path.abspath(audio_path), args.model, reference_text, work_dir, args.detection_batch_size)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w+', encoding='UTF-8') as output_file:
+            json.dump(report, output_file, indent=2, ensure_ascii=False)
@@ -1,20 +1,21 @@
-import torch
-import torchaudio
 import os
 import sys
 import argparse
-import numpy as np
-from df.enhance import enhance, init_df, load_audio, save_audio
-from pydub import AudioSegment
+from media_info import MediaIndex, media_duration
+from stage_trace import trace_stage, start_trace, count_ffmpeg, count_model_invocation
 import subprocess
 
 MINUTE = 1000 * 60
 
 """
 Denoises audio files.
+DeepFilterNet (and with it torch) and pydub are imported only by the functions that use them.
 """
 
-def denoise_file(model, df_state, filepath, reprocess = False, generate_mono = False):
+def denoise_file(model, df_state, filepath, reprocess = False, generate_mono = False, media_index = None):
+    from df.enhance import enhance, load_audio, save_audio
+    from pydub import AudioSegment
+
     print("Denoising", filepath)
     audio_format = filepath.split('.')[1]
     denoised_filepath = os.path.splitext(filepath)[0] + '_denoised.' + audio_format   
@@ -25,20 +26,27 @@ def denoise_file(model, df_state, filepath, reprocess = False, generate_mono = F
     
     else:
         file_to_enhance = filepath
-        og_audio = AudioSegment.from_file(filepath, format=audio_format)
         
         # VERY HACKY WAY to avoid gpu out of memory issue. Need to properly support batching, but that isn't done yet.
-        if (len(og_audio) > 5 * MINUTE):
+        # The duration comes from the file headers, so skipped files are never decoded.
+        duration = media_duration(filepath, index=media_index)
+        if (duration * 1000 > 5 * MINUTE):
             print("Skipping this file; Currently audio over 5 minutes are unsupported due to insufficient GPU memory.")
             return
-        
-        if (audio_format != 'wav'):        
-            file_to_enhance = "original_intermediate.wav"
-            og_audio.export(file_to_enhance, format="wav")
-        
-        audio, _ = load_audio(file_to_enhance, sr=df_state.sr())
+        with trace_stage('denoise_decode', audio_seconds=duration, file=filepath):
+            og_audio = AudioSegment.from_file(filepath, format=audio_format)
+            
+            if (audio_format != 'wav'):        
+                # pydub decodes and encodes anything but wav with an ffmpeg subprocess.
+                count_ffmpeg(2)
+                file_to_enhance = "original_intermediate.wav"
+                og_audio.export(file_to_enhance, format="wav")
+            
+            audio, _ = load_audio(file_to_enhance, sr=df_state.sr())
         # Denoise the audio
-        enhanced = enhance(model, df_state, audio)
+        with trace_stage('denoise', audio_seconds=duration, file=filepath):
+            enhanced = enhance(model, df_state, audio)
+            count_model_invocation()
         
         intermediate_enhanced = 'enhanced_intermediate.wav'
         
@@ -54,7 +62,9 @@ def denoise_file(model, df_state, filepath, reprocess = False, generate_mono = F
         # Now make a mono version.
         denoised_mono_filepath = os.path.splitext(filepath)[0] + '_denoised_mono.' + audio_format  
         cmd_str = "ffmpeg -y -i " + denoised_filepath + " -ac 1 "  + denoised_mono_filepath
-        subprocess.run(cmd_str, shell=True)
+        count_ffmpeg()
+        with trace_stage('denoise_mono', file=filepath):
+            subprocess.run(cmd_str, shell=True)
 
     print("Saved denoised file to ", denoised_filepath)
 
@@ -67,20 +77,32 @@ if __name__ == "__main__":
     parser.add_argument("--generate_mono", action='store_true', help = "Generate mono versions of the denoised audio.")
     
     args = parser.parse_args()
+    if not args.dir and not args.test_single_file:
+        sys.exit("Neither --dir nor --test_single_file is set. Exiting.")
+    if args.dir and not os.path.exists(args.dir):
+        sys.exit(args.dir + " is an invalid directory. Exiting.")
+    if args.test_single_file and not os.path.isfile(args.test_single_file):
+        sys.exit(args.test_single_file + " is an invalid file. Exiting.")
+    # The trace goes next to the audio being denoised, only once it is known to exist.
+    start_trace(os.path.abspath(args.dir or os.path.dirname(os.path.abspath(args.test_single_file))), 'denoise')
 
+    from df.enhance import init_df
     model, df_state, _ = init_df(post_filter=True, config_allow_defaults=True)  # Load default model
         
     if args.dir:
-        if not os.path.exists(args.dir):
-            sys.exit(args.dir + " is an invalid directory. Exiting.")
-        
+        audio_files = []
         for root, dirs, files in os.walk(args.dir):
             path = root.split(os.sep)
             for file in files:
                 if file.split('.')[0].endswith('denoised'):
                     continue
                 if file.endswith('wav') or file.endswith('.mp3'):
-                    denoise_file(model, df_state, os.path.join(root, file), args.reprocess, generate_mono = args.generate_mono)
+                    audio_files.append(os.path.join(root, file))
+        # Probe all files in parallel up front, denoise_file then only reads the index. Unreadable files are skipped.
+        media_index = MediaIndex()
+        media_infos = media_index.probe_many(audio_files)
+        for audio_file in [audio_file for audio_file in audio_files if os.path.abspath(audio_file) in media_infos]:
+            denoise_file(model, df_state, audio_file, args.reprocess, generate_mono = args.generate_mono, media_index = media_index)
 
     if args.test_single_file:
         filepath = os.path.abspath(args.test_single_file)
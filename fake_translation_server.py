@@ -0,0 +1,126 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+Local stand-in for the translation API, to run generate_translated_captions.py offline with --translation_server.
+
+POST /translate takes the json requests of translation_engine.HttpTranslationBackend and "translates" each line by
+prefixing it with the target language, detecting the source language from its script. The server can add latency and
+fail a share of requests with 429 or 503, to exercise concurrency, rate limiting and retries, and reject requests
+over a line or codepoint limit with 413, to exercise batch splitting. GET /stats returns the number of requests and
+lines served, the failures injected, the requests rejected as too large and the most requests in flight at once.
+"""
+
+def detect_script_language(text):
+    for character in text:
+        if '\uac00' <= character <= '\ud7af' or '\u1100' <= character <= '\u11ff':
+            return 'ko'
+        if '\u3040' <= character <= '\u30ff':
+            return 'ja'
+    if any('\u4e00' <= character <= '\u9fff' for character in text):
+        return 'zh-CN'
+    return 'en'
+
+class FakeTranslationServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, failure_rate=0.0, max_lines=None, max_codepoints=None, seed=0):
+        super().__init__(address, FakeTranslationHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.max_lines = max_lines
+        self.max_codepoints = max_codepoints
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'lines': 0, 'failures': 0, 'too_large': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+    @property
+    def url(self):
+        return 'http://' + self.server_address[0] + ':' + str(self.server_address[1]) + '/translate'
+
+class FakeTranslationHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=()):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_json(404, {'error': 'not found'})
+            return
+        with self.server.lock:
+            self.send_json(200, dict(self.server.stats))
+
+    def do_POST(self):
+        if self.path != '/translate':
+            self.send_json(404, {'error': 'not found'})
+            return
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.stats['requests'] += 1
+            server.stats['in_flight'] += 1
+            server.stats['max_in_flight'] = max(server.stats['max_in_flight'], server.stats['in_flight'])
+            fail = server.random.random() < server.failure_rate
+            if fail:
+                server.stats['failures'] += 1
+        try:
+            time.sleep(server.latency)
+            if fail:
+                self.send_json(server.random.choice([429, 503]), {'error': 'injected failure'}, [('Retry-After', '0.1')])
+                return
+            contents = request['contents']
+            codepoints = sum(len(text) for text in contents)
+            if ((server.max_lines is not None and len(contents) > server.max_lines) or
+                    (server.max_codepoints is not None and codepoints > server.max_codepoints)):
+                with server.lock:
+                    server.stats['too_large'] += 1
+                self.send_json(413, {'error': 'request too large, ' + str(len(contents)) + ' lines, ' + str(codepoints) + ' codepoints'})
+                return
+            target_language = request['target_language_code']
+            translations = [{'translated_text': '[' + target_language + '] ' + text, 'detected_language_code': detect_script_language(text)}
+                            for text in contents]
+            with server.lock:
+                server.stats['lines'] += len(contents)
+            self.send_json(200, {'translations': translations})
+        finally:
+            with server.lock:
+                server.stats['in_flight'] -= 1
+
+def serve_in_thread(**kwargs):
+    """
+    Start a FakeTranslationServer on a free local port in a daemon thread and return it. Stop it with shutdown().
+    """
+    server = FakeTranslationServer(('127.0.0.1', 0), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a fake translation API locally for offline runs of generate_translated_captions.py.')
+    parser.add_argument("--port", type=int, default=8765, help="Local port to listen on.")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds each request takes.")
+    parser.add_argument("--failure_rate", type=float, default=0.0, help="Share of requests failed with 429 or 503.")
+    parser.add_argument("--max_lines", type=int, help="Reject requests with more lines than this.")
+    parser.add_argument("--max_codepoints", type=int, help="Reject requests with more codepoints than this.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the injected failures.")
+    args = parser.parse_args()
+
+    server = FakeTranslationServer(('127.0.0.1', args.port), args.latency, args.failure_rate, args.max_lines, args.max_codepoints, args.seed)
+    print("Fake translation server listening on " + server.url + ".")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
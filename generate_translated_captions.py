@@ -2,14 +2,13 @@ import os
 import sys
 import json
 import argparse
-import pysrt
-import html
-from google.cloud import translate
-from google.cloud.translate_v3.types import translation_service
-from google.oauth2 import service_account
+from stage_trace import trace_stage, start_trace, count_model_invocation
+from subtitle_core import read_srt, SrtWriter, SrtCaptions, read_segments, IntervalIndex, dominant_language
+from translation_memory import TranslationMemory, AUTO_SOURCE_LANGUAGE
+from translation_engine import TranslationEngine, GoogleTranslateBackend, HttpTranslationBackend, DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_SECOND, DEFAULT_MAX_RETRIES
 
-# Maximum amount of lines possible to send in a single translation request.
-MAX_STRING_LIMIT = 700
+# Language written to _languages.txt for the captions neither the transcription nor the backend found a language for.
+UNDETERMINED_LANGUAGE = 'und'
 
 def modified_path(path, end, ext):
     return os.path.join(os.path.dirname(path), os.path.basename(path).split('.')[0] + '_' + end + '.' + ext)
@@ -30,37 +29,82 @@ def generate_stats(languages, captions):
             language = 'zh'
         if language not in ['ko', 'zh', 'en', 'ja']:
             continue
-        duration = (captions[i].end - captions[i].start).seconds + 0.001 * (captions[i].end - captions[i].start).milliseconds
+        duration = 0.001 * (captions.ends[i] - captions.starts[i])
         total_speech_duration += duration
         language_durations[language] += duration
     print("total_speech_duration is ", total_speech_duration)
     for lang in language_durations:
         print("Language", lang, " percentage: ", float(language_durations[lang]) / float(total_speech_duration))
 
-def translate_captions(srt_path, google_api_key_path, args):
+def transcription_languages(captions, segments_path):
+    """
+    Language of each caption from the segments it overlaps most in segments_path, the sequence time transcription
+    segments written next to the srt by process_sequence.py. None for the captions no segment overlaps.
+    """
+    index = IntervalIndex(read_segments(segments_path))
+    return [dominant_language(index, captions.start_seconds(i), captions.end_seconds(i)) for i in range(len(captions))]
+
+def caption_languages(srt_path, captions, create_backend, args):
+    """
+    Language of each caption, from the transcription segments where possible. The captions left are sent to the
+    translation backend together, and get the source language it detects, or UNDETERMINED_LANGUAGE if it detects none.
+    """
+    segments_path = args.segments or modified_path(srt_path, 'segments', 'seg')
+    languages = [None] * len(captions)
+    if os.path.isfile(segments_path):
+        with trace_stage('translation_transcription_languages', lines=len(captions)):
+            languages = transcription_languages(captions, segments_path)
+    else:
+        print("No transcription segments at " + segments_path + ". Detecting the language of every caption.")
+
+    unresolved = [i for i in range(len(captions)) if languages[i] is None]
+    if len(unresolved) > 0:
+        print("Running language detection model on " + str(len(unresolved)) + " captions.")
+        engine = TranslationEngine(create_backend(), args.translation_concurrency, args.translation_rate, args.translation_retries,
+                                   max_lines=args.translation_batch_lines, max_codepoints=args.translation_batch_codepoints)
+        # Translation requests return the detected source language of every line, so a batch of them is one round
+        # trip instead of one detection request per caption.
+        texts_by_target = {'en': [captions.texts[i] for i in unresolved]}
+        memory = None if args.no_translation_memory else TranslationMemory(args.translation_memory)
+        with trace_stage('translation_detect_language', lines=len(unresolved)) as trace:
+            try:
+                if memory is not None:
+                    results = memory.translate_targets(texts_by_target, AUTO_SOURCE_LANGUAGE, engine.backend.name, engine.translate)
+                else:
+                    results = engine.translate(texts_by_target)
+            finally:
+                count_model_invocation(engine.requests)
+                trace.update(engine.efficiency())
+        if memory is not None:
+            memory.close()
+        for i, (_, detected_language) in zip(unresolved, results['en']):
+            languages[i] = detected_language or UNDETERMINED_LANGUAGE
+    return languages
+
+def two_step_source(captions, languages, base_translated_captions, target_language):
+    """
+    Captions to translate to target_language in the experimental two-step translation: the base translation, except
+    for the captions already in the target language.
+    """
+    source = SrtCaptions()
+    for i in range(len(captions)):
+        if languages[i][0:2] != target_language[0:2]:
+            source.append(base_translated_captions.starts[i], base_translated_captions.ends[i], base_translated_captions.texts[i])
+        else:
+            source.append(captions.starts[i], captions.ends[i], captions.texts[i])
+    return source
+
+def translate_captions(srt_path, create_backend, args):
  
-    captions = pysrt.open(srt_path)
-        
-    credentials = service_account.Credentials.from_service_account_file(google_api_key_path)
-    client = translate.TranslationServiceClient(credentials=credentials)
-    project_id = credentials.project_id
-    assert(project_id)
-    location = 'global'
-    parent = f'projects/{project_id}/locations/{location}'
+    captions = read_srt(srt_path)
     
     if (args.stats):
         languages = read_languages(srt_path)
         
         if len(languages) != len(captions):
-            print ("Number of languages detected in _languages.txt does not match length of captions! Regenerating language file..")
-        
-        if len(languages) == 0:
-            print("Running language detection model.")
-            response = []
-            for caption in captions:
-                response.append(client.detect_language(content=caption.text, parent=parent))
-            for i in range(len(response)):
-                languages.append(response[i].languages[0].language_code)
+            if len(languages) > 0:
+                print ("Number of languages detected in _languages.txt does not match length of captions! Regenerating language file..")
+            languages = caption_languages(srt_path, captions, create_backend, args)
             if len(languages) > 0:
                 file = open(modified_path(srt_path, 'languages', 'txt'), "w+", encoding='UTF-8')
                 file.writelines([r + '\n' for r in languages])
@@ -78,11 +122,10 @@ def translate_captions(srt_path, google_api_key_path, args):
     if (args.ja_zh):
         translation_target_languages = ['ja', 'zh-CN']
         
-        
-    for l in range(len(translation_target_languages)):
-        target_language = translation_target_languages[l]
-        print("Translating " + srt_path + " to " + target_language + "...")
-        
+    # Captions translated to each target language.
+    sources = {}
+    for target_language in translation_target_languages:
+        sources[target_language] = captions
         if(args.ja_zh):
             languages = read_languages(srt_path)
             print("result from read languages: ", languages)
@@ -94,69 +137,90 @@ def translate_captions(srt_path, google_api_key_path, args):
             if target_language == 'zh-CN':
                 translated_srt_path =   modified_path(srt_path, 'en', 'srt')
             if not os.path.isfile(translated_srt_path):
-                sys.exit('For experimental two-step translation, a base translation file is necessary. Missing: ', os.path.basename(base_translated_captions))
-            base_translated_captions = pysrt.open(translated_srt_path)
-            if len(captions) != len(base_translated_captions):
-                sys.exit("Number of captions in " + os.path.basename(srt_path) + ' and ' + os.path.basename(base_translated_captions) + ' must match.')
-            for i in range(len(captions)):
-                # Replace the original captions with the base translated language, unless the original caption is
-                # already in the target language.
-                if languages[i][0:2] != target_language:
-                    captions[i] = base_translated_captions[i]
-        
-        translated_captions = []
-        detected_languages = []
-        for k in range(len(captions) // MAX_STRING_LIMIT + 1):
-            captions_batch = captions[k * MAX_STRING_LIMIT:k * MAX_STRING_LIMIT + min(len(captions) - k * MAX_STRING_LIMIT, MAX_STRING_LIMIT)] 
-            response = client.translate_text(
-                contents=[c.text for c in captions_batch],
-                target_language_code=target_language,
-                parent=parent,
-            )
-            
-            if(len(response.translations) != len(captions_batch)):
-                sys.exit("Error: length of translated results does not match the length of captions.")                
-            
-            for i in range(len(response.translations)):
-                text = html.unescape(response.translations[i].translated_text)
-                this_caption = captions[i + k * MAX_STRING_LIMIT]
-                translated_caption = pysrt.SubRipItem(this_caption.index, this_caption.start, this_caption.end, text, this_caption.position)
-                translated_captions.append(translated_caption)
-                if (not os.path.isfile(modified_path(srt_path, 'languages', 'txt')) and l == 0):
-                    detected_languages.append(response.translations[i].detected_language_code)
-        
+                sys.exit('For experimental two-step translation, a base translation file is necessary. Missing: ' + os.path.basename(translated_srt_path))
+            base_translated_captions = read_srt(translated_srt_path)
+            if len(captions) != len(base_translated_captions) or len(captions) != len(languages):
+                sys.exit("Number of captions in " + os.path.basename(srt_path) + ', ' + os.path.basename(translated_srt_path) + ' and its language detection file must match.')
+            sources[target_language] = two_step_source(captions, languages, base_translated_captions, target_language)
+
+    print("Translating " + srt_path + " to " + ", ".join(translation_target_languages) + "...")
+    backend = create_backend()
+    engine = TranslationEngine(backend, args.translation_concurrency, args.translation_rate, args.translation_retries,
+                               max_lines=args.translation_batch_lines, max_codepoints=args.translation_batch_codepoints)
+    texts_by_target = {target_language: sources[target_language].texts for target_language in translation_target_languages}
+    memory = None if args.no_translation_memory else TranslationMemory(args.translation_memory)
+    with trace_stage('translation', lines=len(captions), target_languages=translation_target_languages) as trace:
+        try:
+            if memory is not None:
+                results = memory.translate_targets(texts_by_target, AUTO_SOURCE_LANGUAGE, backend.name, engine.translate)
+            else:
+                results = engine.translate(texts_by_target)
+        finally:
+            # Requests are sent from the engine's threads, so they are counted here for the trace of this thread.
+            count_model_invocation(engine.requests)
+            trace.update(engine.efficiency())
+    print(engine.report())
+    if memory is not None:
+        print(memory.report())
+        memory.close()
+
+    for l in range(len(translation_target_languages)):
+        target_language = translation_target_languages[l]
+        source = sources[target_language]
+        translation_results = results[target_language]
         if target_language == 'zh-CN':
             target_language = 'zh'
         
         # Output translated captions.    
         translated_srt_outpath =  modified_path(srt_path, target_language, 'srt')
-        pysrt.SubRipFile(translated_captions).save(translated_srt_outpath, encoding='utf-8')
+        with SrtWriter(translated_srt_outpath) as writer:
+            for j, (text, _) in enumerate(translation_results):
+                writer.write(source.starts[j], source.ends[j], text)
         print("Translated captions outputted to ", translated_srt_outpath)
         
         # If first language to be translated, then also output language detection result.
-        if len(detected_languages) > 0:
+        if (not os.path.isfile(modified_path(srt_path, 'languages', 'txt')) and l == 0):
             file = open(modified_path(srt_path, 'languages', 'txt'), "w+", encoding='UTF-8')
-            file.writelines([r + '\n' for r in detected_languages])
+            file.writelines([detected_language + '\n' for _, detected_language in translation_results])
 
 parser = argparse.ArgumentParser(
     description='Generate subtitles in 4 languages given an input srt file in multi-language format.')
 parser.add_argument("srt_path", help="Path to the srt caption file to process.")
-parser.add_argument('google_api_key_path',
-                    help="Path to the key to use for google translate api. Otherwise translation is not possible.")
+parser.add_argument('google_api_key_path', nargs='?',
+                    help="Path to the key to use for google translate api. Otherwise translation is not possible, unless --translation_server is set.")
 parser.add_argument('--en', action='store_true', help="Translate for english only.")
 parser.add_argument('--ko_en', action = 'store_true', help='Experimental: Step one of split translate. Translate only korean and english.')
 parser.add_argument('--ja_zh', action = 'store_true', help='Experimental: Step two of split translate. Translate only japanese and chinese based on english and korean translations.')
 parser.add_argument('--four_languages', action='store_true', help='Translate for all languages: English, Chinese, Korean, Japanese')
 parser.add_argument('--stats', action='store_true', help='Return stats for percentage of each language.')
+parser.add_argument('--segments', help='Transcription segments of the captions in sequence time, for --stats. Defaults to the _segments.seg file written next to the srt by process_sequence.py.')
+parser.add_argument('--translation_memory', help='Translation memory file reused across runs. Defaults to TRANSLATION_MEMORY_PATH or ~/.cache/multilang_to_premiere/translation_memory.sqlite.')
+parser.add_argument('--no_translation_memory', action='store_true', help='Translate every line again without reading or updating the translation memory.')
+parser.add_argument('--translation_server', help='Url of a json translation endpoint to use instead of google translate, such as the one of fake_translation_server.py.')
+parser.add_argument('--translation_concurrency', type=int, default=DEFAULT_CONCURRENCY, help='Number of translation requests in flight at once, across all target languages.')
+parser.add_argument('--translation_rate', type=float, default=DEFAULT_REQUESTS_PER_SECOND, help='Maximum number of translation requests started per second. 0 disables the limit.')
+parser.add_argument('--translation_batch_lines', type=int, help='Maximum number of lines in a translation request. Defaults to the limit of the backend.')
+parser.add_argument('--translation_batch_codepoints', type=int, help='Maximum number of codepoints in a translation request. Defaults to the limit of the backend.')
+parser.add_argument('--translation_retries', type=int, default=DEFAULT_MAX_RETRIES, help='Number of times a request failing with a rate limit or server error is sent again.')
 
 args = parser.parse_args()
 srt_path = os.path.abspath(args.srt_path)
-google_api_key_path = os.path.abspath(args.google_api_key_path)
+google_api_key_path = os.path.abspath(args.google_api_key_path) if args.google_api_key_path else None
+has_google_api_key = google_api_key_path is not None and os.path.isfile(google_api_key_path) and google_api_key_path.endswith('.json')
+
+def create_backend():
+    if args.translation_server:
+        return HttpTranslationBackend(args.translation_server)
+    if not has_google_api_key:
+        sys.exit("A google api key is needed to translate or detect the language of captions.")
+    return GoogleTranslateBackend(google_api_key_path)
 
-if (os.path.isfile(srt_path) and srt_path.endswith('.srt') and os.path.isfile(google_api_key_path) and google_api_key_path.endswith('.json')):
+# --stats only needs a backend for the captions the transcription doesn't cover.
+if (os.path.isfile(srt_path) and srt_path.endswith('.srt') and (args.stats or args.translation_server or has_google_api_key)):
     print("Translating captions..")
     if (list(map(bool, [args.en, args.ko_en, args.ja_zh, args.four_languages, args.stats])).count(True) != 1):
         sys.exit("Specify one of available flags. Use --help to see options.")
-    translate_captions(srt_path, google_api_key_path, args)
+    start_trace(os.path.dirname(srt_path), 'translation')
+    translate_captions(srt_path, create_backend, args)
 else:
     sys.exit("Input arguments are not valid, either wrong path or file extension.")
\ No newline at end of file
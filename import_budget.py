@@ -0,0 +1,71 @@
+import os
+import sys
+import argparse
+import subprocess
+
+"""
+Measures how long importing each script module takes in a fresh interpreter and checks it against a budget.
+Also checks that none of the heavy ML modules get loaded by the import, since those are only allowed to be imported
+lazily by the stages that need them.
+"""
+
+HEAVY_MODULES = ['torch', 'torchaudio', 'whisper', 'librosa', 'moviepy', 'ffmpeg', 'df', 'pydub', 'budoux']
+
+# Budget in seconds for the cumulative import time of each module.
+IMPORT_BUDGETS = {
+    'subtitle_core': 0.05,
+    'segment_store': 0.05,
+    'stage_cache': 0.05,
+    'stage_trace': 0.05,
+    'translation_memory': 0.05,
+    'translation_engine': 0.1,
+    'media_info': 0.05,
+    'model_worker': 0.1,
+    'transcription': 0.5,
+    'process_sequence': 1.0,
+    'denoise_audio': 0.1,
+}
+
+def measure_import(module, repeat=3):
+    """
+    Import module in fresh interpreters and return (best cumulative import time in seconds, heavy modules loaded).
+    Raises ImportError if the module or one of its dependencies can't be imported.
+    """
+    code = ("import sys, " + module + "; print(','.join(m for m in " + repr(HEAVY_MODULES) + " if m in sys.modules))")
+    best = None
+    loaded = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        if result.returncode != 0:
+            raise ImportError(result.stderr.strip().splitlines()[-1])
+        loaded = [m for m in result.stdout.strip().split(',') if m]
+        for line in result.stderr.splitlines():
+            # Lines are formatted as "import time: self [us] | cumulative | imported package"
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                cumulative = int(fields[1].strip()) / 1e6
+                best = cumulative if best is None else min(best, cumulative)
+    return best, loaded
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the import time of the script modules against their budgets.')
+    parser.add_argument("modules", nargs='*', help="Modules to check. Checks all budgeted modules if not set.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of measurements per module; the best one is used.")
+    args = parser.parse_args()
+
+    failures = []
+    for module in args.modules or IMPORT_BUDGETS.keys():
+        budget = IMPORT_BUDGETS[module]
+        try:
+            seconds, loaded = measure_import(module, args.repeat)
+        except ImportError as e:
+            print('{0:<20} skipped, cannot be imported here: {1}'.format(module, e))
+            continue
+        ok = seconds <= budget and len(loaded) == 0
+        print('{0:<20} {1:8.1f} ms (budget {2:.0f} ms){3} {4}'.format(
+            module, seconds * 1000, budget * 1000, ' heavy: ' + ','.join(loaded) if loaded else '', 'OK' if ok else 'OVER'))
+        if not ok:
+            failures.append(module)
+    if len(failures) > 0:
+        sys.exit("Import budget exceeded for: " + ", ".join(failures))
@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from stage_trace import count_ffmpeg
+
+"""
+Media metadata (duration, streams) read from container headers with ffprobe, without decoding any media.
+Results are kept in an on-disk index keyed by path, size and mtime, so a file is only probed again once it changes.
+"""
+
+# Location of the index. Can be overridden with the MEDIA_INDEX_PATH environment variable.
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'multilang_to_premiere', 'media_index.json')
+
+# Number of ffprobe processes run at once when probing many files.
+PROBE_WORKERS = 8
+
+def probe_media(path):
+    """
+    Read the headers of the media at path with ffprobe.
+    Returns a dict of the following format: {duration:float, format:string, streams:[{type:string, codec:string, sample_rate:int, channels:int}]}
+    """
+    count_ffmpeg()
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path],
+        capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError("Failed to probe " + path + ": " + result.stderr.decode(errors='replace'))
+    probe = json.loads(result.stdout)
+
+    streams = []
+    stream_duration = 0.0
+    for stream in probe.get('streams', []):
+        streams.append({
+            'type': stream.get('codec_type'),
+            'codec': stream.get('codec_name'),
+            'sample_rate': int(stream['sample_rate']) if 'sample_rate' in stream else None,
+            'channels': stream.get('channels'),
+        })
+        stream_duration = max(stream_duration, float(stream.get('duration', 0.0)))
+    # Some containers only report durations on their streams.
+    duration = float(probe.get('format', {}).get('duration', stream_duration))
+    return {'duration': duration, 'format': probe.get('format', {}).get('format_name'), 'streams': streams}
+
+class MediaIndex:
+    """
+    On-disk index of probe_media results.
+    """
+    def __init__(self, index_path=None):
+        self.index_path = index_path or os.environ.get('MEDIA_INDEX_PATH', DEFAULT_INDEX_PATH)
+        self.entries = self._load()
+        self.dirty = False
+        # Errors of the files that failed to probe, by path. They are not indexed, so they are probed again next time.
+        self.errors = {}
+
+    def _load(self):
+        if not os.path.isfile(self.index_path):
+            return {}
+        try:
+            with open(self.index_path, encoding='UTF-8') as index_file:
+                return json.load(index_file)
+        except ValueError:
+            print("Media index " + self.index_path + " is corrupt. Rebuilding it.")
+            return {}
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        # Other processes may have indexed files meanwhile; keep their entries too.
+        entries = self._load()
+        entries.update(self.entries)
+        temp_path = self.index_path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'w+', encoding='UTF-8') as index_file:
+            json.dump(entries, index_file)
+        os.replace(temp_path, self.index_path)
+        self.entries = entries
+        self.dirty = False
+
+    def _lookup(self, path):
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['info'], stat
+        return None, stat
+
+    def _probe(self, path):
+        try:
+            return probe_media(path)
+        except (RuntimeError, ValueError) as e:
+            # One unreadable file must not abort the whole batch.
+            self.errors[path] = str(e)
+            print("Skipping " + path + ", it could not be probed: " + str(e))
+            return None
+
+    def probe_many(self, paths, workers=PROBE_WORKERS):
+        """
+        Return {path: info} for all paths, probing the ones missing from the index in parallel. Files that fail to
+        probe are left out, with their error in errors.
+        """
+        paths = [os.path.abspath(path) for path in paths]
+        infos = {}
+        missing = []
+        for path in paths:
+            info, stat = self._lookup(path)
+            if info is None:
+                missing.append((path, stat))
+            else:
+                infos[path] = info
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for (path, stat), info in zip(missing, pool.map(self._probe, [path for path, _ in missing])):
+                    if info is None:
+                        continue
+                    self.entries[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'info': info}
+                    infos[path] = info
+            self.dirty = True
+            self.save()
+        return infos
+
+    def probe(self, path):
+        path = os.path.abspath(path)
+        infos = self.probe_many([path])
+        if path not in infos:
+            raise RuntimeError(self.errors[path])
+        return infos[path]
+
+def media_durations(paths, workers=PROBE_WORKERS, index=None):
+    """
+    Return {path: duration in seconds} for paths, as absolute paths. Files that fail to probe are left out.
+    """
+    infos = (index or MediaIndex()).probe_many(paths, workers)
+    return {path: info['duration'] for path, info in infos.items()}
+
+def media_duration(path, index=None):
+    return (index or MediaIndex()).probe(path)['duration']
+
+def has_audio_stream(info):
+    return any(stream['type'] == 'audio' for stream in info['streams'])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Print the metadata of media files, probing and indexing them as needed.')
+    parser.add_argument("paths", nargs='+', help="Media files to probe.")
+    parser.add_argument("--workers", type=int, default=PROBE_WORKERS, help="Number of files probed at once.")
+    args = parser.parse_args()
+
+    missing = [path for path in args.paths if not os.path.isfile(path)]
+    if len(missing) > 0:
+        sys.exit("Not a file: " + ", ".join(missing))
+    for path, info in MediaIndex().probe_many(args.paths, args.workers).items():
+        print(path, json.dumps(info, ensure_ascii=False))
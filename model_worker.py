@@ -0,0 +1,198 @@
+import os
+import sys
+import argparse
+import secrets
+import traceback
+from argparse import Namespace
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+"""
+Long-lived local worker that keeps the Silero VAD and whisper models loaded between runs of transcription.py.
+
+Start it once with `python model_worker.py`. While it is running, transcription.py sends its jobs to it over a local
+socket instead of loading the models itself, and falls back to loading them in-process when no worker is listening.
+This module is imported by the transcription.py client, so it must not import torch or whisper at module level.
+"""
+
+WORKER_HOST = 'localhost'
+WORKER_PORT = int(os.environ.get('TRANSCRIPTION_WORKER_PORT', 6010))
+
+# File holding the random key a client must know to send jobs to the worker. Jobs are unpickled by the worker, so the
+# key is created on first use, readable by the current user only. Can be overridden with the
+# TRANSCRIPTION_WORKER_AUTHKEY_PATH environment variable, or the key itself with TRANSCRIPTION_WORKER_AUTHKEY.
+DEFAULT_WORKER_AUTHKEY_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'multilang_to_premiere', 'worker_authkey')
+
+def worker_authkey():
+    """
+    Return the key shared by the worker and its clients, creating the key file if there is none yet.
+    """
+    if os.environ.get('TRANSCRIPTION_WORKER_AUTHKEY'):
+        return os.environ['TRANSCRIPTION_WORKER_AUTHKEY'].encode('utf-8')
+    path = os.environ.get('TRANSCRIPTION_WORKER_AUTHKEY_PATH', DEFAULT_WORKER_AUTHKEY_PATH)
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Written to a temporary file and linked in place, so that a worker and a client starting at the same time
+        # never read a partly written key, and agree on the first key linked.
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        descriptor = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(descriptor, 'wb') as key_file:
+            key_file.write(secrets.token_hex(32).encode('utf-8'))
+        try:
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp_path)
+    with open(path, 'rb') as key_file:
+        return key_file.read().strip()
+
+def connect_to_worker(port=WORKER_PORT):
+    """
+    Return a connection to a running worker, or None if no worker is listening.
+    """
+    try:
+        return Client((WORKER_HOST, port), authkey=worker_authkey())
+    except AuthenticationError:
+        print("A model worker is listening on port " + str(port) + " but rejected the key of this user.")
+        return None
+    except (ConnectionRefusedError, OSError):
+        return None
+
+def run_on_worker(args, port=WORKER_PORT):
+    """
+    Send the jobs described by the parsed transcription.py args to a running worker.
+    Returns False without doing anything if no worker is running, so that the caller can process in-process instead.
+    """
+    connection = connect_to_worker(port)
+    if connection is None:
+        return False
+    print("Sending jobs to the model worker on port " + str(port) + ".")
+    jobs = []
+    if args.footage_dir:
+        jobs.append({'command': 'walk_footage_dir', 'footage_dir': os.path.abspath(args.footage_dir), 'args': vars(args)})
+    if args.test_single_file:
+        jobs.append({'command': 'process_file', 'file': os.path.abspath(args.test_single_file), 'out_basedir': os.path.abspath('./out'), 'args': vars(args)})
+    with connection:
+        for job in jobs:
+            connection.send(job)
+            response = connection.recv()
+            if response['status'] != 'ok':
+                sys.exit("Model worker failed processing the job:\n" + response['message'])
+            print(response['message'])
+    return True
+
+class LoadedModels:
+    """
+    Models kept loaded by the worker. Whisper models are loaded on first use of each model type, and so are the shard
+    pools of each model type and shard configuration, and the VAD worker pools of each number of VAD workers.
+    """
+    def __init__(self):
+        import torch
+        import transcription
+        self.transcription = transcription
+        # create_vad_model makes torch single threaded for Silero, which would also slow down every whisper model
+        # loaded after it.
+        threads = torch.get_num_threads()
+        self.vad_model, self.get_speech_timestamps = transcription.create_vad_model()
+        torch.set_num_threads(threads)
+        self.whisper_models = {}
+        self.shard_pools = {}
+        self.vad_pools = {}
+
+    def whisper_model(self, model_type, quantize=False):
+        if (model_type, quantize) not in self.whisper_models:
+            self.whisper_models[(model_type, quantize)] = self.transcription.load_whisper_model(model_type, quantize)
+        return self.whisper_models[(model_type, quantize)]
+
+    def shard_pool(self, job_args):
+        if job_args.shards <= 1:
+            return None
+        pool_key = (job_args.model, job_args.shards, job_args.shard_threads, job_args.quantize)
+        if pool_key not in self.shard_pools:
+            self.shard_pools[pool_key] = self.transcription.create_shard_pool(job_args)
+        return self.shard_pools[pool_key]
+
+    def vad_pool(self, job_args):
+        """
+        VAD worker processes of walk_footage_dir jobs, kept so that Silero is loaded in them once.
+        """
+        if job_args.vad_workers not in self.vad_pools:
+            self.vad_pools[job_args.vad_workers] = self.transcription.create_vad_pool(job_args)
+        return self.vad_pools[job_args.vad_workers]
+
+    def close(self):
+        for shard_pool in self.shard_pools.values():
+            shard_pool.close()
+        for vad_pool in self.vad_pools.values():
+            vad_pool.shutdown()
+
+def handle_job(models, job):
+    transcription = models.transcription
+    job_args = Namespace(**job['args'])
+    shard_pool = models.shard_pool(job_args)
+    # With shards, the model is only loaded by them.
+    whisper_model = models.whisper_model(job_args.model, job_args.quantize) if shard_pool is None else None
+    feature_cache = transcription.EncoderFeatureCache(job_args.encoder_cache_size)
+    try:
+        if job['command'] == 'process_file':
+            transcription.start_run_trace(job['out_basedir'], job_args)
+            transcription.process_file(job['file'], job['out_basedir'], models.vad_model, models.get_speech_timestamps, whisper_model, job_args, feature_cache=feature_cache, shard_pool=shard_pool)
+            return "Processed " + job['file'] + ". " + feature_cache.report()
+        if job['command'] == 'walk_footage_dir':
+            transcription.start_run_trace(job['footage_dir'], job_args)
+            transcription.walk_footage_dir(job['footage_dir'], job_args, whisper_model=whisper_model, feature_cache=feature_cache, shard_pool=shard_pool,
+                                         vad_pool=models.vad_pool(job_args))
+            return "Processed " + job['footage_dir'] + ". " + feature_cache.report()
+        raise ValueError("Unknown command " + str(job['command']))
+    finally:
+        transcription.stop_trace()
+
+def serve(port=WORKER_PORT, preload_model=None, preload_quantized=False):
+    models = LoadedModels()
+    if preload_model:
+        models.whisper_model(preload_model, preload_quantized)
+    try:
+        with Listener((WORKER_HOST, port), authkey=worker_authkey()) as listener:
+            print("Model worker listening on port " + str(port) + ".")
+            while True:
+                try:
+                    connection = listener.accept()
+                except (AuthenticationError, EOFError, ConnectionError) as e:
+                    # A client without the key, or one that hung up during the handshake, must not stop the worker.
+                    print("Rejected a connection: " + str(e))
+                    continue
+                with connection:
+                    while True:
+                        try:
+                            job = connection.recv()
+                        except EOFError:
+                            break
+                        if job['command'] == 'shutdown':
+                            connection.send({'status': 'ok', 'message': "Model worker shutting down."})
+                            return
+                        try:
+                            connection.send({'status': 'ok', 'message': handle_job(models, job)})
+                        except Exception:
+                            traceback.print_exc()
+                            connection.send({'status': 'error', 'message': traceback.format_exc()})
+    finally:
+        models.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Keep the transcription models loaded and process jobs sent by transcription.py.')
+    parser.add_argument("--port", type=int, default=WORKER_PORT, help="Local port to listen on.")
+    parser.add_argument("--preload_model", default='medium', help="Whisper model to load at startup. Other models are loaded on first use.")
+    parser.add_argument("--preload_quantized", action='store_true', help="Load the int8 quantized version of the preloaded model.")
+    parser.add_argument("--shutdown", action='store_true', help="Stop a running worker.")
+    args = parser.parse_args()
+
+    if args.shutdown:
+        connection = connect_to_worker(args.port)
+        if connection is None:
+            sys.exit("No model worker is running on port " + str(args.port) + ".")
+        with connection:
+            connection.send({'command': 'shutdown'})
+            print(connection.recv()['message'])
+    else:
+        serve(args.port, args.preload_model, args.preload_quantized)
@@ -1,34 +1,33 @@
 import os
 import sys
-import json
 import argparse
-import pysrt
 import pymiere
-import budoux
-from datetime import timedelta
 from pymiere.wrappers import time_from_seconds
-from transcription import transcriptions_to_srt
+from subtitle_core import transcriptions_to_srt, read_segments, write_segments, find_segments, IntervalIndex, read_srt, SEGMENT_EXTENSION
+from stage_trace import trace_stage, start_trace
 
 MAX_LETTERS_IN_VERTICAL_LINE = 19
 
 
-def add_transcription_to_captions(trackItem, clip_begin_time_in_track, transcription_path, captions):
-    transcribe_segments = [json.loads(f) for f in open(transcription_path, encoding='utf-8').readlines()]
-    for segment in transcribe_segments:
-        # Filter out segments that fall outside the inPoint-outPoint range of this trackItem.
-        if (segment['end'] < trackItem.inPoint.seconds):
-            continue
-        elif (segment['start'] > trackItem.outPoint.seconds):
-            break
-        
-        segment['text'] = segment['text'].strip()
+def add_transcription_to_captions(trackItem, clip_begin_time_in_track, transcription_index, captions):
+    """
+    Add the segments of transcription_index, the IntervalIndex of the clip media transcription, that fall in trackItem
+    to captions, in sequence time, keeping their detected language.
+    """
+    # Every property read on a track item is a round trip to Premiere, so the clip bounds are read once.
+    in_point = trackItem.inPoint.seconds
+    out_point = trackItem.outPoint.seconds
+    duration = trackItem.duration.seconds
+    # Only segments inside the inPoint-outPoint range of this trackItem.
+    for segment in transcription_index.overlapping(in_point, out_point):
+        text = segment['text'].strip()
         # This is totally a hack, but Whisper 'hallucinates' so much false instances of Thanks for watching! that
         # if we run into one, it's guaranteed to be a wrong transcription. Besides it belongs only in an end of the video anyway.
-        if (segment['text'] == 'Thanks for watching!'):
+        if (text == 'Thanks for watching!'):
             continue
-        start_in_sequence = clip_begin_time_in_track + max(0.0, segment['start'] - trackItem.inPoint.seconds)
-        end_in_sequence =  clip_begin_time_in_track + min(trackItem.duration.seconds, segment['end'] - trackItem.inPoint.seconds)
-        captions.append({'start': start_in_sequence, 'end': end_in_sequence, 'text': segment['text']})
+        start_in_sequence = clip_begin_time_in_track + max(0.0, segment['start'] - in_point)
+        end_in_sequence =  clip_begin_time_in_track + min(duration, segment['end'] - in_point)
+        captions.append({'start': start_in_sequence, 'end': end_in_sequence, 'text': text, 'lang': segment['lang']})
 
 def transcribe_sequence(sequence, reprocess=False):
     srt_outpath = os.path.join(footage_dir, sequence.name, sequence.name + '_multilang_captions.srt')
@@ -45,6 +44,8 @@ def transcribe_sequence(sequence, reprocess=False):
     print("Transcribing sequence " + sequence.name + "...")
     pymiere.objects.app.project.openSequence(sequenceID=sequence.sequenceID)
     captions = []
+    # Indices of the transcriptions read so far by path. Many clips of a sequence are usually cut from the same media.
+    transcriptions = {}
     
     # Current position of this clip in this track. Increment after each clip.
     clip_begin_time_in_track = 0.0
@@ -54,19 +55,22 @@ def transcribe_sequence(sequence, reprocess=False):
             print("Skipping {sequence.name} because path to the clip in track is not a valid path. path: " + mediapath)
             continue
         # In the same directory as mediapath, look for a transcription file.
-        parent_dir = os.path.dirname(mediapath)
-        transcription_file_name = os.path.basename(mediapath).split('.')[0] + "_transcription.txt"
-        transcription_path = ""
-        for file in [f.path for f in os.scandir(parent_dir)]:
-            if (os.path.basename(file) == transcription_file_name):
-                transcription_path = file
-                # Transcription for this clip was found.
-                add_transcription_to_captions(clip, clip_begin_time_in_track, transcription_path, captions)
-                break
+        transcription_path = find_segments(os.path.join(os.path.dirname(mediapath), os.path.basename(mediapath).split('.')[0] + "_transcription.seg"))
+        if transcription_path is not None:
+            # Transcription for this clip was found.
+            if transcription_path not in transcriptions:
+                transcriptions[transcription_path] = IntervalIndex(read_segments(transcription_path))
+            add_transcription_to_captions(clip, clip_begin_time_in_track, transcriptions[transcription_path], captions)
         clip_begin_time_in_track += clip.duration.seconds
     transcriptions_to_srt(srt_outpath, captions)
+    # The segments behind the captions, in sequence time. generate_translated_captions.py --stats reads the language
+    # of each caption from them instead of detecting it again.
+    write_segments(os.path.splitext(srt_outpath)[0] + '_segments' + SEGMENT_EXTENSION, captions)
 
 def line_break_vertical_text(original_text, lang):
+    # budoux is only needed for vertical text, so it is imported only once it is used.
+    import budoux
+
     # For japanese and chinese, insert natural line breaks.
     if (lang == 'ja'):
         parsed_text = budoux.load_default_japanese_parser().parse(original_text)
@@ -102,19 +106,19 @@ def add_text_graphic_to_sequence(sequence, footage_dir, captions_dir, mogrt_path
         if not os.path.isfile(srt_path):
             print("Skip processing language " + lang + "; can't find the caption file. It should be in the format of ($SEQUENCENAME)_multilang_edited_($lang).srt")
             continue 
-        captions[lang] = pysrt.open(srt_path)
+        captions[lang] = read_srt(srt_path)
         print(lang, "length is ", len(captions[lang]))
     if not all(len(captions[lang]) == len(captions[languages[0]]) for lang in languages):
         sys.exit("The length of captions in all languages must be equal. aborting.")
     for i in range(len(captions[languages[0]])):
-        default_caption = captions[languages[0]][i]
-        caption_start_time = default_caption.start.minutes * 60 + default_caption.start.seconds + 0.001 * default_caption.start.milliseconds
+        default_captions = captions[languages[0]]
+        caption_start_time = default_captions.start_seconds(i)
         mgt_clip = sequence.importMGT(  
                 path=mogrt_path,  
                 time=time_from_seconds(caption_start_time),  # start time  
                 videoTrackIndex=len(sequence.videoTracks) - 1, audioTrackIndex=1  # Place this caption on a new track
             )
-        mgt_clip.end = time_from_seconds(default_caption.end.minutes * 60 + default_caption.end.seconds + 0.001 * default_caption.end.milliseconds)
+        mgt_clip.end = time_from_seconds(default_captions.end_seconds(i))
         # get component hosting modifiable template properties  
         mgt_component = mgt_clip.getMGTComponent()  
         # handle two possible types for mgt
@@ -128,7 +132,7 @@ def add_text_graphic_to_sequence(sequence, footage_dir, captions_dir, mogrt_path
             for prop in component.properties:
                 # Each property in MGT must be named with the langauge codes matching elements in the array languages.
                 for lang in languages:
-                    text = captions[lang][i].text
+                    text = captions[lang].texts[i]
                     
                     # For japanese, insert natural line breaks.
                     # TODO(jiheeh): Chinese line breaks are difficult now due to after effects limited support of vertical text.
@@ -216,9 +220,11 @@ if __name__ == "__main__":
         if premiere_project_path == "":
             sys.exit("Cannot find a premiere project to open.")
 
+    start_trace(footage_dir, 'premiere')
     print("Opening project " + premiere_project_path)
     project = pymiere.objects.app.project
-    pymiere.objects.app.openDocument(premiere_project_path)
+    with trace_stage('premiere_open_project', project=premiere_project_path):
+        pymiere.objects.app.openDocument(premiere_project_path)
 
     if args.sequence_name:
         sequences_with_subfolder_name = [s for s in pymiere.objects.app.project.sequences if s.name == args.sequence_name]
@@ -229,17 +235,22 @@ if __name__ == "__main__":
 
         sequence = sequences_with_subfolder_name[0]
         if (args.transcribe):
-            transcribe_sequence(sequence, reprocess=args.reprocess)  
+            with trace_stage('premiere_transcribe_sequence', sequence=sequence.name):
+                transcribe_sequence(sequence, reprocess=args.reprocess)  
         if (args.add_denoised_audio_dir):
-            add_denoised_audio_to_sequence(args.add_denoised_audio_dir, sequence)
+            with trace_stage('premiere_add_denoised_audio', sequence=sequence.name):
+                add_denoised_audio_to_sequence(args.add_denoised_audio_dir, sequence)
         if (args.add_graphics_with_mogrt):
             if not os.path.isfile(os.path.abspath(args.add_graphics_with_mogrt)):
                 sys.exit("Motion graphics template file path is invalid.")
-            add_text_graphic_to_sequence(sequence, footage_dir, args.captions_dir, args.add_graphics_with_mogrt)
+            with trace_stage('premiere_add_text_graphics', sequence=sequence.name):
+                add_text_graphic_to_sequence(sequence, footage_dir, args.captions_dir, args.add_graphics_with_mogrt)
     else:
         # open each sequence and run process_sequence.
         for sequence in pymiere.objects.app.project.sequences:
             if (args.transcribe):
-                transcribe_sequence(sequence, reprocess=args.reprocess)
+                with trace_stage('premiere_transcribe_sequence', sequence=sequence.name):
+                    transcribe_sequence(sequence, reprocess=args.reprocess)
             if (args.add_denoised_audio_dir):
-                add_denoised_audio_to_sequence(args.add_denoised_audio_dir, sequence)
\ No newline at end of file
+                with trace_stage('premiere_add_denoised_audio', sequence=sequence.name):
+                    add_denoised_audio_to_sequence(args.add_denoised_audio_dir, sequence)
\ No newline at end of file
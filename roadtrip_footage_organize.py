@@ -6,7 +6,7 @@ from shutil import move
 import pymiere
 from pymiere.wrappers import get_system_sequence_presets
 from pymiere.wrappers import time_from_seconds
-from moviepy.editor import VideoFileClip
+from media_info import media_durations
 from datetime import timedelta
 
 
@@ -16,15 +16,17 @@ def get_non_hidden_files_except_current_file(root_dir):
 
 def calculate_footage_duration(footage_dir):
     subfolders = [f.path for f in os.scandir(footage_dir) if f.is_dir()]
+    footages_in_subfolders = {subfolder: [os.path.abspath(os.path.join(subfolder, f))
+                                          for f in os.listdir(subfolder) if f.endswith('.mp4')] for subfolder in subfolders}
+    # Probe the headers of all footages at once, in parallel.
+    durations = media_durations([footage_path for footages in footages_in_subfolders.values() for footage_path in footages])
     lines = []
     total_duration = 0
     for subfolder in subfolders:
         subfolder_duration = 0
-        footages = [os.path.join(subfolder, f)
-                    for f in os.listdir(subfolder) if f.endswith('.mp4')]
-        for footage_path in footages:
-            clip = VideoFileClip(footage_path)
-            subfolder_duration += clip.duration
+        for footage_path in footages_in_subfolders[subfolder]:
+            # Footages that failed to probe are left out of the totals.
+            subfolder_duration += durations.get(footage_path, 0)
         sd = str(timedelta(seconds=subfolder_duration)).split(':')
 
         lines.append("Footage duration of " + os.path.basename(subfolder) + " is " +
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+
+"""
+Compact columnar binary format for the segment intermediates (VAD, language detection and transcription).
+
+A segment file holds rows of identical keys. Numeric keys are stored as float64 columns, 'lang' as a uint8 column of
+indices into a language table, and 'text' as uint64 offsets into a single utf-8 blob, so a file is read by mapping it
+into memory instead of parsing one json line per segment. Layout, all little endian:
+
+    magic b'MLSG' | version u16 | reserved u16 | header length u32 | json header, padded to 8 bytes
+    float64 column per numeric key | uint8 lang column, padded to 8 bytes | uint64 text offsets (count + 1) | text blob
+
+The json header is {count:int, fields:[string], floats:[string], languages:[string]}, fields keeping the key order of
+the rows. Only uses the standard library, like subtitle_core which reads and writes through it.
+"""
+
+MAGIC = b'MLSG'
+VERSION = 1
+PREAMBLE = struct.Struct('<4sHHI')
+
+def _padding(length):
+    return (8 - length % 8) % 8
+
+def write_segment_store(path, segments):
+    """
+    Write segments, a list of dicts with the same keys, to path. Keys other than 'lang' and 'text' must be numbers.
+    """
+    fields = list(segments[0].keys()) if len(segments) > 0 else []
+    floats = [field for field in fields if field not in ('lang', 'text')]
+    for segment in segments:
+        if list(segment.keys()) != fields:
+            raise ValueError("All segments must have the same keys, " + str(fields) + " != " + str(list(segment.keys())))
+    languages = sorted(set(segment['lang'] for segment in segments)) if 'lang' in fields else []
+    if len(languages) > 255:
+        raise ValueError("At most 255 languages are supported in a segment file.")
+
+    header = json.dumps({'count': len(segments), 'fields': fields, 'floats': floats, 'languages': languages}).encode('utf-8')
+    header += b' ' * _padding(PREAMBLE.size + len(header))
+    # Write to a temporary file first so that an interrupted write never leaves a corrupt segment file behind.
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as segment_file:
+        segment_file.write(PREAMBLE.pack(MAGIC, VERSION, 0, len(header)))
+        segment_file.write(header)
+        for field in floats:
+            segment_file.write(struct.pack('<' + str(len(segments)) + 'd', *(float(segment[field]) for segment in segments)))
+        if 'lang' in fields:
+            language_indices = {language: i for i, language in enumerate(languages)}
+            segment_file.write(bytes(language_indices[segment['lang']] for segment in segments))
+            segment_file.write(b'\0' * _padding(len(segments)))
+        if 'text' in fields:
+            texts = [segment['text'].encode('utf-8') for segment in segments]
+            offsets = [0]
+            for text in texts:
+                offsets.append(offsets[-1] + len(text))
+            segment_file.write(struct.pack('<' + str(len(offsets)) + 'Q', *offsets))
+            segment_file.write(b''.join(texts))
+    os.replace(temp_path, path)
+
+class SegmentStore:
+    """
+    Memory mapped segment file. Columns are exposed as memoryviews without copying, rows are built on access.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as segment_file:
+            # Empty files can't be mapped, but a valid segment file is never empty.
+            self._buffer = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, header_length = PREAMBLE.unpack_from(self._buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(path + " is not a version " + str(VERSION) + " segment file.")
+        header = json.loads(bytes(self._buffer[PREAMBLE.size:PREAMBLE.size + header_length]))
+        self.count = header['count']
+        self.fields = header['fields']
+        self.languages = header['languages']
+
+        view = memoryview(self._buffer)
+        offset = PREAMBLE.size + header_length
+        self.columns = {}
+        for field in header['floats']:
+            self.columns[field] = view[offset:offset + 8 * self.count].cast('d')
+            offset += 8 * self.count
+        self._lang = None
+        if 'lang' in self.fields:
+            self._lang = view[offset:offset + self.count]
+            offset += self.count + _padding(self.count)
+        self._text_offsets = None
+        if 'text' in self.fields:
+            self._text_offsets = view[offset:offset + 8 * (self.count + 1)].cast('Q')
+            offset += 8 * (self.count + 1)
+            self._text = view[offset:]
+
+    def close(self):
+        # Views of the map must be released before it can be closed.
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        if getattr(self, '_lang', None) is not None:
+            self._lang.release()
+        if getattr(self, '_text_offsets', None) is not None:
+            self._text_offsets.release()
+            self._text.release()
+        self._buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def lang(self, i):
+        return self.languages[self._lang[i]]
+
+    def text(self, i):
+        return bytes(self._text[self._text_offsets[i]:self._text_offsets[i + 1]]).decode('utf-8')
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("segment index out of range")
+        segment = {}
+        for field in self.fields:
+            if field == 'lang':
+                segment[field] = self.lang(i)
+            elif field == 'text':
+                segment[field] = self.text(i)
+            else:
+                segment[field] = self.columns[field][i]
+        return segment
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+def read_segment_store(path):
+    """
+    Read all segments of the segment file at path as a list of dicts.
+    """
+    with SegmentStore(path) as store:
+        return list(store)
+
+def is_segment_store(path):
+    with open(path, 'rb') as segment_file:
+        return segment_file.read(len(MAGIC)) == MAGIC
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert segment files between the binary format and json lines.')
+    parser.add_argument("command", choices=['export', 'import'],
+                        help="export: print a segment file as json lines, or write them to --out. import: convert a json lines file to a segment file at --out.")
+    parser.add_argument("path", help="File to convert.")
+    parser.add_argument("--out", help="Output path. export prints to stdout if not set.")
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        segments = read_segment_store(args.path)
+        out_file = open(args.out, 'w+', encoding='UTF-8') if args.out else sys.stdout
+        for segment in segments:
+            out_file.write(json.dumps(segment, ensure_ascii=False) + '\n')
+        if args.out:
+            out_file.close()
+    else:
+        if not args.out:
+            sys.exit("import requires --out.")
+        with open(args.path, encoding='UTF-8') as jsonl_file:
+            write_segment_store(args.out, [json.loads(line) for line in jsonl_file if line.strip()])
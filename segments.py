@@ -0,0 +1,120 @@
+import numpy as np
+
+"""
+Vectorized segment algebra. A SegmentSet keeps the starts and ends of its segments in two float64 arrays, so that
+scaling, shifting, clipping, padding, merging, intersecting and de-overlapping run as a few NumPy operations instead of
+a loop over segment dicts, also for VAD outputs of hundreds of thousands of segments.
+"""
+
+class SegmentSet:
+    """
+    Segments as [start, end] pairs in seconds, or in samples before scale. Operations return a new SegmentSet.
+    merge_within, intersect and deoverlap expect the segments sorted by start; use sort() first if they may not be.
+    """
+    def __init__(self, starts=(), ends=()):
+        self.starts = np.asarray(starts, dtype=np.float64)
+        self.ends = np.asarray(ends, dtype=np.float64)
+        if self.starts.shape != self.ends.shape:
+            raise ValueError("starts and ends must have the same length, " + str(len(self.starts)) + " != " + str(len(self.ends)))
+
+    @classmethod
+    def from_dicts(cls, segments):
+        """
+        From dicts with start and end keys, such as the output of Silero's get_speech_timestamps or a VAD segment file.
+        """
+        starts = np.fromiter((segment['start'] for segment in segments), dtype=np.float64, count=len(segments))
+        ends = np.fromiter((segment['end'] for segment in segments), dtype=np.float64, count=len(segments))
+        return cls(starts, ends)
+
+    @classmethod
+    def concatenate(cls, segment_sets):
+        segment_sets = list(segment_sets)
+        if len(segment_sets) == 0:
+            return cls()
+        return cls(np.concatenate([segment_set.starts for segment_set in segment_sets]), np.concatenate([segment_set.ends for segment_set in segment_sets]))
+
+    def to_dicts(self):
+        return [{'start': start, 'end': end} for start, end in zip(self.starts.tolist(), self.ends.tolist())]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return zip(self.starts.tolist(), self.ends.tolist())
+
+    def durations(self):
+        return self.ends - self.starts
+
+    def sort(self):
+        order = np.argsort(self.starts, kind='stable')
+        return SegmentSet(self.starts[order], self.ends[order])
+
+    def scale(self, factor):
+        return SegmentSet(self.starts * factor, self.ends * factor)
+
+    def shift(self, seconds):
+        return SegmentSet(self.starts + seconds, self.ends + seconds)
+
+    def clip(self, lower=None, upper=None):
+        """
+        Trim segments to lower..upper, dropping the ones entirely outside of it.
+        """
+        starts = self.starts if lower is None else np.maximum(self.starts, lower)
+        ends = self.ends if upper is None else np.minimum(self.ends, upper)
+        keep = starts <= ends
+        if lower is not None:
+            keep &= self.ends >= lower
+        if upper is not None:
+            keep &= self.starts <= upper
+        return SegmentSet(starts[keep], ends[keep])
+
+    def pad(self, seconds, lower=None, upper=None):
+        """
+        Extend each segment by seconds on both sides, without going past lower or upper.
+        """
+        starts = self.starts - seconds
+        ends = self.ends + seconds
+        if lower is not None:
+            starts = np.maximum(starts, lower)
+        if upper is not None:
+            ends = np.minimum(ends, upper)
+        return SegmentSet(starts, ends)
+
+    def merge_within(self, gap):
+        """
+        Merge consecutive segments that are less than gap apart, or overlap.
+        """
+        if len(self) == 0:
+            return self
+        # A segment starts a new group when it begins at least gap after every segment before it has ended.
+        reach = np.maximum.accumulate(self.ends)
+        group_starts = np.flatnonzero(np.concatenate(([True], self.starts[1:] - reach[:-1] >= gap)))
+        return SegmentSet(self.starts[group_starts], np.maximum.reduceat(self.ends, group_starts))
+
+    def intersect(self, other):
+        """
+        Segments covered by both self and other. Both sets must be sorted and free of overlaps, see merge_within(0).
+        """
+        # Range of segments of other overlapping each segment of self.
+        first = np.searchsorted(other.ends, self.starts, side='right')
+        last = np.searchsorted(other.starts, self.ends, side='left')
+        counts = np.maximum(last - first, 0)
+        own = np.repeat(np.arange(len(self)), counts)
+        # Index into other of each pair, counting up from first within each segment of self.
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        theirs = np.repeat(first, counts) + offsets
+        starts = np.maximum(self.starts[own], other.starts[theirs])
+        ends = np.minimum(self.ends[own], other.ends[theirs])
+        keep = starts < ends
+        return SegmentSet(starts[keep], ends[keep])
+
+    def deoverlap(self, margin=0.0):
+        """
+        End every segment that reaches the start of the next one margin before that start.
+        """
+        if len(self) < 2:
+            return self
+        ends = self.ends.copy()
+        overlapping = ends[:-1] >= self.starts[1:]
+        ends[:-1][overlapping] = self.starts[1:][overlapping] - margin
+        return SegmentSet(self.starts, ends)
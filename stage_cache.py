@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+
+"""
+Content addressed cache for the intermediate outputs of transcription.py.
+
+Each footage gets a manifest next to its outputs. For every stage the manifest records a key computed from a
+fingerprint of the audio content, the parameters of the stage (model, thresholds, window sizes...) and the keys of
+the stages it consumes. A stage only needs to run again when its key changes, and since the key of a stage includes
+the keys of its upstream stages, rerunning VAD also invalidates detection and transcription.
+"""
+
+FINGERPRINT_BLOCK_SIZE = 1 << 20
+
+def fingerprint_file(path):
+    """
+    Hash the content of the file at path.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(FINGERPRINT_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def stage_key(stage, fingerprint, params, upstream_keys=()):
+    description = {'stage': stage, 'audio': fingerprint, 'params': params, 'upstream': list(upstream_keys)}
+    return hashlib.blake2b(json.dumps(description, sort_keys=True).encode('utf-8'), digest_size=16).hexdigest()
+
+class StageManifest:
+    """
+    Manifest of the cached stage outputs of a single footage, stored as json at manifest_path.
+    """
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.manifest = {'sources': {}, 'stages': {}}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, encoding='UTF-8') as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+    def save(self):
+        # Write to a temporary file first so that an interrupted run never leaves a corrupt manifest behind.
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w+', encoding='UTF-8') as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def fingerprint(self, audio_path):
+        """
+        Content fingerprint of audio_path. Hashing is skipped when the size and mtime match the recorded ones.
+        """
+        stat = os.stat(audio_path)
+        source = self.manifest['sources'].get(os.path.abspath(audio_path))
+        if source is not None and source['size'] == stat.st_size and source['mtime'] == stat.st_mtime:
+            return source['fingerprint']
+        fingerprint = fingerprint_file(audio_path)
+        self.manifest['sources'][os.path.abspath(audio_path)] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'fingerprint': fingerprint}
+        self.save()
+        return fingerprint
+
+    def is_derived(self, output_path, source_path):
+        """
+        Whether output_path exists and was derived from source_path as it is now, by the size and mtime of
+        source_path recorded with record_derived. Outputs written before they were recorded are adopted when they
+        are newer than source_path.
+        """
+        if not os.path.isfile(output_path):
+            return False
+        entry = self.manifest.setdefault('derived', {}).get(os.path.basename(output_path))
+        if entry is None:
+            if os.path.getmtime(output_path) < os.path.getmtime(source_path):
+                return False
+            self.record_derived(output_path, source_path)
+            return True
+        stat = os.stat(source_path)
+        return entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime
+
+    def record_derived(self, output_path, source_path):
+        stat = os.stat(source_path)
+        self.manifest.setdefault('derived', {})[os.path.basename(output_path)] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        self.save()
+
+    def recorded_key(self, stage):
+        entry = self.manifest['stages'].get(stage)
+        return entry['key'] if entry else None
+
+    def key(self, stage, audio_path, params, upstream_stages=()):
+        """
+        Key of stage for the current audio content and params, chained to the keys recorded for upstream_stages.
+        """
+        return stage_key(stage, self.fingerprint(audio_path), params, [self.recorded_key(upstream) for upstream in upstream_stages])
+
+    def is_fresh(self, stage, key, outputs):
+        """
+        Whether the outputs of stage exist and were produced from inputs matching key.
+        Outputs written before the cache existed have no record; they are adopted as fresh.
+        """
+        if not all(os.path.isfile(output) for output in outputs):
+            return False
+        entry = self.manifest['stages'].get(stage)
+        if entry is None:
+            print("Adopting existing " + stage + " output into the cache manifest.")
+            self.record(stage, key, outputs)
+            return True
+        return entry['key'] == key
+
+    def record(self, stage, key, outputs):
+        self.manifest['stages'][stage] = {'key': key, 'outputs': [os.path.basename(output) for output in outputs]}
+        self.save()
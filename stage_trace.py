@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+
+"""
+Structured per-stage instrumentation. Each stage wrapped in trace_stage is recorded as one json line with its wall
+time, seconds of audio processed, real-time factor, RSS after the stage and its change over the stage, peak RSS of the
+child and worker processes, and the number of ffmpeg subprocesses and model invocations it caused, in worker
+processes included. Records of a run go to a jsonl trace under <directory>/traces, and
+`python stage_trace.py summarize <footage_dir>` aggregates all traces found under a footage directory.
+
+The trace path is passed through the STAGE_TRACE_PATH environment variable, so that worker processes started by a
+traced run append to the same trace. Jobs of pool workers that run inside a stage of the parent are wrapped in counted,
+and the parent adds the counts they return with add_counts.
+"""
+
+TRACE_PATH_ENV = 'STAGE_TRACE_PATH'
+TRACE_DIR_NAME = 'traces'
+
+COUNTERS = ['ffmpeg_processes', 'model_invocations']
+
+# Counters incremented by the code spawning ffmpeg or calling a model. They are kept per thread, so that stages running
+# concurrently on other threads aren't counted in each other's records.
+_local = threading.local()
+
+def _counters():
+    if not hasattr(_local, 'counters'):
+        _local.counters = dict.fromkeys(COUNTERS, 0)
+    return _local.counters
+
+def start_trace(directory, run_name):
+    """
+    Start tracing to a new jsonl file under directory/traces and return its path.
+    """
+    trace_dir = os.path.join(directory, TRACE_DIR_NAME)
+    os.makedirs(trace_dir, exist_ok=True)
+    trace_path = os.path.join(trace_dir, run_name + '_' + time.strftime('%Y%m%d-%H%M%S') + '_' + str(os.getpid()) + '.jsonl')
+    os.environ[TRACE_PATH_ENV] = trace_path
+    print("Tracing stages to " + trace_path)
+    return trace_path
+
+def stop_trace():
+    os.environ.pop(TRACE_PATH_ENV, None)
+
+def current_trace():
+    return os.environ.get(TRACE_PATH_ENV)
+
+def use_trace(trace_path):
+    """
+    Trace to trace_path, or nowhere if it is None. For worker processes that outlive the run they were started by, whose
+    environment still has the trace of that run.
+    """
+    if trace_path:
+        os.environ[TRACE_PATH_ENV] = trace_path
+    else:
+        stop_trace()
+
+def count_ffmpeg(count=1):
+    _counters()['ffmpeg_processes'] += count
+
+def count_model_invocation(count=1):
+    _counters()['model_invocations'] += count
+
+def counted(function, *args, **kwargs):
+    """
+    Run function and return (its result, counts), counts being what it added to the counters and the peak RSS of this
+    process. Wraps the jobs of worker processes, whose counters would otherwise never reach the parent's records.
+    """
+    counters_before = dict(_counters())
+    result = function(*args, **kwargs)
+    counts = {counter: _counters()[counter] - counters_before[counter] for counter in COUNTERS}
+    counts['peak_rss_mb'] = _max_rss_mb('RUSAGE_SELF')
+    return result, counts
+
+def add_counts(counts):
+    """
+    Add the counts returned by a worker's counted job to the current stages of this thread.
+    """
+    for counter in COUNTERS:
+        _counters()[counter] += counts[counter]
+    if counts['peak_rss_mb'] is not None:
+        _local.workers_peak_rss_mb = max(getattr(_local, 'workers_peak_rss_mb', None) or 0.0, counts['peak_rss_mb'])
+
+def rss_mb():
+    """
+    Current resident set size of this process, or None where it can't be read.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+def _max_rss_mb(who):
+    """
+    Peak resident set size of this process (RUSAGE_SELF) or of its largest waited for child (RUSAGE_CHILDREN), or None
+    where it can't be read.
+    """
+    try:
+        import resource
+    except ImportError:
+        # Not available on windows.
+        return None
+    rss = resource.getrusage(getattr(resource, who)).ru_maxrss
+    # Kilobytes on linux, bytes on macOS.
+    return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+@contextmanager
+def trace_stage(stage, audio_seconds=None, **fields):
+    """
+    Record the stage run inside the with block. Yields the record, so that fields only known inside the block, such
+    as audio_seconds of a file being decoded, can still be set on it.
+    Nothing is written when no trace was started.
+    """
+    record = {'stage': stage, 'audio_seconds': audio_seconds}
+    record.update(fields)
+    counters_before = dict(_counters())
+    # The peak of the workers is only known from the jobs of this stage, so nested stages each start over and report
+    # back the higher of theirs and the enclosing one's.
+    enclosing_workers_peak = getattr(_local, 'workers_peak_rss_mb', None)
+    _local.workers_peak_rss_mb = None
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - start
+        record['rtf'] = record['wall_seconds'] / record['audio_seconds'] if record['audio_seconds'] else None
+        record['rss_mb'] = rss_mb()
+        record['rss_delta_mb'] = record['rss_mb'] - rss_before if record['rss_mb'] is not None and rss_before is not None else None
+        # ffmpeg subprocesses and finished pool workers; pool workers still running report through add_counts.
+        record['children_peak_rss_mb'] = _max_rss_mb('RUSAGE_CHILDREN')
+        record['workers_peak_rss_mb'] = _local.workers_peak_rss_mb
+        if enclosing_workers_peak is not None:
+            _local.workers_peak_rss_mb = max(enclosing_workers_peak, _local.workers_peak_rss_mb or 0.0)
+        for counter in COUNTERS:
+            record[counter] = _counters()[counter] - counters_before[counter]
+        record['pid'] = os.getpid()
+        record['time'] = time.time()
+        trace_path = os.environ.get(TRACE_PATH_ENV)
+        if trace_path:
+            # One short append per record, so records of concurrent worker processes don't interleave.
+            with open(trace_path, 'a', encoding='UTF-8') as trace_file:
+                trace_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def read_traces(directory):
+    records = []
+    for root, dirs, files in os.walk(directory):
+        if os.path.basename(root) != TRACE_DIR_NAME:
+            continue
+        for file in sorted(files):
+            if file.endswith('.jsonl'):
+                with open(os.path.join(root, file), encoding='UTF-8') as trace_file:
+                    records.extend(json.loads(line) for line in trace_file if line.strip())
+    return records
+
+def summarize(records):
+    """
+    Aggregate records per stage into {stage: {runs, wall_seconds, audio_seconds, rtf, rss_mb, rss_delta_mb,
+    children_peak_rss_mb, workers_peak_rss_mb, ffmpeg_processes, model_invocations}}. The memory figures are the
+    highest of the runs.
+    """
+    summary = {}
+    for record in records:
+        stage = summary.setdefault(record['stage'], {'runs': 0, 'wall_seconds': 0.0, 'audio_seconds': 0.0, 'rss_mb': None, 'rss_delta_mb': None,
+                                                     'children_peak_rss_mb': None, 'workers_peak_rss_mb': None,
+                                                     'ffmpeg_processes': 0, 'model_invocations': 0})
+        stage['runs'] += 1
+        stage['wall_seconds'] += record['wall_seconds']
+        stage['audio_seconds'] += record['audio_seconds'] or 0.0
+        stage['ffmpeg_processes'] += record['ffmpeg_processes']
+        stage['model_invocations'] += record['model_invocations']
+        for memory in ['rss_mb', 'rss_delta_mb', 'children_peak_rss_mb', 'workers_peak_rss_mb']:
+            # Traces recorded before these fields existed don't have them.
+            if record.get(memory) is not None:
+                stage[memory] = record[memory] if stage[memory] is None else max(stage[memory], record[memory])
+    for stage in summary.values():
+        stage['rtf'] = stage['wall_seconds'] / stage['audio_seconds'] if stage['audio_seconds'] else None
+    return summary
+
+def _format_mb(mb):
+    return '{0:.0f}'.format(mb) if mb is not None else '-'
+
+def print_summary(summary):
+    print('{0:<28} {1:>6} {2:>11} {3:>11} {4:>8} {5:>10} {6:>10} {7:>12} {8:>8} {9:>10}'.format(
+        'stage', 'runs', 'wall [s]', 'audio [s]', 'rtf', 'rss [MB]', '+rss [MB]', 'workers [MB]', 'ffmpeg', 'model'))
+    for name, stage in sorted(summary.items(), key=lambda item: -item[1]['wall_seconds']):
+        print('{0:<28} {1:>6} {2:>11.1f} {3:>11.1f} {4:>8} {5:>10} {6:>10} {7:>12} {8:>8} {9:>10}'.format(
+            name, stage['runs'], stage['wall_seconds'], stage['audio_seconds'],
+            '{0:.4f}'.format(stage['rtf']) if stage['rtf'] is not None else '-',
+            _format_mb(stage['rss_mb']), _format_mb(stage['rss_delta_mb']),
+            _format_mb(max(stage['children_peak_rss_mb'] or 0.0, stage['workers_peak_rss_mb'] or 0.0) or None),
+            stage['ffmpeg_processes'], stage['model_invocations']))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report on the stage traces recorded under a footage directory.')
+    parser.add_argument("command", choices=['summarize'], help="Report to generate.")
+    parser.add_argument("directory", help="Directory to search for traces recursively.")
+    parser.add_argument("--json", action='store_true', help="Print the summary as json.")
+    args = parser.parse_args()
+
+    records = read_traces(os.path.abspath(args.directory))
+    if len(records) == 0:
+        sys.exit("No traces found under " + args.directory + ".")
+    summary = summarize(records)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
@@ -0,0 +1,204 @@
+import os
+import re
+import json
+from array import array
+from bisect import bisect_left, bisect_right
+from segment_store import read_segment_store, write_segment_store, is_segment_store
+
+"""
+Caption and segment logic shared by the transcription and Premiere scripts: segment file I/O, timestamp math and
+SRT reading and writing. This module must only depend on the standard library, so that Premiere-only operations of
+process_sequence.py can use it without loading torch, whisper or any other ML stack. NumPy is imported lazily by
+transcriptions_to_srt.
+"""
+
+# Segment files are written in the binary format of segment_store.py. Files of the older format of one json dict per
+# line have the LEGACY_SEGMENT_EXTENSION and are still read.
+SEGMENT_EXTENSION = '.seg'
+LEGACY_SEGMENT_EXTENSION = '.txt'
+
+def read_segments(path):
+    """
+    Read a segment file written by write_segments, either binary or of one json dict per line.
+    """
+    if is_segment_store(path):
+        return read_segment_store(path)
+    with open(path, encoding='UTF-8') as segment_file:
+        return [json.loads(line) for line in segment_file if line.strip()]
+
+def write_segments(path, segments):
+    """
+    Write segments in the binary format if path has the SEGMENT_EXTENSION, as one json dict per line otherwise.
+    """
+    if path.endswith(SEGMENT_EXTENSION):
+        write_segment_store(path, segments)
+        return
+    with open(path, "w+", encoding='UTF-8') as segment_file:
+        for segment in segments:
+            segment_file.write(json.dumps(segment, ensure_ascii=False) + '\n')
+
+def find_segments(path):
+    """
+    Return path if it exists, or its legacy json lines version if only that one exists, or None.
+    """
+    if os.path.isfile(path):
+        return path
+    legacy_path = os.path.splitext(path)[0] + LEGACY_SEGMENT_EXTENSION
+    if os.path.isfile(legacy_path):
+        return legacy_path
+    return None
+
+def migrate_legacy_segments(path):
+    """
+    Convert the legacy json lines version of the segment file at path to the binary format if only that one exists, so
+    that outputs of earlier runs are reused.
+    """
+    existing_path = find_segments(path)
+    if existing_path is not None and existing_path != path:
+        print("Converting " + existing_path + " to " + path)
+        write_segment_store(path, read_segments(existing_path))
+
+class IntervalIndex:
+    """
+    Sorted, array backed index of segments with start and end keys, for range queries in the timeline code.
+    Starts are kept sorted along with a running maximum of the ends, so a query bisects both arrays and only visits
+    segments from the first one that can still reach the queried range.
+    """
+    def __init__(self, segments):
+        self.segments = sorted(segments, key=lambda segment: segment['start'])
+        self.starts = [segment['start'] for segment in self.segments]
+        self.max_ends = []
+        max_end = float('-inf')
+        for segment in self.segments:
+            max_end = max(max_end, segment['end'])
+            self.max_ends.append(max_end)
+
+    def __len__(self):
+        return len(self.segments)
+
+    def overlapping(self, start, end):
+        """
+        Segments that end at or after start and begin at or before end, in order of their start.
+        """
+        first = bisect_left(self.max_ends, start)
+        last = bisect_right(self.starts, end)
+        return [segment for segment in self.segments[first:last] if segment['end'] >= start]
+
+def dominant_language(index, start, end):
+    """
+    Language of the segments of index covering most of start..end, or None if no segment with a language overlaps it.
+    """
+    overlaps = {}
+    for segment in index.overlapping(start, end):
+        overlap = min(end, segment['end']) - max(start, segment['start'])
+        # Segments whose window got no language detected don't tell the language of the caption.
+        if overlap > 0 and segment['lang'] is not None:
+            overlaps[segment['lang']] = overlaps.get(segment['lang'], 0.0) + overlap
+    return max(overlaps, key=overlaps.get) if len(overlaps) > 0 else None
+
+def seconds_to_ms(seconds):
+    return int(round(seconds * 1000))
+
+def format_srt_time(milliseconds):
+    """
+    SRT timestamp HH:MM:SS,mmm of integer milliseconds. Hours keep counting past 24.
+    """
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%02d:%02d:%02d,%03d' % (hours, minutes, seconds, milliseconds)
+
+SRT_TIME_LINE = re.compile(r'\s*(\d+):(\d+):(\d+)[,.](\d+)\s*-->\s*(\d+):(\d+):(\d+)[,.](\d+)')
+
+def _srt_time_match_to_ms(match, first_group):
+    hours, minutes, seconds, fraction = match.group(first_group, first_group + 1, first_group + 2, first_group + 3)
+    # Some writers use fewer or more than 3 digits for the fraction.
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int((fraction + '00')[:3])
+
+class SrtCaptions:
+    """
+    Captions of an srt file as compact columns: start and end times as integer milliseconds and the texts as a list.
+    """
+    def __init__(self):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.texts = []
+
+    def __len__(self):
+        return len(self.texts)
+
+    def append(self, start_ms, end_ms, text):
+        self.starts.append(start_ms)
+        self.ends.append(end_ms)
+        self.texts.append(text)
+
+    def start_seconds(self, i):
+        return self.starts[i] / 1000
+
+    def end_seconds(self, i):
+        return self.ends[i] / 1000
+
+def read_srt(path):
+    """
+    Parse the srt file at path into SrtCaptions, reading it line by line. Caption numbers are not kept; captions are
+    numbered by their order when written again.
+    """
+    captions = SrtCaptions()
+    text_lines = None
+    with open(path, encoding='utf-8-sig') as srt_file:
+        for line in srt_file:
+            line = line.rstrip('\r\n')
+            if text_lines is None:
+                # Between captions, only the time line matters; the caption number before it is skipped.
+                match = SRT_TIME_LINE.match(line)
+                if match:
+                    start_ms = _srt_time_match_to_ms(match, 1)
+                    end_ms = _srt_time_match_to_ms(match, 5)
+                    text_lines = []
+            elif line.strip() == '':
+                captions.append(start_ms, end_ms, '\n'.join(text_lines))
+                text_lines = None
+            else:
+                text_lines.append(line)
+    if text_lines is not None:
+        captions.append(start_ms, end_ms, '\n'.join(text_lines))
+    return captions
+
+class SrtWriter:
+    """
+    Write captions to an srt file as they are added, numbering them from 1.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.srt_file = open(path, "w+", encoding='UTF-8')
+        self.count = 0
+
+    def write(self, start_ms, end_ms, text):
+        self.count += 1
+        self.srt_file.write(str(self.count) + '\n' + format_srt_time(start_ms) + ' --> ' + format_srt_time(end_ms) + '\n' + text + '\n\n')
+
+    def close(self):
+        self.srt_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def write_srt(path, captions):
+    with SrtWriter(path) as writer:
+        for start_ms, end_ms, text in zip(captions.starts, captions.ends, captions.texts):
+            writer.write(start_ms, end_ms, text)
+
+def transcriptions_to_srt(srt_out_path, transcriptions):
+    # NumPy is only needed here, so it is imported once an srt is written.
+    from segments import SegmentSet
+    # A bit of a hack, but make sure that the end time of each segment is at least 1 milliseconds less than the
+    # beginning of the next segment. Otherwise premiere pro will combine them.
+    times = SegmentSet.from_dicts(transcriptions).deoverlap(0.001)
+    print("Saving srt file of transcription to " + srt_out_path)
+    with SrtWriter(srt_out_path) as writer:
+        for segment, (start, end) in zip(transcriptions, times):
+            text = segment['text']
+            writer.write(seconds_to_ms(start), seconds_to_ms(end), text[1:] if text.startswith(' ') else text)
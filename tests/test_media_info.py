@@ -0,0 +1,27 @@
+import pytest
+
+import media_info
+
+"""
+MediaIndex with probe_media replaced, so that no ffprobe is needed.
+"""
+
+def fake_probe_media(path):
+    if path.endswith('broken.mp4'):
+        raise RuntimeError("Failed to probe " + path + ": moov atom not found")
+    return {'duration': 2.0, 'format': 'mov,mp4,m4a,3gp,3g2,mj2', 'streams': [{'type': 'audio', 'codec': 'aac', 'sample_rate': 48000, 'channels': 2}]}
+
+def test_files_failing_to_probe_are_left_out(monkeypatch, tmp_path):
+    monkeypatch.setattr(media_info, 'probe_media', fake_probe_media)
+    paths = []
+    for name in ['first.mp4', 'broken.mp4', 'second.mp4']:
+        (tmp_path / name).write_bytes(b'footage')
+        paths.append(str(tmp_path / name))
+    index = media_info.MediaIndex(str(tmp_path / 'media_index.json'))
+
+    assert media_info.media_durations(paths, index=index) == {paths[0]: 2.0, paths[2]: 2.0}
+    assert 'moov atom not found' in index.errors[paths[1]]
+    # The failure is not indexed, and probing the file alone raises it.
+    assert paths[1] not in media_info.MediaIndex(index.index_path).entries
+    with pytest.raises(RuntimeError):
+        index.probe(paths[1])
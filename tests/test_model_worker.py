@@ -0,0 +1,68 @@
+import socket
+import threading
+from multiprocessing.connection import Client
+import pytest
+
+import model_worker
+
+"""
+Connection handling of model_worker.py with the models replaced, so that no weights are loaded.
+"""
+
+class FakeModels:
+    closed = False
+
+    def close(self):
+        FakeModels.closed = True
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind((model_worker.WORKER_HOST, 0))
+        return probe.getsockname()[1]
+
+def test_worker_survives_rejected_clients(monkeypatch, tmp_path):
+    monkeypatch.delenv('TRANSCRIPTION_WORKER_AUTHKEY', raising=False)
+    monkeypatch.setenv('TRANSCRIPTION_WORKER_AUTHKEY_PATH', str(tmp_path / 'worker_authkey'))
+    monkeypatch.setattr(model_worker, 'LoadedModels', FakeModels)
+    monkeypatch.setattr(model_worker, 'handle_job', lambda models, job: "Processed " + job['command'] + ".")
+    port = free_port()
+    worker = threading.Thread(target=model_worker.serve, args=(port,), daemon=True)
+    worker.start()
+
+    # A client that hangs up during the handshake, retried until the worker listens, and one with another key.
+    for _ in range(50):
+        try:
+            socket.create_connection((model_worker.WORKER_HOST, port)).close()
+            break
+        except ConnectionRefusedError:
+            worker.join(0.1)
+    with pytest.raises(model_worker.AuthenticationError):
+        Client((model_worker.WORKER_HOST, port), authkey=b'not the key')
+
+    connection = model_worker.connect_to_worker(port)
+    assert connection is not None
+    with connection:
+        connection.send({'command': 'job'})
+        assert connection.recv() == {'status': 'ok', 'message': "Processed job."}
+        connection.send({'command': 'shutdown'})
+        assert connection.recv()['status'] == 'ok'
+    worker.join(5)
+    assert not worker.is_alive() and FakeModels.closed
+    assert (tmp_path / 'worker_authkey').stat().st_mode & 0o077 == 0
+
+def test_loaded_models_keep_the_torch_threads(monkeypatch):
+    torch = pytest.importorskip('torch')
+    import transcription
+
+    def create_vad_model():
+        torch.set_num_threads(1)
+        return 'vad model', 'get_speech_timestamps'
+    monkeypatch.setattr(transcription, 'create_vad_model', create_vad_model)
+    threads = torch.get_num_threads()
+    torch.set_num_threads(2)
+    try:
+        models = model_worker.LoadedModels()
+        assert models.vad_model == 'vad model'
+        assert torch.get_num_threads() == 2
+    finally:
+        torch.set_num_threads(threads)
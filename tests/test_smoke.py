@@ -0,0 +1,44 @@
+import os
+import shutil
+import pytest
+
+"""
+Runs the per-file transcription pipeline end to end with the stub models of benchmark.py, to catch breakage in the
+plumbing between stages without downloading any weights.
+"""
+
+pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('whisper')
+pytest.importorskip('ffmpeg')
+if shutil.which('ffmpeg') is None:
+    pytest.skip("The ffmpeg CLI is needed to decode audio.", allow_module_level=True)
+
+import benchmark
+import transcription
+from subtitle_core import read_segments
+
+OUTPUT_SUFFIXES = ['_manifest.json', '_vad.seg', '_lang_detection.seg', '_transcription.seg', '_transcription.srt']
+
+def run_process_file(audio_path, out_dir, args):
+    transcription.process_file(audio_path, out_dir, benchmark.StubVadModel(), benchmark.stub_get_speech_timestamps,
+                               benchmark.StubWhisperModel(), args)
+
+def test_process_file_with_stub_models(tmp_path):
+    audio_path, _, _ = benchmark.generate_fixture('dense_bilingual', benchmark.FIXTURES['dense_bilingual'], str(tmp_path))
+    out_dir = str(tmp_path / 'out')
+    os.makedirs(out_dir)
+    args = transcription.build_parser().parse_args(['--output_srt'])
+
+    run_process_file(audio_path, out_dir, args)
+    for suffix in OUTPUT_SUFFIXES:
+        assert os.path.isfile(transcription.footage_output_path(audio_path, out_dir, suffix)), suffix
+    transcription_path = transcription.footage_output_path(audio_path, out_dir, '_transcription.seg')
+    transcriptions = read_segments(transcription_path)
+    assert len(read_segments(transcription.footage_output_path(audio_path, out_dir, '_vad.seg'))) > 0
+    assert len(transcriptions) > 0
+    assert set(segment['lang'] for segment in transcriptions) == {'en', 'ko'}
+
+    # A second run finds every stage fresh in the manifest and leaves the outputs as they are.
+    run_process_file(audio_path, out_dir, args)
+    assert read_segments(transcription_path) == transcriptions
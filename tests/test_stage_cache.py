@@ -0,0 +1,24 @@
+import os
+import shutil
+
+from stage_cache import StageManifest
+
+def test_replaced_source_is_not_taken_for_derived(tmp_path):
+    video_path = str(tmp_path / 'clip.mp4')
+    sidecar_path = str(tmp_path / 'clip.mp3')
+    with open(video_path, 'wb') as video_file:
+        video_file.write(b'first video')
+    with open(sidecar_path, 'wb') as sidecar_file:
+        sidecar_file.write(b'audio of the first video')
+    manifest = StageManifest(str(tmp_path / 'clip_manifest.json'))
+    manifest.record_derived(sidecar_path, video_path)
+    assert manifest.is_derived(sidecar_path, video_path)
+
+    # The replacement keeps its older mtime, as a copy preserving times would, so only the recorded size and mtime of
+    # the source tell that the sidecar is stale.
+    replacement_path = str(tmp_path / 'replacement.mp4')
+    with open(replacement_path, 'wb') as replacement_file:
+        replacement_file.write(b'second, longer video')
+    os.utime(replacement_path, (1, 1))
+    shutil.copy2(replacement_path, video_path)
+    assert not StageManifest(str(tmp_path / 'clip_manifest.json')).is_derived(sidecar_path, video_path)
@@ -0,0 +1,30 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+import stage_trace
+
+"""
+Records of stage_trace.py for stages whose work runs in this process and in worker processes.
+"""
+
+def test_stage_records_memory_and_worker_invocations(monkeypatch, tmp_path):
+    trace_path = str(tmp_path / 'trace.jsonl')
+    monkeypatch.setenv(stage_trace.TRACE_PATH_ENV, trace_path)
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        with stage_trace.trace_stage('sharded'):
+            stage_trace.count_model_invocation()
+            for _, counts in pool.map(stage_trace.counted, [stage_trace.count_model_invocation] * 3, [2] * 3):
+                stage_trace.add_counts(counts)
+            held = b'\x01' * (64 * 1024 * 1024)
+        with stage_trace.trace_stage('idle'):
+            pass
+    with open(trace_path, encoding='UTF-8') as trace_file:
+        sharded, idle = [json.loads(line) for line in trace_file]
+
+    assert sharded['model_invocations'] == 7 and idle['model_invocations'] == 0
+    assert sharded['workers_peak_rss_mb'] > 0 and idle['workers_peak_rss_mb'] is None
+    # The change of the current RSS, not the lifetime peak, is reported per stage.
+    assert sharded['rss_delta_mb'] >= 60 and abs(idle['rss_delta_mb']) < 16
+    assert len(held) > 0
+    summary = stage_trace.summarize([sharded, idle])
+    assert summary['sharded']['model_invocations'] == 7 and summary['sharded']['rss_delta_mb'] == sharded['rss_delta_mb']
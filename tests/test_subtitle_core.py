@@ -0,0 +1,13 @@
+from subtitle_core import IntervalIndex, dominant_language
+
+"""
+Caption languages taken from transcription segments, as generate_translated_captions.py --stats does.
+"""
+
+def test_segments_without_a_language_are_ignored():
+    # Windows whose language wasn't detected leave segments with no language.
+    index = IntervalIndex([{'start': 0.0, 'end': 1.5, 'text': 'hello', 'lang': 'en'},
+                           {'start': 4.0, 'end': 5.5, 'text': '...', 'lang': None},
+                           {'start': 6.0, 'end': 7.5, 'text': 'again', 'lang': None},
+                           {'start': 7.0, 'end': 7.2, 'text': 'again', 'lang': 'en'}])
+    assert [dominant_language(index, start, start + 1.5) for start in [0.0, 2.0, 4.0, 6.0]] == ['en', None, None, 'en']
@@ -0,0 +1,93 @@
+import os
+import shutil
+import wave
+import importlib.util
+import pytest
+
+"""
+Unit tests of the stages of transcription.py on generated audio, without downloading any weights.
+"""
+
+np = pytest.importorskip('numpy')
+
+import transcription
+from subtitle_core import write_segments
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None or importlib.util.find_spec('ffmpeg') is None,
+                                  reason="The ffmpeg CLI and ffmpeg-python are needed to decode audio.")
+
+def write_wav(path, samples, sample_rate=transcription.SAMPLE_RATE):
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes((np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16).tobytes())
+    return str(path)
+
+def tone(frequency, seconds, sample_rate=transcription.SAMPLE_RATE):
+    return 0.5 * np.sin(2 * np.pi * frequency * np.arange(int(seconds * sample_rate)) / sample_rate)
+
+def tiny_whisper(n_mels=80):
+    """
+    Whisper model with random weights and the smallest dimensions the audio frontend allows.
+    """
+    torch = pytest.importorskip('torch')
+    whisper_model = pytest.importorskip('whisper.model')
+    torch.manual_seed(0)
+    dims = whisper_model.ModelDimensions(n_mels=n_mels, n_audio_ctx=1500, n_audio_state=64, n_audio_head=1, n_audio_layer=1,
+                                         n_vocab=51865, n_text_ctx=16, n_text_state=64, n_text_head=1, n_text_layer=1)
+    return whisper_model.Whisper(dims).eval()
+
+@needs_ffmpeg
+def test_load_shared_audio_maps_pcm_wavs(tmp_path):
+    import ffmpeg
+    audio_path = write_wav(tmp_path / 'tone.wav', tone(440, 3))
+    # A 16 kHz mono wav is mapped as it is, without a scratch file.
+    scratch_path = str(tmp_path / 'tone_16k.pcm')
+    audio = transcription.load_shared_audio(audio_path, scratch_path)
+    assert not os.path.exists(scratch_path)
+    assert np.array_equal(audio[:], transcription.load_audio(audio_path))
+
+    # Other audio is decoded to the scratch file once.
+    resampled_path = str(tmp_path / 'resampled.wav')
+    ffmpeg.input(audio_path).output(resampled_path, ar=44100, ac=2).run(cmd='ffmpeg', quiet=True)
+    audio = transcription.load_shared_audio(resampled_path, scratch_path)
+    assert os.path.isfile(scratch_path) and not os.path.exists(scratch_path + '.tmp')
+    assert np.array_equal(transcription.audio_window(audio, 1.0, 1.5),
+                          transcription.audio_window(transcription.load_audio(resampled_path), 1.0, 1.5))
+
+def test_detection_uses_the_mel_bins_of_the_model():
+    # large-v3 and turbo take 128 mel bins instead of 80.
+    model = tiny_whisper(n_mels=128)
+    detections = list(transcription.detect_window_languages(model, [tone(440, 2).astype(np.float32)]))
+    assert len(detections) == 1
+
+def test_transcription_reuses_the_encoder_pass_of_aligned_detection_windows(tmp_path):
+    torch = pytest.importorskip('torch')
+    model = tiny_whisper()
+    audio = (np.random.default_rng(0).standard_normal(60 * transcription.SAMPLE_RATE) * 0.1).astype(np.float32)
+    windows = [(0.0, 30.0), (30.0, 30.0)]
+
+    encoder_passes = {}
+    encode = model.encoder.forward
+    def counting_forward(mel):
+        for window_mel in mel:
+            key = transcription.EncoderFeatureCache.key(window_mel)
+            encoder_passes[key] = encoder_passes.get(key, 0) + 1
+        return encode(mel)
+    model.encoder.forward = counting_forward
+
+    feature_cache = transcription.EncoderFeatureCache()
+    detections = transcription.detect_windows(model, audio, windows, feature_cache=feature_cache)
+    # Language sections of exactly the detection windows.
+    detection_path = str(tmp_path / 'noise_lang_detection.seg')
+    write_segments(detection_path, [{'start': start, 'lang': 'en', 'duration': duration} for start, duration in windows])
+    torch.manual_seed(0)
+    transcribed = transcription.transcribe_using_detection(detection_path, str(tmp_path / 'cached.seg'), model, 'noise', audio=audio, feature_cache=feature_cache)
+
+    # The encoder ran once over each window, for detection, and transcription reused its output.
+    assert [encoder_passes[key] for _, _, _, _, key in detections] == [1, 1]
+    assert feature_cache.hits >= 2
+    # And the transcription is the one whisper gives without the cache.
+    torch.manual_seed(0)
+    assert transcription.transcribe_using_detection(detection_path, str(tmp_path / 'uncached.seg'), model, 'noise', audio=audio) == transcribed
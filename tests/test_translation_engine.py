@@ -0,0 +1,84 @@
+import threading
+
+from translation_engine import TranslationEngine, HttpTranslationBackend, RetryableTranslationError, PayloadTooLargeError
+from fake_translation_server import serve_in_thread
+
+"""
+Retries and splitting of TranslationEngine against scripted backends, and concurrency against the local fake server.
+"""
+
+class FlakySingleLineBackend:
+    """
+    Fails every distinct request once with a retryable error, then rejects it as too large unless it has one line.
+    """
+    max_lines = 100
+
+    def __init__(self):
+        self.failed = set()
+        self.lock = threading.Lock()
+
+    def translate(self, texts, target_language):
+        with self.lock:
+            first_attempt = tuple(texts) not in self.failed
+            self.failed.add(tuple(texts))
+        if first_attempt:
+            raise RetryableTranslationError("transient", retry_after=0)
+        if len(texts) > 1:
+            raise PayloadTooLargeError("too large")
+        return [('[' + target_language + '] ' + text, 'en') for text in texts]
+
+def test_split_halves_get_their_own_retries():
+    engine = TranslationEngine(FlakySingleLineBackend(), requests_per_second=None, max_retries=1)
+    texts = ['line ' + str(i) for i in range(8)]
+    results = engine.translate({'ko': texts})
+    assert [translation for translation, _ in results['ko']] == ['[ko] ' + text for text in texts]
+    assert engine.splits == 7
+
+class RateLimitedBackend:
+    """
+    Rate limits the first `limited` requests with a quota error, whatever their size.
+    """
+    max_lines = 100
+
+    def __init__(self, limited):
+        self.limited = limited
+        self.lock = threading.Lock()
+
+    def translate(self, texts, target_language):
+        with self.lock:
+            self.limited -= 1
+            limited = self.limited >= 0
+        if limited:
+            raise RetryableTranslationError("HTTP 429", retry_after=0, quota=True)
+        return [('[' + target_language + '] ' + text, 'en') for text in texts]
+
+def test_rate_limited_batches_are_retried_whole():
+    engine = TranslationEngine(RateLimitedBackend(3), requests_per_second=None, max_retries=5)
+    texts = ['line ' + str(i) for i in range(8)]
+    results = engine.translate({'ko': texts})
+    assert [translation for translation, _ in results['ko']] == ['[ko] ' + text for text in texts]
+    assert (engine.requests, engine.retries, engine.splits) == (4, 3, 0)
+
+def test_batches_over_quota_after_their_retries_are_split():
+    engine = TranslationEngine(RateLimitedBackend(2), requests_per_second=None, max_retries=1)
+    texts = ['line ' + str(i) for i in range(8)]
+    results = engine.translate({'ko': texts})
+    assert [translation for translation, _ in results['ko']] == ['[ko] ' + text for text in texts]
+    assert engine.splits == 1
+
+def test_batches_of_all_target_languages_run_together():
+    server = serve_in_thread(latency=0.05, failure_rate=0.2)
+    try:
+        engine = TranslationEngine(HttpTranslationBackend(server.url), concurrency=4, requests_per_second=None, max_lines=10)
+        texts = {'en': ['안녕하세요 ' + str(i) for i in range(25)], 'ja': ['hello ' + str(i) for i in range(25)]}
+        results = engine.translate(texts)
+        stats = server.stats
+    finally:
+        server.shutdown()
+        server.server_close()
+    # Each language's lines come back in order, with the source language detected per line.
+    assert results['en'] == [('[en] ' + text, 'ko') for text in texts['en']]
+    assert results['ja'] == [('[ja] ' + text, 'en') for text in texts['ja']]
+    # 3 batches per language, the 6 of them in flight up to 4 at a time, and every line translated once.
+    assert engine.batches == 6 and stats['max_in_flight'] > 1
+    assert stats['lines'] == 50 and stats['requests'] == 6 + stats['failures']
@@ -1,118 +1,595 @@
 import os 
 import argparse
-import librosa
 import sys
 import re
 import json
-import torch
-import ffmpeg 
+import hashlib
+import contextlib
+import dataclasses
 import numpy as np
 from datetime import timedelta
-import whisper
-from typing import Any, Deque, Iterator, List, Dict
-import moviepy.editor as mp
-from whisper.transcribe import detect_language_custom
-from ast import literal_eval
+from typing import Iterator
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from stage_cache import StageManifest
+from media_info import MediaIndex, has_audio_stream
+from model_worker import run_on_worker
+from subtitle_core import transcriptions_to_srt, read_segments, write_segments, migrate_legacy_segments
+from stage_trace import trace_stage, start_trace, stop_trace, current_trace, use_trace, counted, add_counts, count_ffmpeg, count_model_invocation
+from segments import SegmentSet
+
+# torch, whisper and ffmpeg are imported inside the functions that need them, so that importing this module, or
+# running it as a thin client of model_worker.py, doesn't load the ML stack.
 
 # Amount of padding before and after each VAD segment.
 VAD_SEGMENT_PAD = 0.05
 
+# Whisper model used when none is given on the command line.
+DEFAULT_MODEL_TYPE = 'medium'
+
+# Language detection parameters. Windows of DETECTION_WINDOW_SECONDS are detected within each VAD segment; a window is
+# extended to the end of the segment if less than DETECTION_MIN_WINDOW_SECONDS would remain after it.
+DETECTION_MIN_PROBABILITY = 0.5
+DETECTION_WINDOW_SECONDS = 2
+DETECTION_MIN_WINDOW_SECONDS = 1.5
+
+# Adaptive language detection first detects coarse windows of DETECTION_COARSE_WINDOW_SECONDS, and only subdivides the
+# ones detected with less than DETECTION_CONFIDENT_PROBABILITY, or in a different language than a neighbouring coarse
+# window, into windows of DETECTION_WINDOW_SECONDS. Coarse windows are as long as a transcription window, so that the
+# windows of a monolingual stretch line up with the ones it is transcribed in and their encoder outputs can be reused.
+DETECTION_COARSE_WINDOW_SECONDS = 30
+DETECTION_CONFIDENT_PROBABILITY = 0.8
+
+# Whisper transcription falls back to a higher temperature when the average log probability is below this.
+TRANSCRIPTION_LOGPROB_THRESHOLD = -1.0
+
+# Silero speech probability above which a frame counts as speech.
+SPEECH_TRESHOLD = 0.5
+
+# Number of samples fed to Silero at a time in streaming VAD mode. Silero supports 512 sample frames at 16 kHz.
+VAD_FRAME_SAMPLES = 512
+
+# Sample rate that both whisper and Silero VAD consume. Audio is decoded once at this rate and shared by all stages.
+SAMPLE_RATE = 16000
+
 # Seconds that a single whisper model can process at a time. THis must match the CHUNK_LENGTH const value
 # in whisper's audio.py
 CHUNK_LENGTH = 30
 
-def language_detection_test(detection_result_path, model, audio_path, pre_transcribe_segments=None):
+# Number of language detection windows that are stacked into a single encoder pass.
+DETECTION_BATCH_SIZE = 16
+
+# Maximum number of encoder outputs kept in EncoderFeatureCache. One entry of the medium model is ~6MB in fp32.
+ENCODER_CACHE_MAX_ENTRIES = 64
+
+# Directory of the int8 quantized whisper checkpoints, written on first use of each model type with --quantize.
+# Can be overridden with the QUANTIZED_MODEL_DIR environment variable.
+DEFAULT_QUANTIZED_MODEL_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'multilang_to_premiere', 'quantized')
+
+def audio_window(audio, start_second, duration_seconds=None):
+    """
+    Return the samples of audio between start_second and start_second + duration_seconds. A zero-copy view of arrays,
+    while PcmSamples convert only the samples of the window.
+    """
+    start_sample = max(int(start_second * SAMPLE_RATE), 0)
+    if duration_seconds is None:
+        return audio[start_sample:]
+    return audio[start_sample:start_sample + int(duration_seconds * SAMPLE_RATE)]
+
+class PcmSamples:
+    """
+    16 kHz mono 16-bit PCM samples memory-mapped from a file. Slicing returns float32 samples scaled as load_audio
+    returns them, so the stages can share a mapping of the audio without a float32 copy of the whole recording.
+    source identifies the mapping, so that the shard workers can map the same samples.
+    """
+    def __init__(self, path, offset=0, length=None):
+        if length is None:
+            length = (os.path.getsize(path) - offset) // 2
+        self.filename = path
+        self.source = (path, offset, length, os.stat(path).st_mtime_ns)
+        # np.memmap can't map an empty range.
+        self.pcm = np.memmap(path, dtype=np.int16, mode='r', offset=offset, shape=(length,)) if length > 0 else np.zeros(0, dtype=np.int16)
+
+    def __len__(self):
+        return len(self.pcm)
+
+    def __getitem__(self, key):
+        return self.pcm[key].astype(np.float32) / 32768.0
+
+def pcm_wav_data(path):
+    """
+    Return (offset, samples) of the data chunk of path if it is a 16 kHz mono 16-bit PCM wav, or None.
+    """
+    with open(path, 'rb') as wav_file:
+        header = wav_file.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        is_pcm = False
+        while True:
+            chunk_header = wav_file.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id = chunk_header[:4]
+            chunk_size = int.from_bytes(chunk_header[4:], 'little')
+            if chunk_id == b'fmt ':
+                fmt = wav_file.read(chunk_size)
+                audio_format = int.from_bytes(fmt[0:2], 'little')
+                channels = int.from_bytes(fmt[2:4], 'little')
+                sample_rate = int.from_bytes(fmt[4:8], 'little')
+                bits = int.from_bytes(fmt[14:16], 'little')
+                is_pcm = audio_format == 1 and channels == 1 and sample_rate == SAMPLE_RATE and bits == 16
+                wav_file.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                if not is_pcm:
+                    return None
+                offset = wav_file.tell()
+                # The size of a wav that was never finalized may be larger than what was written.
+                return offset, min(chunk_size, os.path.getsize(path) - offset) // 2
+            else:
+                # Chunks are padded to an even size.
+                wav_file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+def load_shared_audio(file, scratch_path=None):
+    """
+    Map the audio of file as 16 kHz mono samples so that VAD, language detection and transcription can share the same
+    buffer instead of each spawning ffmpeg again.
+    A 16 kHz mono 16-bit wav is mapped as it is. Other audio is decoded once to 16-bit PCM in scratch_path, which is
+    reused on later runs as long as it is newer than the source file. Without scratch_path the samples are decoded into
+    memory as float32.
+    """
+    if scratch_path is None:
+        return load_audio(file, SAMPLE_RATE)
+    wav_data = pcm_wav_data(file)
+    if wav_data is not None:
+        return PcmSamples(file, *wav_data)
+    if not os.path.isfile(scratch_path) or os.path.getmtime(scratch_path) < os.path.getmtime(file):
+        print("Decoding audio for " + file)
+        with trace_stage('decode_audio', file=file) as record:
+            decode_pcm(file, scratch_path)
+            record['audio_seconds'] = os.path.getsize(scratch_path) / 2 / SAMPLE_RATE
+    return PcmSamples(scratch_path)
+
+class EncoderFeatureCache:
+    """
+    Keeps whisper encoder outputs of language detection windows, keyed by the log-mel they were computed from, so that
+    a transcription window whose log-mel is the same is decoded without running the encoder again. The outputs are
+    handed to whisper's own transcribe, so a window gives the same result whether or not its encoder pass was reused.
+    Also counts encoder passes so that the saved compute can be reported.
+    """
+    def __init__(self, max_entries=ENCODER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.features = OrderedDict()
+        self.detection_passes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(mel):
+        return (tuple(mel.shape), str(mel.dtype), hashlib.blake2b(mel.detach().cpu().numpy().tobytes(), digest_size=16).hexdigest())
+
+    def put(self, key, features):
+        if self.max_entries <= 0:
+            return
+        # Kept on the cpu in the dtype of the encoder, so that a reused output is exactly the one the encoder gave.
+        self.features[key] = features.detach().to('cpu')
+        self.features.move_to_end(key)
+        while len(self.features) > self.max_entries:
+            self.features.popitem(last=False)
+
+    def discard(self, key):
+        self.features.pop(key, None)
+
+    @contextlib.contextmanager
+    def reusing(self, model):
+        """
+        Within the context, encoder passes of model over a single log-mel found in the cache return the kept output.
+        """
+        encoder = getattr(model, 'encoder', None)
+        if encoder is None:
+            yield
+            return
+        encode = encoder.forward
+
+        def cached_forward(mel):
+            key = self.key(mel[0]) if len(mel) == 1 else None
+            # Kept after a hit, as whisper runs the encoder again for every temperature it falls back to.
+            features = self.features.get(key) if key is not None else None
+            if features is None:
+                self.misses += 1
+                return encode(mel)
+            self.hits += 1
+            self.features.move_to_end(key)
+            return features.unsqueeze(0).to(mel.device)
+
+        # forward is shadowed on the instance only, and whatever was there before is put back.
+        shadowed = 'forward' in vars(encoder)
+        encoder.forward = cached_forward
+        try:
+            yield
+        finally:
+            if shadowed:
+                encoder.forward = encode
+            else:
+                del encoder.forward
+
+    def report(self):
+        encoder_passes = self.detection_passes + self.hits + self.misses
+        if encoder_passes == 0:
+            return "Encoder feature cache: no encoder passes."
+        return ("Encoder feature cache: reused detection features for " + str(self.hits) + " of " + str(self.hits + self.misses) +
+                " transcription encoder passes, saving " + str(self.hits) + " of " + str(encoder_passes) + " encoder passes (" +
+                '{0:.1f}'.format(100.0 * self.hits / encoder_passes) + "%).")
+
+def window_mel(model, window):
+    """
+    Log-mel of the first CHUNK_LENGTH seconds of window, computed as whisper.transcribe computes the first segment of
+    the same audio. Detecting on it matches whisper's own language detection, and a transcription window of the same
+    samples is run through the encoder on exactly this log-mel.
+    """
+    import torch
+    import whisper
+    mel = whisper.log_mel_spectrogram(window, model.dims.n_mels, padding=whisper.audio.N_SAMPLES)
+    content_frames = mel.shape[-1] - whisper.audio.N_FRAMES
+    mel = whisper.pad_or_trim(mel[:, :min(whisper.audio.N_FRAMES, content_frames)], whisper.audio.N_FRAMES)
+    # The dtype whisper.transcribe runs the model in by default.
+    return mel.to(torch.float16 if model.device.type != 'cpu' else torch.float32)
+
+def detect_window_languages(model, windows, batch_size=DETECTION_BATCH_SIZE, feature_cache=None):
+    """
+    Detect the most likely language of each window of at most CHUNK_LENGTH seconds of audio.
+    Log-mel spectrograms of up to batch_size windows are stacked and run through the encoder in a single pass.
+    feature_cache: EncoderFeatureCache to keep the encoder outputs of the windows in.
+    Returns a list of (language code, probability, cache key) in the order of windows. The cache key is None without
+    feature_cache.
+    """
+    import torch
+    results = []
+    for i in range(0, len(windows), batch_size):
+        # The log-mel is clamped relative to its own maximum, so each window must be computed separately
+        # to match what single window detection produces.
+        mels = [window_mel(model, window) for window in windows[i:i + batch_size]]
+        features = model.embed_audio(torch.stack(mels).to(model.device))
+        count_model_invocation()
+        # detect_language skips the encoder when it is given encoder outputs.
+        _, probs = model.detect_language(features)
+        for j in range(len(probs)):
+            key = None
+            if feature_cache is not None:
+                key = feature_cache.key(mels[j])
+                feature_cache.put(key, features[j])
+            detected_language = max(probs[j], key=probs[j].get)
+            results.append((detected_language, probs[j][detected_language], key))
+    return results
+
+def detect_windows(model, audio, windows, batch_size=DETECTION_BATCH_SIZE, shard_pool=None, feature_cache=None):
+    """
+    Detect the language of (start, duration) windows of audio, on shard_pool if given.
+    Returns [(start, duration, language, probability, cache key)] in the order of windows. Encoder outputs are only
+    kept in feature_cache when detecting in this process.
+    """
+    if shard_pool is not None:
+        return [window + detection + (None,) for window, detection in zip(windows, shard_pool.detect(audio, windows, batch_size))]
+    return [window + detection for window, detection in
+            zip(windows, detect_window_languages(model, [audio_window(audio, start, duration) for start, duration in windows], batch_size, feature_cache))]
+
+def split_detection_windows(start, end, unit_seconds, min_unit_seconds=DETECTION_MIN_WINDOW_SECONDS):
+    """
+    Split start to end into (start, duration) windows of unit_seconds. A window is extended to end if less than
+    min_unit_seconds would remain after it.
+    """
+    windows = []
+    while start < end:
+        duration = unit_seconds
+        if (end - (start + duration) < min_unit_seconds) or (start + unit_seconds > end):
+            duration = end - start
+        windows.append((start, duration))
+        start += unit_seconds
+    return windows
+
+def adaptive_window_detections(model, audio, spans, batch_size=DETECTION_BATCH_SIZE, shard_pool=None, feature_cache=None):
+    """
+    Coarse to fine language detection over spans of (start, end) seconds.
+    Coarse windows are detected first. The ones that are uncertain or disagree with a neighbour are detected again as
+    windows of DETECTION_WINDOW_SECONDS, while confident windows inside monolingual stretches are kept whole.
+    The encoder outputs of the coarse windows kept whole stay in feature_cache for transcription.
+    Returns [(start, duration, language, probability, cache key)] in time order, and the number of windows detected.
+    """
+    coarse_windows = []
+    for start, end in spans:
+        # Never extended past a transcription window, which they could then not line up with.
+        coarse_windows.extend(split_detection_windows(start, end, DETECTION_COARSE_WINDOW_SECONDS, min_unit_seconds=0))
+    coarse = detect_windows(model, audio, coarse_windows, batch_size, shard_pool, feature_cache)
+
+    refine = []
+    for i, (start, duration, language, probability, _) in enumerate(coarse):
+        differs = ((i > 0 and coarse[i - 1][2] != language) or (i < len(coarse) - 1 and coarse[i + 1][2] != language))
+        refine.append(probability < DETECTION_CONFIDENT_PROBABILITY or differs)
+
+    fine_windows = []
+    for (start, duration, _, _, key), refined in zip(coarse, refine):
+        if refined:
+            fine_windows.extend(split_detection_windows(start, start + duration, DETECTION_WINDOW_SECONDS))
+            # A language section starts within it, so no transcription window will line up with it.
+            if key is not None:
+                feature_cache.discard(key)
+    fine = iter(detect_windows(model, audio, fine_windows, batch_size, shard_pool))
+
+    detections = []
+    for coarse_detection, refined in zip(coarse, refine):
+        if not refined:
+            detections.append(coarse_detection)
+            continue
+        # Fine windows were collected in the order of the coarse windows they subdivide.
+        start, duration = coarse_detection[:2]
+        for _ in split_detection_windows(start, start + duration, DETECTION_WINDOW_SECONDS):
+            detections.append(next(fine))
+    print("Adaptive detection: " + str(len(coarse_windows)) + " coarse windows, " + str(sum(refine)) + " refined into " +
+          str(len(fine_windows)) + " fine windows.")
+    return detections, len(coarse_windows) + len(fine_windows)
+
+def language_detection_test(detection_result_path, model, audio_path, pre_transcribe_segments=None, audio=None, batch_size=DETECTION_BATCH_SIZE, feature_cache=None,
+                            adaptive=False, shard_pool=None):
     """
     Detect language type for audio containing speech of mutliple languages. 
+    audio: Samples decoded by load_shared_audio. Decoded from audio_path if not given.
+    batch_size: Number of detection windows run through the model at once.
+    feature_cache: EncoderFeatureCache to keep the encoder outputs of the coarse windows of adaptive detection in, which
+    transcription windows lining up with them reuse.
+    adaptive: Detect coarse windows first and subdivide only the uncertain ones, see adaptive_window_detections.
+    shard_pool: ShardPool to split the windows across. The encoder outputs of windows detected on it aren't cached.
     """
     print("Detecting language for " + audio_path)
     
-    minimum_probability = 0.5
-    detection_segment_unit_seconds = 2
-    min_detection_segment_unit = 1.5
-    audio_total_length_seconds = librosa.get_duration(filename=audio_path)
+    minimum_probability = DETECTION_MIN_PROBABILITY
+    if audio is None:
+        audio = load_shared_audio(audio_path)
+    audio_total_length_seconds = len(audio) / SAMPLE_RATE
         
     if pre_transcribe_segments == None:    
         pre_transcribe_segments = [{'start':0, 'end':audio_total_length_seconds}]
 
+    spans = list(SegmentSet.from_dicts(pre_transcribe_segments).pad(VAD_SEGMENT_PAD, 0.0, audio_total_length_seconds))
+    if adaptive:
+        detections, detected_windows = adaptive_window_detections(model, audio, spans, batch_size, shard_pool, feature_cache)
+    else:
+        # Collect the detection windows of every VAD segment first, so that they can be detected in batches.
+        windows = []
+        for start, end in spans:
+            windows.extend(split_detection_windows(start, end, DETECTION_WINDOW_SECONDS))
+        # Windows of DETECTION_WINDOW_SECONDS rarely line up with a transcription window, so they aren't cached.
+        detections = detect_windows(model, audio, windows, batch_size, shard_pool)
+        detected_windows = len(windows)
+    if feature_cache is not None:
+        feature_cache.detection_passes += detected_windows
+
     result = []
-    # For each VAD Segment
-    for segment in pre_transcribe_segments:       
-        start = max(segment['start'] - VAD_SEGMENT_PAD, 0.0)
-        end = min(segment['end'] + VAD_SEGMENT_PAD, audio_total_length_seconds)                   
-        
-        while start < end:
-            duration = detection_segment_unit_seconds
-            if (end - (start + duration) < min_detection_segment_unit) or (start + detection_segment_unit_seconds > end):
-                duration = end - start
-            detected_language, probs = detect_language_custom(
-                    model,
-                    str(audio_path),
-                    start_second = start,
-                    detection_duration_seconds = duration,
-                )
-            if (probs < minimum_probability):
-                detected_language = 'nil'
-            if (len(result) > 0 and result[-1]['lang'] == detected_language):
-                start += detection_segment_unit_seconds
-                continue
-            else:
-                result.append({'start': start, 'lang': detected_language})
-                start += detection_segment_unit_seconds
+    for start, duration, detected_language, probs, _ in detections:
+        if (probs < minimum_probability):
+            detected_language = 'nil'
+        if (len(result) > 0 and result[-1]['lang'] == detected_language):
+            continue
+        result.append({'start': start, 'lang': detected_language})
         
     print("Saving detection to " + detection_result_path)
-    with open(detection_result_path, "w+", encoding='UTF-8') as text_file:
-        for i in range(len(result)):
-            duration = 0
-            if (i < len(result)-1):
-                duration = result[i+1]['start'] - result[i]['start']
-            else:
-                duration = audio_total_length_seconds - result[i]['start']
-            assert(duration > 0)
-            result[i]['duration'] = duration
-            text_file.write(json.dumps(result[i], ensure_ascii=False) + '\n')
-        text_file.close()
+    for i in range(len(result)):
+        duration = 0
+        if (i < len(result)-1):
+            duration = result[i+1]['start'] - result[i]['start']
+        else:
+            duration = audio_total_length_seconds - result[i]['start']
+        assert(duration > 0)
+        result[i]['duration'] = duration
+    write_segments(detection_result_path, result)
     
     return result
 
-def transcribe_using_detection(detection_result_path, transcription_out_path, model, audio_path):
+def section_windows(lang_sections):
     """
-    Transcribe the audio using 
-    detection_result_path: File containing dicts of the following format: {start:float, duration_seconds:float, language:string}
+    Slice each language section into windows of at most CHUNK_LENGTH seconds of wall-clock time.
+    A window is a dict of the following format: {lang:string, pieces:[(source_start:float, source_end:float)]}
     """
-    print("transcribing " + audio_path)
-    if not os.path.exists(detection_result_path):
-        language_detection_test(detection_result_path, model, audio_path)
-    res = open(detection_result_path).readlines()
-    args = dict()
-    transcription_results = []
-    for line in res:
-        lang_section = json.loads(line)
+    windows = []
+    for lang_section in lang_sections:
         start = float(lang_section['start'])
         duration = float(lang_section['duration'])
-        args['language'] = re.sub(r'\s','',lang_section['lang'])
-        if args['language'] == 'nil':
+        language = re.sub(r'\s','',lang_section['lang'])
+        if language == 'nil':
             continue
-        
         for i in range(int(duration / CHUNK_LENGTH) + 1):
             start_subsegment = start + i * CHUNK_LENGTH
             duration_trimmed = min(duration - i * CHUNK_LENGTH, CHUNK_LENGTH)
-            transcriptions = whisper.transcribe(
-                model,
-                str(audio_path),
-                logprob_threshold=-1.0,
-                start_second = start_subsegment,
-                duration_seconds = duration_trimmed,
-                **args,
-            )['segments']
-            for transcription in transcriptions:
-                transcription_results.append({'start': start_subsegment + float(transcription['start']), 'end': start_subsegment + float(transcription['end']), 'text': transcription['text'], 'lang': args['language']})
+            # Sections that are an exact multiple of CHUNK_LENGTH would otherwise end with an empty window.
+            if duration_trimmed <= 0:
+                break
+            windows.append({'lang': language, 'pieces': [(start_subsegment, start_subsegment + duration_trimmed)]})
+    return windows
+
+def pack_speech_windows(speech_segments, lang_sections, audio_total_length_seconds, max_window_seconds=CHUNK_LENGTH):
+    """
+    Pack the speech of the VAD segments into dense windows of up to max_window_seconds per detected language.
+    The padded VAD segments are split at language section boundaries, silence between them is dropped, and the
+    resulting pieces of each language are concatenated in time order until a window is full.
+    Returns windows in the format of section_windows, sorted by their first piece.
+    """
+    sections = []
+    for lang_section in lang_sections:
+        language = re.sub(r'\s','',lang_section['lang'])
+        if language != 'nil':
+            sections.append((float(lang_section['start']), float(lang_section['start']) + float(lang_section['duration']), language))
+
+    pieces_by_language = {}
+    first_section = 0
+    for segment in speech_segments:
+        segment_start = max(segment['start'] - VAD_SEGMENT_PAD, 0.0)
+        segment_end = min(segment['end'] + VAD_SEGMENT_PAD, audio_total_length_seconds)
+        # Both segments and sections are sorted, so sections ending before this segment never match again.
+        while first_section < len(sections) and sections[first_section][1] <= segment_start:
+            first_section += 1
+        for section_start, section_end, language in sections[first_section:]:
+            if section_start >= segment_end:
+                break
+            piece_start = max(segment_start, section_start)
+            piece_end = min(segment_end, section_end)
+            # Speech longer than a window can't be kept whole, so it is cut at window length.
+            while piece_end - piece_start > 0:
+                pieces_by_language.setdefault(language, []).append((piece_start, min(piece_end, piece_start + max_window_seconds)))
+                piece_start += max_window_seconds
+
+    windows = []
+    for language, pieces in pieces_by_language.items():
+        window_pieces = []
+        window_length = 0.0
+        for piece_start, piece_end in pieces:
+            if len(window_pieces) > 0 and window_length + piece_end - piece_start > max_window_seconds:
+                windows.append({'lang': language, 'pieces': window_pieces})
+                window_pieces = []
+                window_length = 0.0
+            window_pieces.append((piece_start, piece_end))
+            window_length += piece_end - piece_start
+        if len(window_pieces) > 0:
+            windows.append({'lang': language, 'pieces': window_pieces})
+    windows.sort(key=lambda window: window['pieces'][0][0])
+    return windows
+
+def window_samples(audio, pieces):
+    """
+    Samples of a window, and the offset in seconds at which each of its pieces starts within them.
+    Single piece windows are a zero-copy view of audio.
+    """
+    views = [audio_window(audio, piece_start, piece_end - piece_start) for piece_start, piece_end in pieces]
+    offsets = []
+    offset_samples = 0
+    for view in views:
+        offsets.append(offset_samples / SAMPLE_RATE)
+        offset_samples += len(view)
+    return (views[0] if len(views) == 1 else np.concatenate(views)), offsets
+
+def window_to_source_time(pieces, offsets, window_time, is_end=False):
+    """
+    Map a time within the samples of a packed window back to the time in the source audio.
+    An end time falling exactly on a piece boundary maps to the end of the earlier piece.
+    """
+    if is_end:
+        k = bisect_left(offsets, window_time) - 1
+    else:
+        k = bisect_right(offsets, window_time) - 1
+    k = min(max(k, 0), len(pieces) - 1)
+    return pieces[k][0] + window_time - offsets[k]
+
+def checkpoint_path(transcription_out_path):
+    return transcription_out_path + '.partial'
+
+def read_transcription_checkpoint(path, checkpoint_id):
+    """
+    Return {window index: transcriptions} of the windows completed in the checkpoint at path, or an empty dict if there
+    is no checkpoint for checkpoint_id.
+    The checkpoint is append-only: a header line with the checkpoint id, then one line per completed window of the
+    format {window:int, segments:[{start:float, end:float, text:string, lang:string}]}.
+    """
+    if not os.path.isfile(path):
+        return {}
+    completed = {}
+    with open(path, encoding='UTF-8') as checkpoint_file:
+        lines = checkpoint_file.read().split('\n')
+    try:
+        if json.loads(lines[0]).get('checkpoint') != checkpoint_id:
+            print("Checkpoint " + path + " is from a different run configuration. Starting over.")
+            return {}
+    except ValueError:
+        return {}
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # The last line is cut short when the process was killed while writing it.
+            break
+        completed[record['window']] = record['segments']
+    return completed
+
+def transcribe_window(model, audio, window, feature_cache=None):
+    """
+    Transcribe a single window of the format of section_windows. Encoder passes found in feature_cache are reused.
+    Returns [{start:float, end:float, text:string, lang:string}] in source time.
+    """
+    language = window['lang']
+    pieces = window['pieces']
+    window_results = []
+    samples, offsets = window_samples(audio, pieces)
+    # Called through the model, so that benchmark.py can plug in a stub model.
+    count_model_invocation()
+    with feature_cache.reusing(model) if feature_cache is not None else contextlib.nullcontext():
+        transcriptions = model.transcribe(
+            samples,
+            logprob_threshold=TRANSCRIPTION_LOGPROB_THRESHOLD,
+            language=language,
+        )['segments']
+    for transcription in transcriptions:
+        window_results.append({'start': window_to_source_time(pieces, offsets, float(transcription['start'])),
+                               'end': window_to_source_time(pieces, offsets, float(transcription['end']), is_end=True),
+                               'text': transcription['text'], 'lang': language})
+    return window_results
+
+def transcribe_using_detection(detection_result_path, transcription_out_path, model, audio_path, audio=None, feature_cache=None, speech_segments=None,
+                               checkpoint_key=None, resume=True, shard_pool=None):
+    """
+    Transcribe the audio using 
+    detection_result_path: File containing dicts of the following format: {start:float, duration_seconds:float, language:string}
+    audio: Samples decoded by load_shared_audio. Decoded from audio_path if not given.
+    feature_cache: EncoderFeatureCache filled by language_detection_test. Windows found in it skip the encoder.
+    speech_segments: VAD segments. If given, their speech is packed into full windows by pack_speech_windows instead of
+    slicing the language sections by wall-clock time.
+    checkpoint_key: Stage key of the run. Each window is appended to a checkpoint next to transcription_out_path as soon
+    as it is transcribed, and a rerun with the same key and windows resumes after the last completed window.
+    resume: If False, an existing checkpoint is discarded.
+    shard_pool: ShardPool to split the windows across. Results are still checkpointed and merged in window order.
+    """
+    print("transcribing " + audio_path)
+    if audio is None:
+        audio = load_shared_audio(audio_path)
+    if not os.path.exists(detection_result_path):
+        language_detection_test(detection_result_path, model, audio_path, audio=audio, shard_pool=shard_pool)
+    lang_sections = read_segments(detection_result_path)
+    if speech_segments is not None:
+        windows = pack_speech_windows(speech_segments, lang_sections, len(audio) / SAMPLE_RATE)
+    else:
+        windows = section_windows(lang_sections)
+    # The windows are part of the checkpoint id, so that a checkpoint is never resumed against different windows.
+    checkpoint_id = hashlib.blake2b(json.dumps([checkpoint_key, windows]).encode('utf-8'), digest_size=16).hexdigest()
+    partial_path = checkpoint_path(transcription_out_path)
+    completed = read_transcription_checkpoint(partial_path, checkpoint_id) if resume else {}
+    if len(completed) > 0:
+        print("Resuming transcription from checkpoint: " + str(len(completed)) + " of " + str(len(windows)) + " windows already transcribed.")
+    # Rewrite the checkpoint with only its complete lines, so that a line cut short by a crash isn't continued by the
+    # next append.
+    with open(partial_path, "w+", encoding='UTF-8') as checkpoint_file:
+        checkpoint_file.write(json.dumps({'checkpoint': checkpoint_id}) + '\n')
+        for window_index in sorted(completed):
+            checkpoint_file.write(json.dumps({'window': window_index, 'segments': completed[window_index]}, ensure_ascii=False) + '\n')
+    print("Transcribing " + str(len(windows) - len(completed)) + " windows.")
+
+    remaining = [window_index for window_index in range(len(windows)) if window_index not in completed]
+    if shard_pool is not None:
+        remaining_results = shard_pool.transcribe(audio, [windows[window_index] for window_index in remaining])
+    else:
+        remaining_results = (transcribe_window(model, audio, windows[window_index], feature_cache) for window_index in remaining)
+    with open(partial_path, "a", encoding='UTF-8') as checkpoint_file:
+        # Results come in window order, also from the shards.
+        for window_index, window_results in zip(remaining, remaining_results):
+            # A window is only checkpointed once it is on disk, so a crash loses at most the windows being transcribed.
+            checkpoint_file.write(json.dumps({'window': window_index, 'segments': window_results}, ensure_ascii=False) + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+            completed[window_index] = window_results
+    transcription_results = []
+    for window_index in range(len(windows)):
+        transcription_results.extend(completed[window_index])
+    # Packed windows of different languages interleave in time.
+    transcription_results.sort(key=lambda transcription: transcription['start'])
         
     print("Saving transcription to " + transcription_out_path)
-    with open(transcription_out_path, "w+", encoding='UTF-8') as text_file:
-        for i in range(len(transcription_results)):
-            text_file.write(json.dumps(transcription_results[i], ensure_ascii=False) + '\n')
-    text_file.close()
+    write_segments(transcription_out_path, transcription_results)
+    os.remove(partial_path)
     
     return transcription_results
 
@@ -141,79 +618,395 @@ def transcribe_timestamp(model, audio_path, languages, out_path='out/test_transr
             text_file.close()
         return result['segments']
 
-def transcriptions_to_srt(srt_out_path, transcriptions):
-    srt_segments = []
-    for i in range(len(transcriptions)):
-        segment = transcriptions[i]
-        segment_id = i + 1
-        text = segment['text']
-        
-        # A bit of a hack, but make sure that the end time of this segment is at least 1 milliseconds less than the
-        # beginning of the next segment. Otherwise premiere pro will combine them.
-        if (i != len(transcriptions) - 1 and segment['end'] >= transcriptions[i+1]['start']):
-            segment['end'] = transcriptions[i+1]['start'] - 0.001
-        
-        startTime = str(0)+str(timedelta(seconds=int(segment['start'])))+ ',' + '{0:.3f}'.format(segment['start']).split('.')[1][:3]
-        endTime = str(0)+str(timedelta(seconds=int(segment['end'])))+ ',' + '{0:.3f}'.format(segment['end']).split('.')[1][:3]
-        srt_segments.append(f"{segment_id}\n{startTime} --> {endTime}\n{text[1:] if text[0] == ' ' else text}\n\n")
-    print("Saving srt file of transcription to " + srt_out_path)
-    with open(srt_out_path, "w+", encoding='UTF-8') as srt_file:
-        for srt_segment in srt_segments:
-            srt_file.write(srt_segment)
-    srt_file.close()
-    
-def process_file(file, out_basedir, vad_model, get_speech_timestamps, whisper_model, args):
+def footage_output_path(file, out_basedir, suffix):
+    return os.path.join(out_basedir, os.path.basename(file).split('.')[0] + suffix)
+
+def extract_audio(file, out_path):
+    """
+    Demux the audio track of file into a 16 kHz mono PCM wav at out_path in a single ffmpeg call, without decoding
+    any video. This is the format whisper and Silero consume, so later stages don't need to resample.
+    """
+    import ffmpeg
+    temp_path = out_path + '.tmp'
+    count_ffmpeg()
+    try:
+        (
+            ffmpeg.input(file)
+            .output(temp_path, format='wav', vn=None, ac=1, ar=SAMPLE_RATE, acodec='pcm_s16le')
+            .overwrite_output()
+            .run(cmd="ffmpeg", capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"Failed to extract audio: {e.stderr.decode()}")
+    # Only move the sidecar in place once it is complete, so an interrupted extraction is never mistaken for a done one.
+    os.replace(temp_path, out_path)
+
+def decode_pcm(file, out_path):
+    """
+    Decode the audio of file to raw 16 kHz mono 16-bit PCM at out_path.
+    """
+    import ffmpeg
+    temp_path = out_path + '.tmp'
+    count_ffmpeg()
+    try:
+        (
+            ffmpeg.input(file, threads=0)
+            .output(temp_path, format='s16le', acodec='pcm_s16le', ac=1, ar=SAMPLE_RATE)
+            .overwrite_output()
+            .run(cmd="ffmpeg", capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}")
+    # A decode that is killed halfway leaves only the temporary file, which is never taken for the scratch file.
+    os.replace(temp_path, out_path)
+
+def extract_footage_audio(file, out_basedir):
+    """
+    Return the path of the audio to process for file, extracting it first if file is a video.
+    """
     footage_audio = ""
     if (file.endswith('.mp4')):
-        # First, find if there is already an audio file corresponding to this video.
-        footage_audio = os.path.join(out_basedir, os.path.basename(file).split('.')[0] + ".mp3")
-        if (not os.path.isfile(footage_audio)):
+        # First, find if there is already an audio file extracted from this video as it is now. mp3 sidecars were
+        # written by earlier versions and are still used when present. A video replaced since is extracted again, which
+        # changes the fingerprint of its audio and so the keys of every stage.
+        manifest = footage_manifest(file, out_basedir)
+        footage_audio = footage_output_path(file, out_basedir, "_16k.wav")
+        legacy_footage_audio = footage_output_path(file, out_basedir, ".mp3")
+        if (not os.path.isfile(footage_audio) and manifest.is_derived(legacy_footage_audio, file)):
+            footage_audio = legacy_footage_audio
+        elif (not manifest.is_derived(footage_audio, file)):
             print("Extracting audio for " + file)
-            mp.VideoFileClip(file).audio.write_audiofile(footage_audio)
+            with trace_stage('extract_audio', file=file):
+                extract_audio(file, footage_audio)
+            manifest.record_derived(footage_audio, file)
     elif (file.endswith('.wav') or file.endswith('.mp3')):
         footage_audio = file
     else:
         sys.exit("Input file " + file + " is neither a video or an audio file.")
-    
-    vad_path = os.path.join(out_basedir, os.path.basename(file).split('.')[0] + "_vad.txt")
+    return footage_audio
+
+def footage_manifest(file, out_basedir):
+    return StageManifest(footage_output_path(file, out_basedir, "_manifest.json"))
+
+def vad_stage_params(args):
+    return {'speech_threshold': SPEECH_TRESHOLD, 'segment_pad': VAD_SEGMENT_PAD, 'streaming': args.streaming_vad}
+
+def detection_stage_params(args):
+    params = {'model': args.model, 'minimum_probability': DETECTION_MIN_PROBABILITY, 'window_seconds': DETECTION_WINDOW_SECONDS,
+              'min_window_seconds': DETECTION_MIN_WINDOW_SECONDS, 'segment_pad': VAD_SEGMENT_PAD}
+    if args.quantize:
+        params['quantize'] = 'int8'
+    if args.adaptive_detection:
+        params.update({'coarse_window_seconds': DETECTION_COARSE_WINDOW_SECONDS, 'confident_probability': DETECTION_CONFIDENT_PROBABILITY})
+    return params
+
+def transcription_stage_params(args):
+    params = {'model': args.model, 'chunk_length': CHUNK_LENGTH, 'logprob_threshold': TRANSCRIPTION_LOGPROB_THRESHOLD,
+              'pack_speech_windows': args.pack_speech_windows}
+    if args.quantize:
+        params['quantize'] = 'int8'
+    return params
+
+def run_vad_stage(file, out_basedir, footage_audio, audio, vad_model, get_speech_timestamps, args):
+    vad_path = footage_output_path(file, out_basedir, "_vad.seg")
+    migrate_legacy_segments(vad_path)
+    manifest = footage_manifest(file, out_basedir)
+    vad_key = manifest.key('vad', footage_audio, vad_stage_params(args))
     pre_transcribe_segments = []
-    if (not os.path.isfile(vad_path) or args.reprocess_vad):
-        pre_transcribe_segments = vad_transcribe_timestamps(vad_model, get_speech_timestamps, footage_audio, 0.0, librosa.get_duration(filename=footage_audio), out_path=vad_path)
+    if (args.reprocess_vad or not manifest.is_fresh('vad', vad_key, [vad_path])):
+        with trace_stage('vad', audio_seconds=len(audio) / SAMPLE_RATE, file=file, streaming=args.streaming_vad):
+            if args.streaming_vad:
+                pre_transcribe_segments = list(vad_stream_timestamps(vad_model, footage_audio, out_path=vad_path, samples=audio))
+            else:
+                pre_transcribe_segments = vad_transcribe_timestamps(vad_model, get_speech_timestamps, footage_audio, 0.0, len(audio) / SAMPLE_RATE, out_path=vad_path, samples=audio)
+        manifest.record('vad', vad_key, [vad_path])
     else:
         print("Existing VAD found. Skipping step.")
-        pre_transcribe_segments = [json.loads(f) for f in open(vad_path).readlines()]
-    detection_result_path = os.path.join(out_basedir, os.path.basename(file).split('.')[0] + "_lang_detection.txt")
-    if (not os.path.isfile(detection_result_path) or args.reprocess_lang_detection):
-        language_detection_test(detection_result_path, whisper_model, footage_audio, pre_transcribe_segments=pre_transcribe_segments)
+        pre_transcribe_segments = read_segments(vad_path)
+    return pre_transcribe_segments
+
+def run_whisper_stages(file, out_basedir, footage_audio, audio, pre_transcribe_segments, whisper_model, args, feature_cache=None, shard_pool=None):
+    # Reload the manifest, VAD may have recorded to it from a worker process.
+    manifest = footage_manifest(file, out_basedir)
+    if shard_pool is not None:
+        # Encoder outputs stay in the shard processes.
+        feature_cache = None
+    detection_result_path = footage_output_path(file, out_basedir, "_lang_detection.seg")
+    migrate_legacy_segments(detection_result_path)
+    detection_key = manifest.key('lang_detection', footage_audio, detection_stage_params(args), upstream_stages=['vad'])
+    if (args.reprocess_lang_detection or not manifest.is_fresh('lang_detection', detection_key, [detection_result_path])):
+        with trace_stage('lang_detection', audio_seconds=len(audio) / SAMPLE_RATE, file=file):
+            language_detection_test(detection_result_path, whisper_model, footage_audio, pre_transcribe_segments=pre_transcribe_segments, audio=audio, batch_size=args.detection_batch_size, feature_cache=feature_cache,
+                                    adaptive=args.adaptive_detection, shard_pool=shard_pool)
+        manifest.record('lang_detection', detection_key, [detection_result_path])
     else:
         print("Existing lang detection found. Skipping step.")
-    transcription_out_path = os.path.join(out_basedir, os.path.basename(file).split('.')[0] + "_transcription.txt")
-    if (not os.path.isfile(transcription_out_path) or args.reprocess_transcription):
-        transcriptions = transcribe_using_detection(detection_result_path, transcription_out_path, whisper_model, footage_audio)
+    transcription_out_path = footage_output_path(file, out_basedir, "_transcription.seg")
+    migrate_legacy_segments(transcription_out_path)
+    transcription_upstream = ['vad', 'lang_detection'] if args.pack_speech_windows else ['lang_detection']
+    transcription_key = manifest.key('transcription', footage_audio, transcription_stage_params(args), upstream_stages=transcription_upstream)
+    if (args.reprocess_transcription or not manifest.is_fresh('transcription', transcription_key, [transcription_out_path])):
+        with trace_stage('transcription', audio_seconds=len(audio) / SAMPLE_RATE, file=file):
+            transcriptions = transcribe_using_detection(detection_result_path, transcription_out_path, whisper_model, footage_audio, audio=audio, feature_cache=feature_cache,
+                                                        speech_segments=pre_transcribe_segments if args.pack_speech_windows else None,
+                                                        checkpoint_key=transcription_key, resume=not args.reprocess_transcription, shard_pool=shard_pool)
+        manifest.record('transcription', transcription_key, [transcription_out_path])
     else:
         print("Existing transcription found. Skipping step.")
-        transcriptions = [json.loads(f) for f in open(transcription_out_path, encoding='utf-8').readlines()]
+        transcriptions = read_segments(transcription_out_path)
     if (args.output_srt):
-        srt_out_path = os.path.join(out_basedir, os.path.basename(file).split('.')[0] + "_transcription.srt")
-        transcriptions_to_srt(srt_out_path, transcriptions)
+        srt_out_path = footage_output_path(file, out_basedir, "_transcription.srt")
+        with trace_stage('srt', audio_seconds=len(audio) / SAMPLE_RATE, file=file):
+            transcriptions_to_srt(srt_out_path, transcriptions)
 
-def walk_footage_dir(footage_dir, args):
-    vad_model, get_speech_timestamps = create_vad_model()
+def process_file(file, out_basedir, vad_model, get_speech_timestamps, whisper_model, args, feature_cache=None, shard_pool=None):
+    footage_audio = extract_footage_audio(file, out_basedir)
     
-    modeltype = 'medium'
-    print("Loading langauge model " + modeltype + "...")
-    whisper_model = whisper.load_model(modeltype)
+    # Decode once; every stage below works on slices of this buffer.
+    audio = load_shared_audio(footage_audio, footage_output_path(file, out_basedir, "_16k.pcm"))
+
+    pre_transcribe_segments = run_vad_stage(file, out_basedir, footage_audio, audio, vad_model, get_speech_timestamps, args)
+    run_whisper_stages(file, out_basedir, footage_audio, audio, pre_transcribe_segments, whisper_model, args, feature_cache=feature_cache, shard_pool=shard_pool)
+
+# Silero model of a VAD worker process of walk_footage_dir. Loaded once per worker by _init_vad_worker.
+_vad_worker_model = None
+
+def _init_vad_worker():
+    global _vad_worker_model
+    _vad_worker_model = create_vad_model()
+
+def _vad_worker_job(file, out_basedir, footage_audio, args, trace_path):
+    # The pool of model_worker.py serves many runs, so the VAD record goes to the trace of the run of this job.
+    use_trace(trace_path)
+    vad_model, get_speech_timestamps = _vad_worker_model
+    # The scratch file was written by _prepare_footage, so this only maps it.
+    audio = load_shared_audio(footage_audio, footage_output_path(file, out_basedir, "_16k.pcm"))
+    return run_vad_stage(file, out_basedir, footage_audio, audio, vad_model, get_speech_timestamps, args)
+
+def create_vad_pool(args):
+    """
+    Pool of args.vad_workers processes, each with its own single threaded Silero model.
+    """
+    return ProcessPoolExecutor(max_workers=max(args.vad_workers, 1), initializer=_init_vad_worker)
+
+def _prepare_footage(file, out_basedir, vad_pool, args):
+    """
+    Extract and decode the audio of file, then run VAD for it on vad_pool. Runs on the I/O threads of walk_footage_dir.
+    """
+    footage_audio = extract_footage_audio(file, out_basedir)
+    load_shared_audio(footage_audio, footage_output_path(file, out_basedir, "_16k.pcm"))
+    pre_transcribe_segments = vad_pool.submit(_vad_worker_job, file, out_basedir, footage_audio, args, current_trace()).result()
+    return footage_audio, pre_transcribe_segments
+
+# Whisper model and mapped audio of a shard worker process of ShardPool.
+_shard_worker_model = None
+_shard_worker_audio = (None, None)
+
+def _init_shard_worker(model_type, threads, quantize):
+    global _shard_worker_model
+    import torch
+    torch.set_num_threads(threads)
+    _shard_worker_model = load_whisper_model(model_type, quantize)
+
+def _shard_worker_samples(source):
+    global _shard_worker_audio
+    # Consecutive jobs are mostly of the same recording, so its mapping is kept. The source includes the modification
+    # time, so a file replaced since is mapped again.
+    if _shard_worker_audio[0] != source:
+        _shard_worker_audio = (source, PcmSamples(*source[:3]))
+    return _shard_worker_audio[1]
+
+def _shard_detect_job(source, windows, batch_size):
+    audio = _shard_worker_samples(source)
+    return [(language, probability) for language, probability, _ in
+            detect_window_languages(_shard_worker_model, [audio_window(audio, start, duration) for start, duration in windows], batch_size)]
+
+def _shard_transcribe_job(source, window):
+    return transcribe_window(_shard_worker_model, _shard_worker_samples(source), window)
+
+def _add_shard_counts(results):
+    """
+    Yield the results of the counted jobs of shard workers, adding their model invocations to the stage running here.
+    """
+    for result, counts in results:
+        add_counts(counts)
+        yield result
+
+class ShardPool:
+    """
+    Worker processes that each hold their own whisper model, to split language detection and transcription of a single
+    recording across the cores of a CPU-only machine. Each worker runs its model on threads_per_shard torch threads,
+    all cores split evenly between the shards by default.
+    Workers map the same file as the PcmSamples of load_shared_audio, so only window bounds and results are sent between
+    processes.
+    """
+    def __init__(self, model_type, shards, threads_per_shard=None, quantize=False):
+        threads = threads_per_shard or max(1, (os.cpu_count() or 1) // shards)
+        print("Starting " + str(shards) + " shards of " + model_type + " with " + str(threads) + " threads each.")
+        self.pool = ProcessPoolExecutor(max_workers=shards, initializer=_init_shard_worker, initargs=(model_type, threads, quantize))
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _source(audio):
+        source = getattr(audio, 'source', None)
+        if source is None:
+            raise ValueError("Sharding needs the audio mapped from a file by load_shared_audio.")
+        return source
+
+    def detect(self, audio, windows, batch_size=DETECTION_BATCH_SIZE):
+        """
+        Detect (language, probability) of (start, duration) windows, one batch of windows per job.
+        """
+        source = self._source(audio)
+        batches = [windows[i:i + batch_size] for i in range(0, len(windows), batch_size)]
+        detections = []
+        for batch_detections in _add_shard_counts(self.pool.map(counted, [_shard_detect_job] * len(batches), [source] * len(batches), batches, [batch_size] * len(batches))):
+            detections.extend(batch_detections)
+        return detections
+
+    def transcribe(self, audio, windows):
+        """
+        Transcribe windows, one window per job. Returns an iterator of the results of each window in the order of windows.
+        """
+        source = self._source(audio)
+        return _add_shard_counts(self.pool.map(counted, [_shard_transcribe_job] * len(windows), [source] * len(windows), windows))
+
+def create_shard_pool(args):
+    if args.shards <= 1:
+        return None
+    return ShardPool(args.model, args.shards, args.shard_threads, args.quantize)
+
+def start_run_trace(directory, args):
+    if not args.no_trace:
+        start_trace(directory, 'transcription')
+
+def _replace_whisper_linears(module):
+    """
+    Replace whisper's Linear subclass by plain torch Linear layers, which are the type quantize_dynamic looks for.
+    """
+    import torch
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.Linear) and type(child) is not torch.nn.Linear:
+            linear = torch.nn.Linear(child.in_features, child.out_features, bias=child.bias is not None)
+            linear.load_state_dict(child.state_dict())
+            setattr(module, name, linear)
+        else:
+            _replace_whisper_linears(child)
+
+def _quantize_whisper(model):
+    import torch
+    _replace_whisper_linears(model)
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def quantized_model_path(model_type):
+    return os.path.join(os.environ.get('QUANTIZED_MODEL_DIR', DEFAULT_QUANTIZED_MODEL_DIR), 'whisper_' + model_type + '_int8.pt')
+
+def load_quantized_whisper_model(model_type):
+    """
+    Load model_type with its linear layers quantized to int8 for CPU inference. The model is quantized once and kept
+    as a checkpoint at quantized_model_path; later loads only rebuild the quantized structure and load its weights.
+    """
+    import torch
+    import whisper
+    from whisper.model import ModelDimensions, Whisper
+    checkpoint_path = quantized_model_path(model_type)
+    if os.path.isfile(checkpoint_path):
+        print("Loading int8 quantized langauge model " + model_type + " from " + checkpoint_path + "...")
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        model = _quantize_whisper(Whisper(ModelDimensions(**checkpoint['dims'])))
+        model.load_state_dict(checkpoint['state_dict'])
+    else:
+        print("Quantizing langauge model " + model_type + " to int8. This is done once, the result is kept at " + checkpoint_path)
+        model = _quantize_whisper(whisper.load_model(model_type, device='cpu'))
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        temp_path = checkpoint_path + '.tmp'
+        torch.save({'dims': dataclasses.asdict(model.dims), 'state_dict': model.state_dict()}, temp_path)
+        os.replace(temp_path, checkpoint_path)
+    # Alignment heads aren't part of the state dict. They are only used for word timestamps.
+    if hasattr(whisper, '_ALIGNMENT_HEADS') and model_type in whisper._ALIGNMENT_HEADS:
+        model.set_alignment_heads(whisper._ALIGNMENT_HEADS[model_type])
+    return model.eval()
+
+def load_whisper_model(model_type, quantize=False):
+    """
+    quantize: Load the int8 quantized model for CPU inference instead, see load_quantized_whisper_model.
+    """
+    if quantize:
+        return load_quantized_whisper_model(model_type)
+    import whisper
+    print("Loading langauge model " + model_type + "...")
+    return whisper.load_model(model_type)
+
+def walk_footage_dir(footage_dir, args, whisper_model=None, feature_cache=None, shard_pool=None, vad_pool=None):
+    """
+    Process every mp4 in the subfolders of footage_dir as a pipeline. While the whisper model works on one file,
+    audio extraction and decoding of the upcoming files run concurrently on a thread pool and VAD runs on a pool of worker processes,
+    each with its own single threaded Silero model. At most args.pipeline_depth files are prepared ahead of the whisper
+    stage, which keeps memory bounded.
+    whisper_model, feature_cache, shard_pool, vad_pool: Already loaded model, cache, shards and VAD workers to use, as
+    kept by model_worker.py. vad_pool is a pool created by create_vad_pool.
+    Shards are started for this walk if args.shards is set and none are given, and the model is then only loaded by them.
+    """
+    own_shard_pool = shard_pool is None
+    if own_shard_pool:
+        shard_pool = create_shard_pool(args)
+    if whisper_model is None and shard_pool is None:
+        whisper_model = load_whisper_model(args.model, args.quantize)
+    if feature_cache is None:
+        feature_cache = EncoderFeatureCache(args.encoder_cache_size)
     
+    footages = []
     subfolders = [f.path for f in os.scandir(footage_dir) if f.is_dir()]
     for subfolder in subfolders:
-        footages = [f.path for f in os.scandir(subfolder) if f.name.endswith('.mp4')]
-        for footage in footages:
-            process_file(footage, subfolder, vad_model, get_speech_timestamps, whisper_model, args)
+        footages.extend([(f.path, subfolder) for f in os.scandir(subfolder) if f.name.endswith('.mp4')])
+    
+    # Probe all footages in parallel from their headers, and leave out the unreadable ones and the ones without any audio
+    # to transcribe.
+    media_infos = MediaIndex().probe_many([footage for footage, _ in footages])
+    footages = [(footage, subfolder) for footage, subfolder in footages if os.path.abspath(footage) in media_infos]
+    for footage, _ in footages:
+        if not has_audio_stream(media_infos[os.path.abspath(footage)]):
+            print("Skipping " + footage + ", it has no audio stream.")
+    footages = [(footage, subfolder) for footage, subfolder in footages if has_audio_stream(media_infos[os.path.abspath(footage)])]
+    print("Processing " + str(len(footages)) + " footages, " + str(timedelta(seconds=int(sum(media_infos[os.path.abspath(footage)]['duration'] for footage, _ in footages)))) + " in total.")
+    
+    pipeline_depth = max(args.pipeline_depth, 1)
+    own_vad_pool = vad_pool is None
+    if own_vad_pool:
+        vad_pool = create_vad_pool(args)
+    try:
+        with ThreadPoolExecutor(max_workers=pipeline_depth) as prepare_pool:
+            pending = deque()
+            next_footage = 0
+            while next_footage < len(footages) or len(pending) > 0:
+                while next_footage < len(footages) and len(pending) < pipeline_depth:
+                    footage, subfolder = footages[next_footage]
+                    pending.append((footage, subfolder, prepare_pool.submit(_prepare_footage, footage, subfolder, vad_pool, args)))
+                    next_footage += 1
+                footage, subfolder, prepared = pending.popleft()
+                footage_audio, pre_transcribe_segments = prepared.result()
+                audio = load_shared_audio(footage_audio, footage_output_path(footage, subfolder, "_16k.pcm"))
+                run_whisper_stages(footage, subfolder, footage_audio, audio, pre_transcribe_segments, whisper_model, args, feature_cache=feature_cache, shard_pool=shard_pool)
+    finally:
+        if own_vad_pool:
+            vad_pool.shutdown()
+        if own_shard_pool and shard_pool is not None:
+            shard_pool.close()
+    print(feature_cache.report())
                 
 
 # These VAD loading scripts are taken from aadnk/whisper-webui
 
 def create_vad_model():
+    import torch
     model, utils = torch.hub.load(repo_or_dir='snakers4/silero-vad', model='silero_vad')
     
     # Silero does not benefit from multi-threading
@@ -222,40 +1015,6 @@ def create_vad_model():
 
     return model, get_speech_timestamps
 
-def multiply_timestamps( timestamps: List[Dict[str, Any]], factor: float):
-        result = []
-
-        for entry in timestamps:
-            start = entry['start']
-            end = entry['end']
-
-            result.append({
-                'start': start * factor,
-                'end': end * factor
-            })
-        return result
-
-def adjust_timestamp(segments: Iterator[dict], adjust_seconds: float, max_source_time: float = None):
-    result = []
-
-    for segment in segments:
-        segment_start = float(segment['start'])
-        segment_end = float(segment['end'])
-
-        # Filter segments?
-        if (max_source_time is not None):
-            if (segment_start > max_source_time):
-                continue
-            segment_end = min(max_source_time, segment_end)
-
-            new_segment = segment.copy()
-
-        # Add to start and end
-        new_segment['start'] = segment_start + adjust_seconds
-        new_segment['end'] = segment_end + adjust_seconds
-        result.append(new_segment)
-    return result
-
 def load_audio(file: str, sample_rate: int = 16000, 
                start_time: str = None, duration: str = None):
     """
@@ -275,6 +1034,7 @@ def load_audio(file: str, sample_rate: int = 16000,
     -------
     A NumPy array containing the audio waveform, in float32 dtype.
     """
+    import ffmpeg
     try:
         inputArgs = {'threads': 0}
 
@@ -285,6 +1045,7 @@ def load_audio(file: str, sample_rate: int = 16000,
 
         # This launches a subprocess to decode audio while down-mixing and resampling as necessary.
         # Requires the ffmpeg CLI and `ffmpeg-python` package to be installed.
+        count_ffmpeg()
         out, _ = (
             ffmpeg.input(file, **inputArgs)
             .output("-", format="s16le", acodec="pcm_s16le", ac=1, ar=sample_rate)
@@ -295,74 +1056,213 @@ def load_audio(file: str, sample_rate: int = 16000,
 
     return np.frombuffer(out, np.int16).flatten().astype(np.float32) / 32768.0
 
-def vad_transcribe_timestamps(model, get_speech_timestamps, audio: str, start_time: float, end_time: float, out_path=None):
-    result = []
+def vad_transcribe_timestamps(model, get_speech_timestamps, audio: str, start_time: float, end_time: float, out_path=None, samples=None):
+    """
+    samples: Samples of audio decoded by load_shared_audio. If given, chunks are sliced from it instead of
+    being decoded from audio again.
+    """
+    import torch
+    chunk_segments = []
 
     # Divide procesisng of audio into chunks
     chunk_start = start_time
     VAD_MAX_PROCESSING_CHUNK = 60 * 60 # 60 minutes of audio
-    SPEECH_TRESHOLD = 0.5
     while (chunk_start < end_time):
         chunk_duration = min(end_time - chunk_start, VAD_MAX_PROCESSING_CHUNK)
 
-        sampling_rate = 16000
-        wav = load_audio(audio, sampling_rate, str(chunk_start), str(chunk_duration)) 
+        sampling_rate = SAMPLE_RATE
+        if samples is not None:
+            wav = torch.from_numpy(np.ascontiguousarray(audio_window(samples, chunk_start, chunk_duration)))
+        else:
+            wav = load_audio(audio, sampling_rate, str(chunk_start), str(chunk_duration))
 
         sample_timestamps = get_speech_timestamps(wav, model, sampling_rate=sampling_rate, threshold=SPEECH_TRESHOLD)
-        seconds_timestamps = multiply_timestamps(sample_timestamps, factor=1 / sampling_rate) 
-        adjusted = adjust_timestamp(seconds_timestamps, adjust_seconds=chunk_start, max_source_time=chunk_start + chunk_duration)
-
-        result.extend(adjusted)
+        count_model_invocation()
+        # Sample offsets within the chunk to seconds in the source.
+        chunk_segments.append(SegmentSet.from_dicts(sample_timestamps).scale(1 / sampling_rate).clip(0.0, chunk_duration).shift(chunk_start))
         chunk_start += chunk_duration
         
-    i = 0
-    while i < len(result):
-        # If the gap between this and the next segment is less than pad_between_segments * 2, just combine them.
-        if (i != len(result) - 1 and result[i+1]['start'] - result[i]['end'] < 2 * VAD_SEGMENT_PAD):
-            result[i]['end'] = result[i+1]['end']
-            del result[i+1] 
-        else:
-            i += 1
+    # If the gap between two segments is less than pad_between_segments * 2, just combine them.
+    result = SegmentSet.concatenate(chunk_segments).merge_within(2 * VAD_SEGMENT_PAD).to_dicts()
 
     if (out_path != None):
-        with open(out_path, "w+", encoding='UTF-8') as text_file:
-            for segment in result:
-                text_file.write(json.dumps(segment, ensure_ascii=False) + '\n')
-        text_file.close()
+        write_segments(out_path, result)
 
     return result
+
+def stream_audio_frames(file: str, frame_samples: int = VAD_FRAME_SAMPLES, samples=None):
+    """
+    Yield the audio of file as consecutive float32 frames of frame_samples samples, the last one zero padded.
+    Frames are read from ffmpeg's stdout as it decodes, or sliced from samples decoded by load_shared_audio if given,
+    so that only a single frame is held in memory at a time.
+    """
+    import ffmpeg
+    if samples is not None:
+        for i in range(0, len(samples), frame_samples):
+            frame = samples[i:i + frame_samples]
+            if len(frame) < frame_samples:
+                frame = np.pad(frame, (0, frame_samples - len(frame)))
+            yield frame
+        return
+
+    count_ffmpeg()
+    process = (
+        ffmpeg.input(file, threads=0)
+        .output("-", format="s16le", acodec="pcm_s16le", ac=1, ar=SAMPLE_RATE)
+        .global_args("-loglevel", "error")
+        .run_async(cmd="ffmpeg", pipe_stdout=True)
+    )
+    frame_bytes = frame_samples * 2
+    try:
+        while True:
+            data = process.stdout.read(frame_bytes)
+            if not data:
+                break
+            if len(data) % 2:
+                data = data[:-1]
+            frame = np.frombuffer(data, np.int16).astype(np.float32) / 32768.0
+            if len(frame) < frame_samples:
+                frame = np.pad(frame, (0, frame_samples - len(frame)))
+            yield frame
+    finally:
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError("Failed to stream audio from " + file)
+
+def merge_close_segments(segments: Iterator[dict], max_gap: float):
+    """
+    Merge consecutive segments whose gap is less than max_gap. Works on a stream of segments sorted by start,
+    holding back only the segment that may still be extended.
+    """
+    current = None
+    for segment in segments:
+        if current is not None and segment['start'] - current['end'] < max_gap:
+            current['end'] = max(current['end'], segment['end'])
+            continue
+        if current is not None:
+            yield current
+        current = dict(segment)
+    if current is not None:
+        yield current
+
+def stream_speech_timestamps(model, frames: Iterator[np.ndarray], threshold: float = SPEECH_TRESHOLD,
+                             min_speech_duration_ms: int = 250, min_silence_duration_ms: int = 100, speech_pad_ms: int = 30):
+    """
+    Feed frames to Silero one at a time and yield speech segments in seconds as soon as they end.
+    Silero's recurrent state is carried between frames by the model, and the speech/silence hysteresis below follows
+    get_speech_timestamps, so segments are never cut at arbitrary chunk boundaries.
+    """
+    import torch
+    model.reset_states()
+    neg_threshold = threshold - 0.15
+    min_speech_samples = SAMPLE_RATE * min_speech_duration_ms / 1000
+    min_silence_samples = SAMPLE_RATE * min_silence_duration_ms / 1000
+    speech_pad_samples = SAMPLE_RATE * speech_pad_ms / 1000
+
+    triggered = False
+    speech_start = 0
+    temp_end = 0
+    position = 0
+    for frame in frames:
+        speech_prob = model(torch.from_numpy(np.ascontiguousarray(frame)), SAMPLE_RATE).item()
+        count_model_invocation()
+        frame_start = position
+        position += len(frame)
+
+        if speech_prob >= threshold:
+            temp_end = 0
+            if not triggered:
+                triggered = True
+                speech_start = frame_start
+            continue
+        if speech_prob < neg_threshold and triggered:
+            if not temp_end:
+                temp_end = frame_start
+            if position - temp_end < min_silence_samples:
+                continue
+            if temp_end - speech_start >= min_speech_samples:
+                yield {'start': max(speech_start - speech_pad_samples, 0) / SAMPLE_RATE, 'end': (temp_end + speech_pad_samples) / SAMPLE_RATE}
+            triggered = False
+            temp_end = 0
+
+    if triggered and position - speech_start >= min_speech_samples:
+        yield {'start': max(speech_start - speech_pad_samples, 0) / SAMPLE_RATE, 'end': position / SAMPLE_RATE}
+
+def vad_stream_timestamps(model, audio: str, out_path=None, samples=None):
+    """
+    Streaming counterpart of vad_transcribe_timestamps. Speech segments are produced as a generator while the audio
+    is decoded frame by frame, so peak memory does not depend on the length of the recording.
+    If out_path is set, the segments are written to it once the stream ends. Only the segments are kept until then,
+    which are a few bytes per second of speech.
+    """
+    segments = merge_close_segments(stream_speech_timestamps(model, stream_audio_frames(audio, samples=samples)), 2 * VAD_SEGMENT_PAD)
+    if out_path is None:
+        yield from segments
+        return
+    result = []
+    for segment in segments:
+        result.append(segment)
+        yield segment
+    write_segments(out_path, result)
     
-if __name__ == "__main__":
-    #directory paths 
+def build_parser():
     parser = argparse.ArgumentParser(description='Script for organizing footage to folders.')
     parser.add_argument("--footage_dir", help="Root directory for footages.")
     parser.add_argument("--output_srt", action='store_true', help="Whether to also output the transcription result to an srt format.")
     parser.add_argument("--test_single_file", help = "Test transcribing only for a single file.")
+    parser.add_argument("--model", default=DEFAULT_MODEL_TYPE, help = "Whisper model to use for language detection and transcription.")
     parser.add_argument("--reprocess_vad", action='store_true', help = "Reprocess vad even if there are existing intermediate output files.")
     parser.add_argument("--reprocess_lang_detection", action='store_true', help = "Reprocess language detection even if there are existing intermediate output files.")
     parser.add_argument("--reprocess_transcription", action='store_true', help = "Reprocess transcription even if there are existing intermediate output files.")
+    parser.add_argument("--detection_batch_size", type=int, default=DETECTION_BATCH_SIZE, help = "Number of language detection windows to run through the model at once.")
+    parser.add_argument("--adaptive_detection", action='store_true', help = "Detect languages over coarse windows first, and only subdivide the uncertain ones or ones at a language change.")
+    parser.add_argument("--encoder_cache_size", type=int, default=ENCODER_CACHE_MAX_ENTRIES, help = "Number of adaptive detection encoder outputs kept for reuse in transcription. 0 disables the cache.")
+    parser.add_argument("--pipeline_depth", type=int, default=2, help = "Number of footages whose audio extraction and VAD run ahead of the whisper stages in --footage_dir mode.")
+    parser.add_argument("--vad_workers", type=int, default=2, help = "Number of VAD worker processes in --footage_dir mode.")
+    parser.add_argument("--quantize", action='store_true', help = "Run whisper with int8 dynamically quantized linear layers on the CPU. Faster on CPU-only machines, at some cost in accuracy; see compare_quantization.py.")
+    parser.add_argument("--shards", type=int, default=1, help = "Number of worker processes, each with its own whisper model, that language detection and transcription of a file are split across. For CPU-only machines.")
+    parser.add_argument("--shard_threads", type=int, help = "Number of torch threads of each shard. All cores are split evenly between the shards if not set.")
+    parser.add_argument("--streaming_vad", action='store_true', help = "Run VAD frame by frame over a stream of the audio instead of over hour long chunks, keeping memory flat.")
+    parser.add_argument("--pack_speech_windows", action='store_true', help = "Transcribe the VAD speech of each language packed into full 30 second windows, dropping the silence between.")
+    parser.add_argument("--no_worker", action='store_true', help = "Load the models in this process even if a model_worker.py is running.")
+    parser.add_argument("--no_trace", action='store_true', help = "Don't record a trace of the timing of each stage. Use stage_trace.py to summarize traces.")
     parser.add_argument("--reprocess_all", action='store_true', help = "Reprocess the entire pipeline even if there are existing intermediate output files.")
+    return parser
 
-    args = parser.parse_args()
+if __name__ == "__main__":
+    #directory paths 
+    args = build_parser().parse_args()
     if args.reprocess_all:
         args.reprocess_vad = True
         args.reprocess_lang_detection = True
         args.reprocess_transcription = True
 
+    # Hand the jobs to a running model worker, which already has the models loaded.
+    if not args.no_worker and run_on_worker(args):
+        sys.exit(0)
+
     if args.footage_dir:
+        start_run_trace(os.path.abspath(args.footage_dir), args)
         walk_footage_dir(os.path.abspath(args.footage_dir), args)
+        stop_trace()
 
     if args.test_single_file:
         filepath = os.path.abspath(args.test_single_file)
         vad_model, get_speech_timestamps = create_vad_model()
         #pre_transcribe_segments = vad_transcribe_timestamps(vad_model, get_speech_timestamps, filepath, 0.0, librosa.get_duration(filename=filepath))
         
-        modeltype = 'medium'
-        print("Loading langauge model " + modeltype + "...")
-        
-        whisper_model = whisper.load_model(modeltype)
+        shard_pool = create_shard_pool(args)
+        # With shards, the model is only loaded by them.
+        whisper_model = load_whisper_model(args.model, args.quantize) if shard_pool is None else None
         
-        process_file(filepath, os.path.abspath('./out'), vad_model, get_speech_timestamps, whisper_model, args)
+        feature_cache = EncoderFeatureCache(args.encoder_cache_size)
+        start_run_trace(os.path.abspath('./out'), args)
+        try:
+            process_file(filepath, os.path.abspath('./out'), vad_model, get_speech_timestamps, whisper_model, args, feature_cache=feature_cache, shard_pool=shard_pool)
+        finally:
+            if shard_pool is not None:
+                shard_pool.close()
+        print(feature_cache.report())
         
         
         # detection_result_name = os.path.join(os.path.abspath('./out'),  os.path.basename(filepath).split('.')[0] + "_" + 'lang_detection' + ".txt")
@@ -0,0 +1,298 @@
+import html
+import json
+import time
+import random
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Concurrent translation of caption lines into several target languages.
+
+Lines of every target are packed into batches that fit the backend's per-request limits on lines, codepoints and
+bytes, and the batches of all targets are sent together from a thread pool, with at most `concurrency` requests in
+flight and a token bucket keeping the request rate under the backend's quota. Requests failing with a retryable error
+(rate limiting, server errors, timeouts) are sent again after an exponential backoff, whole, since halves would only
+add requests under a rate limit. A batch rejected as too large, a per-request quota on characters included, is split
+in halves right away, and so is one still failing on quota once its retries are used up. Batches at least as large as a
+rejected one, in both lines and codepoints, are split before being sent at all. Results come back in the order of
+the lines, whatever order the requests complete in.
+
+Backends translate a list of lines into one target language and return (translation, detected source language) per
+line. GoogleTranslateBackend uses the Cloud Translation API, HttpTranslationBackend a json endpoint such as the local
+fake_translation_server.py.
+"""
+
+# Maximum amount of lines possible to send in a single translation request.
+MAX_STRING_LIMIT = 700
+# Maximum total codepoints of the lines of a single Cloud Translation request.
+MAX_REQUEST_CODEPOINTS = 30000
+
+DEFAULT_CONCURRENCY = 4
+# Requests started per second. The Cloud Translation API default quota is far above this; it mostly smooths bursts.
+DEFAULT_REQUESTS_PER_SECOND = 5.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+
+class RetryableTranslationError(Exception):
+    """
+    Failure of a translation request that may succeed when sent again. retry_after is the delay in seconds asked for
+    by the backend, if any, and quota tells rate limiting apart from other failures.
+    """
+    def __init__(self, message, retry_after=None, quota=False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.quota = quota
+
+class PayloadTooLargeError(Exception):
+    """
+    Rejection of a translation request for having too many lines or too much text, or for going over a quota on the
+    size of one request. A smaller request may succeed.
+    """
+
+class TokenBucket:
+    """
+    Allow rate acquisitions per second on average, with bursts of up to capacity.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            # Sleep outside the lock so that other threads can refill and check too.
+            time.sleep(wait)
+
+class GoogleTranslateBackend:
+    """
+    Cloud Translation API v3, authenticated with a service account key.
+    """
+    name = 'google_v3'
+    max_lines = MAX_STRING_LIMIT
+    max_codepoints = MAX_REQUEST_CODEPOINTS
+    max_bytes = None
+
+    def __init__(self, google_api_key_path):
+        from google.cloud import translate
+        from google.oauth2 import service_account
+        from google.api_core import exceptions
+        credentials = service_account.Credentials.from_service_account_file(google_api_key_path)
+        self.client = translate.TranslationServiceClient(credentials=credentials)
+        project_id = credentials.project_id
+        assert(project_id)
+        location = 'global'
+        self.parent = f'projects/{project_id}/locations/{location}'
+        self.invalid_argument_error = exceptions.InvalidArgument
+        self.quota_errors = (exceptions.TooManyRequests, exceptions.ResourceExhausted)
+        self.retryable_errors = (exceptions.ServiceUnavailable, exceptions.InternalServerError, exceptions.DeadlineExceeded)
+
+    def translate(self, texts, target_language):
+        try:
+            response = self.client.translate_text(contents=texts, target_language_code=target_language, parent=self.parent)
+        except self.invalid_argument_error as e:
+            # Oversized requests are only told apart from other invalid arguments by their message.
+            message = str(e).lower()
+            if any(reason in message for reason in ['too long', 'too many', 'too large', 'exceed']):
+                raise PayloadTooLargeError(str(e)) from e
+            raise
+        except self.quota_errors as e:
+            # A quota on the characters of one request is not lifted by waiting, only by sending less.
+            if 'per request' in str(e).lower():
+                raise PayloadTooLargeError(str(e)) from e
+            raise RetryableTranslationError(str(e), quota=True) from e
+        except self.retryable_errors as e:
+            raise RetryableTranslationError(str(e)) from e
+        return [(html.unescape(translation.translated_text), translation.detected_language_code) for translation in response.translations]
+
+class HttpTranslationBackend:
+    """
+    Json translation endpoint. Requests are {contents:[string], target_language_code:string}, responses
+    {translations:[{translated_text:string, detected_language_code:string}]}. HTTP 429 and 5xx are retryable, 429
+    being a quota error, and HTTP 413 means the request was too large.
+    """
+    def __init__(self, url, timeout=60.0, max_lines=MAX_STRING_LIMIT, max_codepoints=MAX_REQUEST_CODEPOINTS, max_bytes=None):
+        self.url = url
+        self.timeout = timeout
+        self.name = 'http ' + url
+        self.max_lines = max_lines
+        self.max_codepoints = max_codepoints
+        self.max_bytes = max_bytes
+
+    def translate(self, texts, target_language):
+        body = json.dumps({'contents': texts, 'target_language_code': target_language}).encode('utf-8')
+        request = urllib.request.Request(self.url, data=body, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                payload = json.load(response)
+        except urllib.error.HTTPError as e:
+            if e.code == 413:
+                raise PayloadTooLargeError("HTTP 413 from " + self.url + " for " + str(len(texts)) + " lines") from e
+            if e.code == 429 or e.code >= 500:
+                retry_after = e.headers.get('Retry-After')
+                raise RetryableTranslationError("HTTP " + str(e.code) + " from " + self.url, float(retry_after) if retry_after else None, quota=e.code == 429) from e
+            raise
+        except (urllib.error.URLError, TimeoutError) as e:
+            raise RetryableTranslationError("Request to " + self.url + " failed: " + str(e)) from e
+        return [(translation['translated_text'], translation.get('detected_language_code')) for translation in payload['translations']]
+
+def pack_batches(texts, max_lines=MAX_STRING_LIMIT, max_codepoints=None, max_bytes=None):
+    """
+    Split texts into consecutive batches of at most max_lines lines, max_codepoints codepoints and max_bytes utf-8
+    bytes, filling each batch before starting the next. A line over a budget on its own gets a batch to itself.
+    """
+    batches = []
+    batch = []
+    codepoints = 0
+    size = 0
+    for text in texts:
+        text_codepoints = len(text)
+        text_size = len(text.encode('utf-8')) if max_bytes is not None else 0
+        if len(batch) > 0 and (len(batch) == max_lines or
+                               (max_codepoints is not None and codepoints + text_codepoints > max_codepoints) or
+                               (max_bytes is not None and size + text_size > max_bytes)):
+            batches.append(batch)
+            batch = []
+            codepoints = 0
+            size = 0
+        batch.append(text)
+        codepoints += text_codepoints
+        size += text_size
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+class TranslationEngine:
+    """
+    Sends translation requests to backend concurrently. Batch limits default to the ones of the backend.
+    requests counts the requests sent, retries and splits included, and lines and codepoints what they carried.
+    """
+    def __init__(self, backend, concurrency=DEFAULT_CONCURRENCY, requests_per_second=DEFAULT_REQUESTS_PER_SECOND,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_seconds=DEFAULT_BACKOFF_SECONDS, max_lines=None,
+                 max_codepoints=None, max_bytes=None):
+        self.backend = backend
+        self.concurrency = concurrency
+        # No rate limit when requests_per_second is 0 or None.
+        self.bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_lines = max_lines or getattr(backend, 'max_lines', MAX_STRING_LIMIT)
+        self.max_codepoints = max_codepoints or getattr(backend, 'max_codepoints', None)
+        self.max_bytes = max_bytes or getattr(backend, 'max_bytes', None)
+        self.requests = 0
+        self.retries = 0
+        self.splits = 0
+        self.batches = 0
+        self.lines = 0
+        self.codepoints = 0
+        # (lines, codepoints) of the requests rejected as too large.
+        self.rejected = []
+        self.lock = threading.Lock()
+
+    def _split(self, texts, target_language):
+        with self.lock:
+            self.splits += 1
+        half = len(texts) // 2
+        # Each half is a new request with retries of its own, so that lines split off deep down don't inherit the
+        # failures of the larger requests they were part of.
+        return self._send(texts[:half], target_language) + self._send(texts[half:], target_language)
+
+    def _known_too_large(self, lines, codepoints):
+        with self.lock:
+            return any(lines >= rejected_lines and codepoints >= rejected_codepoints for rejected_lines, rejected_codepoints in self.rejected)
+
+    def _send(self, texts, target_language):
+        codepoints = sum(len(text) for text in texts)
+        attempt = 0
+        while True:
+            if len(texts) > 1 and self._known_too_large(len(texts), codepoints):
+                return self._split(texts, target_language)
+            if self.bucket is not None:
+                self.bucket.acquire()
+            with self.lock:
+                self.requests += 1
+            try:
+                results = self.backend.translate(texts, target_language)
+            except PayloadTooLargeError:
+                if len(texts) == 1:
+                    raise
+                with self.lock:
+                    self.rejected.append((len(texts), codepoints))
+                print("Translation request of " + str(len(texts)) + " lines to " + target_language + " is too large, splitting it.")
+                return self._split(texts, target_language)
+            except RetryableTranslationError as e:
+                if attempt == self.max_retries:
+                    # Smaller requests may still fit in what is left of a quota on characters.
+                    if e.quota and len(texts) > 1:
+                        print("Translation request of " + str(len(texts)) + " lines to " + target_language + " is still over quota, splitting it.")
+                        return self._split(texts, target_language)
+                    raise
+                # Exponential backoff with jitter, so that requests failing together don't all come back together.
+                delay = e.retry_after if e.retry_after is not None else self.backoff_seconds * 2 ** attempt * random.uniform(0.5, 1.0)
+                print("Translation request to " + target_language + " failed (" + str(e) + "), retrying in " + '{0:.1f}'.format(delay) + " s.")
+                with self.lock:
+                    self.retries += 1
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if len(results) != len(texts):
+                raise ValueError("Error: length of translated results does not match the length of captions, " + str(len(results)) + " != " + str(len(texts)) + ".")
+            with self.lock:
+                self.lines += len(texts)
+                self.codepoints += codepoints
+            return results
+
+    def translate(self, texts_by_target):
+        """
+        Translate {target_language: [line]} and return {target_language: [(translation, detected_language)]}, in the
+        order of the lines. The batches of all target languages are in flight together.
+        """
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            batches = {target_language: pack_batches(texts, self.max_lines, self.max_codepoints, self.max_bytes)
+                       for target_language, texts in texts_by_target.items()}
+            self.batches += sum(len(target_batches) for target_batches in batches.values())
+            futures = {target_language: [pool.submit(self._send, batch, target_language) for batch in target_batches]
+                       for target_language, target_batches in batches.items()}
+            return {target_language: [result for future in target_futures for result in future.result()]
+                    for target_language, target_futures in futures.items()}
+        finally:
+            # On failure, don't keep sending the batches that haven't started.
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def efficiency(self):
+        """
+        Batching statistics of the lines translated so far. minimum_requests is the fewest requests the line and
+        codepoint budgets allow for sent_lines and sent_codepoints; line_fill and codepoint_fill are the average share
+        of each budget used by a request.
+        """
+        minimum_requests = -(-self.lines // self.max_lines)
+        if self.max_codepoints:
+            minimum_requests = max(minimum_requests, -(-self.codepoints // self.max_codepoints))
+        return {'requests': self.requests, 'batches': self.batches, 'retries': self.retries, 'splits': self.splits,
+                'sent_lines': self.lines, 'sent_codepoints': self.codepoints, 'minimum_requests': minimum_requests,
+                'line_fill': self.lines / (self.requests * self.max_lines) if self.requests else None,
+                'codepoint_fill': self.codepoints / (self.requests * self.max_codepoints) if self.requests and self.max_codepoints else None}
+
+    def report(self):
+        efficiency = self.efficiency()
+        report = ("Translation engine: " + str(efficiency['requests']) + " requests for " + str(efficiency['sent_lines']) + " lines in "
+                  + str(efficiency['batches']) + " batches (minimum " + str(efficiency['minimum_requests']) + "), "
+                  + str(efficiency['retries']) + " retries, " + str(efficiency['splits']) + " splits.")
+        if efficiency['requests'] > 0:
+            report += " Average request filled {0:.0%} of the line budget".format(efficiency['line_fill'])
+            if efficiency['codepoint_fill'] is not None:
+                report += " and {0:.0%} of the codepoint budget".format(efficiency['codepoint_fill'])
+            report += "."
+        return report
@@ -0,0 +1,169 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import unicodedata
+
+"""
+Local translation memory for generate_translated_captions.py.
+
+Translations are stored in SQLite keyed by (normalized source text, source language, target language, backend), so a
+rerun only sends the caption lines that were edited or never translated, and a line repeated within a file is sent
+once. The detected source language returned with each translation is kept too, since the first translation of a file
+also writes its language detection result.
+"""
+
+# Location of the translation memory. Can be overridden with the TRANSLATION_MEMORY_PATH environment variable.
+DEFAULT_TRANSLATION_MEMORY_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'multilang_to_premiere', 'translation_memory.sqlite')
+
+# Source language of lines translated with automatic source language detection.
+AUTO_SOURCE_LANGUAGE = 'auto'
+
+def normalize_text(text):
+    """
+    Key of a source line: NFC normalized, with runs of whitespace, line breaks included, collapsed to single spaces.
+    """
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+class TranslationMemory:
+    """
+    SQLite store of translations. hits and sent count the lines answered from the store and the unique lines sent to
+    the backend since it was opened.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('TRANSLATION_MEMORY_PATH', DEFAULT_TRANSLATION_MEMORY_PATH)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        # Several translation runs may share the store; WAL lets them read while another one writes.
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS translations ('
+            ' source_text TEXT NOT NULL, source_language TEXT NOT NULL, target_language TEXT NOT NULL, backend TEXT NOT NULL,'
+            ' translation TEXT NOT NULL, detected_language TEXT, created REAL NOT NULL,'
+            ' PRIMARY KEY (source_text, source_language, target_language, backend))')
+        self.connection.commit()
+        self.hits = 0
+        self.sent = 0
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def lookup(self, keys, source_language, target_language, backend):
+        """
+        Return {key: (translation, detected_language)} for the normalized keys found in the store.
+        """
+        found = {}
+        for key in keys:
+            row = self.connection.execute(
+                'SELECT translation, detected_language FROM translations'
+                ' WHERE source_text = ? AND source_language = ? AND target_language = ? AND backend = ?',
+                (key, source_language, target_language, backend)).fetchone()
+            if row is not None:
+                found[key] = (row[0], row[1])
+        return found
+
+    def store(self, entries, source_language, target_language, backend):
+        """
+        Store entries, a dict of {key: (translation, detected_language)}.
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(key, source_language, target_language, backend, translation, detected_language, now)
+                 for key, (translation, detected_language) in entries.items()])
+
+    def translate_targets(self, texts_by_target, source_language, backend, translate_function):
+        """
+        Translate {target_language: [line]}, sending only the unique lines of each target missing from the store to
+        translate_function. translate_function takes {target_language: [line]} and returns
+        {target_language: [(translation, detected_language)]} in the same order; it is not called when every line is
+        in the store.
+        Returns {target_language: [(translation, detected_language)]} aligned with the lines.
+        """
+        plans = {}
+        for target_language, texts in texts_by_target.items():
+            keys = [normalize_text(text) for text in texts]
+            # First line of each key, in order of appearance, so that every key is sent once.
+            first_texts = {}
+            for key, text in zip(keys, texts):
+                first_texts.setdefault(key, text)
+            translations = self.lookup(first_texts.keys(), source_language, target_language, backend)
+            missing = [key for key in first_texts if key not in translations]
+            plans[target_language] = (keys, first_texts, translations, missing)
+
+        lines_to_send = {target_language: [first_texts[key] for key in missing]
+                         for target_language, (_, first_texts, _, missing) in plans.items() if len(missing) > 0}
+        sent = translate_function(lines_to_send) if len(lines_to_send) > 0 else {}
+
+        results = {}
+        for target_language, (keys, _, translations, missing) in plans.items():
+            if len(missing) > 0:
+                if len(sent[target_language]) != len(missing):
+                    raise ValueError("Translated " + str(len(sent[target_language])) + " lines, expected " + str(len(missing)) + ".")
+                fresh = dict(zip(missing, sent[target_language]))
+                self.store(fresh, source_language, target_language, backend)
+                translations.update(fresh)
+            self.sent += len(missing)
+            self.hits += len(keys) - len(missing)
+            results[target_language] = [translations[key] for key in keys]
+        return results
+
+    def translate(self, texts, source_language, target_language, backend, translate_function):
+        """
+        translate_targets for a single target language. translate_function takes and returns lists instead of dicts.
+        """
+        return self.translate_targets({target_language: texts}, source_language, backend,
+                                      lambda lines: {target_language: translate_function(lines[target_language])})[target_language]
+
+    def report(self):
+        return "Translation memory: " + str(self.hits) + " lines reused, " + str(self.sent) + " unique lines translated."
+
+    def summary(self):
+        """
+        Return [(backend, source_language, target_language, count)] of the stored translations.
+        """
+        return self.connection.execute(
+            'SELECT backend, source_language, target_language, COUNT(*) FROM translations'
+            ' GROUP BY backend, source_language, target_language ORDER BY backend, source_language, target_language').fetchall()
+
+    def clear(self, backend=None, target_language=None):
+        """
+        Delete the stored translations, only those of backend and target_language if set. Returns the number deleted.
+        """
+        conditions = []
+        params = []
+        if backend is not None:
+            conditions.append('backend = ?')
+            params.append(backend)
+        if target_language is not None:
+            conditions.append('target_language = ?')
+            params.append(target_language)
+        where = ' WHERE ' + ' AND '.join(conditions) if len(conditions) > 0 else ''
+        with self.connection:
+            return self.connection.execute('DELETE FROM translations' + where, params).rowcount
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect or clear the translation memory.')
+    parser.add_argument("command", choices=['stats', 'clear'], help="stats: print the number of stored translations. clear: delete stored translations.")
+    parser.add_argument("--path", help="Translation memory to use. Defaults to TRANSLATION_MEMORY_PATH or " + DEFAULT_TRANSLATION_MEMORY_PATH + ".")
+    parser.add_argument("--backend", help="clear: only delete the translations of this backend.")
+    parser.add_argument("--target_language", help="clear: only delete the translations to this language.")
+    args = parser.parse_args()
+
+    path = args.path or os.environ.get('TRANSLATION_MEMORY_PATH', DEFAULT_TRANSLATION_MEMORY_PATH)
+    if not os.path.isfile(path):
+        sys.exit("No translation memory at " + path + ".")
+    with TranslationMemory(path) as memory:
+        if args.command == 'stats':
+            for backend, source_language, target_language, count in memory.summary():
+                print(backend, source_language + ' -> ' + target_language, count)
+        else:
+            print("Deleted " + str(memory.clear(args.backend, args.target_language)) + " translations.")